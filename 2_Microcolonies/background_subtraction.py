@@ -0,0 +1,84 @@
+#title           : background_subtraction.py
+#description     : Rolling ball background subtraction of every plane of an image,
+#					either exact ("Subtract Background...") or fast: the background is
+#					computed with a sliding paraboloid on a shrunken copy of the plane
+#					and enlarged again. Import it from a script in the same folder:
+#					background_subtraction.subtract_background(imp, 40, True, "fast")
+#					background_subtraction_np.py is the NumPy version for whole stacks.
+#date            : 2026/10/18
+#version         :
+#usage           :
+#notes           :
+#python_version  : ImageJ
+
+#=======================================================================
+
+from ij.plugin import Binner
+from ij.plugin.filter import BackgroundSubtracter
+from ij.process import ImageProcessor, Blitter
+
+MODES = ['exact', 'fast']
+# ball radius (pixels) on the shrunken planes of the fast mode
+FAST_RADIUS = 5
+
+
+def fast_shrink(radius):
+	'''
+	shrink factor of the fast mode, the ball has a radius of about FAST_RADIUS on the shrunken plane
+	'''
+	return max(1, int(round(radius / float(FAST_RADIUS))))
+
+
+def background_fast(ip, radius, light):
+	'''
+	approximate rolling ball background (FloatProcessor) of ip: the minimum (maximum with a
+	light background) of every block of the plane, rolled with a sliding paraboloid and
+	enlarged with bilinear interpolation
+	'''
+	shrink = fast_shrink(radius)
+	fp = ip.convertToFloat()
+	if fp is ip:
+		fp = fp.duplicate()
+	if shrink == 1:
+		small = fp
+	else:
+		small = Binner().shrink(fp, shrink, shrink, Binner.MAX if light else Binner.MIN)
+	BackgroundSubtracter().rollingBallBackground(small, radius / float(shrink), True, light, True, True, False)
+	if shrink == 1:
+		return small
+	small.setInterpolationMethod(ImageProcessor.BILINEAR)
+	return small.resize(ip.getWidth(), ip.getHeight(), True)
+
+
+def subtract_plane(ip, radius, light=False, mode='exact'):
+	'''
+	subtracts the rolling ball background from ip (in place) like "Subtract Background...":
+	with a light background the background becomes white (255 or 65535)
+	'''
+	if mode == 'exact' or ip.getBitDepth() == 24:
+		BackgroundSubtracter().rollingBallBackground(ip, radius, False, light, False, True, True)
+		return ip
+	background = background_fast(ip, radius, light)
+	fp = ip.convertToFloat()
+	if fp is ip:
+		fp = fp.duplicate()
+	fp.copyBits(background, 0, 0, Blitter.SUBTRACT)
+	if light:
+		fp.add({8: 255, 16: 65535}.get(ip.getBitDepth(), 0))
+	# rounded and clamped to the range of ip
+	ip.setPixels(0, fp)
+	return ip
+
+
+def subtract_background(imp, radius, light=False, mode='exact'):
+	'''
+	subtracts the rolling ball background from every plane of imp (in place), mode 'exact'
+	as "Subtract Background..." (rolling ball, with smoothing) or 'fast'. Returns imp.
+	'''
+	if mode not in MODES:
+		raise ValueError('unknown background subtraction mode ' + str(mode))
+	stack = imp.getStack()
+	for n in range(1, stack.getSize() + 1):
+		subtract_plane(stack.getProcessor(n), radius, light, mode)
+	imp.updateAndDraw()
+	return imp
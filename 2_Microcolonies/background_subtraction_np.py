@@ -0,0 +1,211 @@
+"""
+Rolling Ball Background Subtraction (NumPy)
+
+This module subtracts a rolling ball background from whole (T, Y, X) stacks
+without Fiji. The frames are filtered together by vectorized SciPy calls.
+
+Modes:
+	exact  the rolling ball of ImageJ's "Subtract Background..." (with
+	       smoothing): the frames are smoothed (3x3 mean), shrunk by 2, 4 or 8
+	       for large balls and opened with ImageJ's (trimmed) ball.
+	fast   the frames are shrunk until the ball has a radius of about
+	       FAST_RADIUS pixels and opened with a paraboloid of the same
+	       curvature as the ball (sliding paraboloid), which is separable into
+	       two parabolas along x and y. The background is a little smoother
+	       than the exact one. For radius 40 the opening is about 40 times
+	       faster and the whole subtraction about 2.5 times, as the smoothing
+	       and the interpolation at full resolution remain.
+
+In both modes the shrunken background is enlarged again by linear
+interpolation and can not be above the (smoothed) frames, or below with a
+light background. As in ImageJ, 8 and 16-bit results with a light background
+are offset to white (255 or 65535).
+
+It is used by segment_colonies_np.py (2_Microcolonies) and can preprocess
+the frames of other workflows (e.g. before Ilastik). background_subtraction.py
+offers both modes in FIJI. Run as script, a TIFF stack is written background
+subtracted.
+
+Usage:
+	python background_subtraction_np.py --radius 40 --light --mode fast input.tif output.tif
+"""
+
+import time
+import argparse
+import logging
+import numpy as np
+from scipy import ndimage
+
+MODES = ["exact", "fast"]
+# ball radius (pixels) on the shrunken frames of the fast mode
+FAST_RADIUS = 5
+# number of frames that are filtered together
+BATCH = 8
+
+
+def ball_parameters(radius):
+	"""
+	Shrink factor and ball (height of every point) of ImageJ's rolling ball:
+	large balls roll over an image shrunk by 2, 4 or 8, with the ball trimmed at its rim.
+	"""
+	if radius <= 10:
+		shrink, arc_trim = 1, 24
+	elif radius <= 30:
+		shrink, arc_trim = 2, 24
+	elif radius <= 100:
+		shrink, arc_trim = 4, 32
+	else:
+		shrink, arc_trim = 8, 40
+	small_radius = max(radius / shrink, 1)
+	half_width = int(round(small_radius - int(arc_trim * small_radius) / 100))
+	y, x = np.mgrid[-half_width:half_width + 1, -half_width:half_width + 1]
+	ball = np.sqrt(np.maximum(small_radius ** 2 - x * x - y * y, 0))
+	return shrink, ball
+
+
+def fast_shrink(radius):
+	"""
+	Shrink factor of the fast mode, at least that of ImageJ's rolling ball.
+	"""
+	return max(ball_parameters(radius)[0], int(round(radius / FAST_RADIUS)))
+
+
+def shrink_stack(stack, shrink):
+	"""
+	Minimum of every shrink x shrink block of the frames (T, Y, X); partial blocks at the border included.
+	"""
+	nt, ny, nx = stack.shape
+	sy, sx = -(-ny // shrink), -(-nx // shrink)
+	padded = np.full((nt, sy * shrink, sx * shrink), np.inf, dtype=stack.dtype)
+	padded[:, :ny, :nx] = stack
+	return padded.reshape(nt, sy, shrink, sx, shrink).min(axis=(2, 4))
+
+
+def enlarge_stack(small, shape, shrink):
+	"""
+	Linear interpolation of the shrunken frames back to the frame shape (Y, X);
+	the value of every block is at its center, beyond the outer centers it is extended.
+	"""
+	out = small
+	for axis, n in ((1, shape[0]), (2, shape[1])):
+		centers = np.arange(out.shape[axis]) * shrink + (shrink - 1) / 2
+		pos = np.clip(np.arange(n), centers[0], centers[-1])
+		i = np.clip(np.searchsorted(centers, pos, side='right') - 1, 0, len(centers) - 1)
+		j = np.minimum(i + 1, len(centers) - 1)
+		w = np.where(j > i, (pos - centers[i]) / shrink, 0).astype(np.float32)
+		w_shape = [1, 1, 1]
+		w_shape[axis] = -1
+		out = np.take(out, i, axis=axis) * (1 - w.reshape(w_shape)) + np.take(out, j, axis=axis) * w.reshape(w_shape)
+	return out
+
+
+def ball_opening(stack, ball):
+	"""
+	Grey opening of the frames (T, Y, X) with the ball: the highest surface the ball reaches from below.
+	Positions of the ball outside of a frame do not touch it.
+	"""
+	structure = ball[np.newaxis].astype(np.float32)
+	eroded = ndimage.grey_erosion(stack, structure=structure, mode='constant', cval=np.inf)
+	return ndimage.grey_dilation(eroded, structure=structure, mode='constant', cval=-np.inf)
+
+
+def paraboloid_opening(stack, radius):
+	"""
+	Grey opening of the frames (T, Y, X) with a paraboloid of the curvature of a
+	ball of the radius, as erosions and dilations with parabolas along y and x.
+	"""
+	half_width = int(np.ceil(radius))
+	k = np.arange(-half_width, half_width + 1)
+	parabola = (-k * k / (2 * radius)).astype(np.float32)
+	structures = [parabola.reshape(1, -1, 1), parabola.reshape(1, 1, -1)]
+	out = stack
+	for structure in structures:
+		out = ndimage.grey_erosion(out, structure=structure, mode='constant', cval=np.inf)
+	for structure in structures:
+		out = ndimage.grey_dilation(out, structure=structure, mode='constant', cval=-np.inf)
+	return out
+
+
+def rolling_ball_background(stack, radius, light=False, mode="exact"):
+	"""
+	Rolling ball background of the frames (T, Y, X) as float32, in the exact or
+	the fast mode (see above). With a light background the ball rolls from above.
+	"""
+	if mode not in MODES:
+		raise ValueError(f"Unknown mode {mode}, use one of {', '.join(MODES)}")
+	img = stack.astype(np.float32)
+	if light:
+		img = -img
+	smooth = ndimage.uniform_filter(img, size=(1, 3, 3), mode='nearest')
+	if mode == "exact":
+		shrink, ball = ball_parameters(radius)
+	else:
+		shrink = fast_shrink(radius)
+	small = shrink_stack(smooth, shrink) if shrink > 1 else smooth
+	if mode == "exact":
+		background = ball_opening(small, ball)
+	else:
+		background = paraboloid_opening(small, radius / shrink)
+	if shrink > 1:
+		background = enlarge_stack(background, img.shape[1:], shrink)
+	background = np.minimum(background, img)
+	return -background if light else background
+
+
+def subtract_background(stack, radius, light=False, mode="exact"):
+	"""
+	Subtract the rolling ball background from the frames (T, Y, X) like ImageJ:
+	integer frames (signed or unsigned) are rounded (half up, as ImageJ) and
+	clamped to the range of their type and, with a light background, the
+	background becomes white. Float frames are not offset.
+	"""
+	background = rolling_ball_background(stack, radius, light, mode)
+	if stack.dtype.kind == "f":
+		return (stack - background).astype(stack.dtype)
+	info = np.iinfo(stack.dtype)
+	offset = info.max + 0.5 if light else 0.5
+	return np.clip(np.floor(stack - background + offset), info.min, info.max).astype(stack.dtype)
+
+
+def subtract_background_batches(stack, radius, light=False, mode="exact", batch=BATCH, out=None):
+	"""
+	Subtract the background from a long stack (T, Y, X) in batches of frames, into out (default: a new array).
+	"""
+	if out is None:
+		out = np.empty_like(stack)
+	for start in range(0, len(stack), batch):
+		out[start:start + batch] = subtract_background(stack[start:start + batch], radius, light, mode)
+	return out
+
+
+def run():
+	"""
+	Run the script with command line arguments.
+	"""
+	import tifffile
+
+	logging.basicConfig(level=logging.INFO, format="%(message)s")
+	parser = argparse.ArgumentParser(description="Subtract a rolling ball background from every plane of a TIFF stack")
+	parser.add_argument("input", help="TIFF file to read")
+	parser.add_argument("output", help="TIFF file to write")
+	parser.add_argument("--radius", type=float, default=40, help="Rolling ball radius (pixels)")
+	parser.add_argument("--light", action="store_true", help="Light background")
+	parser.add_argument("--mode", default="exact", choices=MODES, help="Exact (ImageJ) or fast approximate background")
+	parser.add_argument("--batch", type=int, default=BATCH, help="Frames filtered together")
+	args = parser.parse_args()
+
+	with tifffile.TiffFile(args.input) as tif:
+		data = tif.series[0].asarray()
+		imagej_metadata = tif.imagej_metadata
+		axes = tif.series[0].axes
+	stack = data.reshape((-1,) + data.shape[-2:])
+	start = time.perf_counter()
+	result = subtract_background_batches(stack, args.radius, args.light, args.mode, args.batch)
+	duration = time.perf_counter() - start
+	metadata = {"axes": axes} if imagej_metadata is not None else None
+	tifffile.imwrite(args.output, result.reshape(data.shape), imagej=metadata is not None, metadata=metadata)
+	logging.info(f"Subtracted the background of {len(stack)} planes in {duration:.1f} s ({args.mode})")
+
+
+if __name__ == "__main__":
+	run()
@@ -12,7 +12,10 @@
 
 import os
 import sys
+import math
 import csv
+import json
+import time
 from ij import IJ, ImagePlus
 from ij.io import Opener
 from ij.plugin import ChannelSplitter, ImageCalculator, ZProjector, Duplicator
@@ -32,75 +35,45 @@ import drift_correction
 #@ File (label="Choose the input image:", style="directory") IN_DIR
 #@ File (label="Ouput directory:", style="directory") OUT_DIR
 #@ Boolean (label="Manually adjust crop region", style=boolean, value=false) adj_crop
+#@ Boolean (label="Check the crop region on the minimum projection over all frames", style=boolean, value=false) check_crop
+#@ Integer (label="Reference positions for a shared stage drift (0: drift of every position on its own)", value=0) n_ref
+#@ String (label="Only these input files (comma separated, empty: all)", value="", required=false) only_files
+#@ Integer (label="Threads per file (0: all processors)", value=0) n_threads
+#@ Integer (label="Memory budget in MB, planes are read when needed (0: load whole files)", value=0) budget_mb
+#@ String (label="Compression of the exported stacks (lossless)", choices={"none", "LZW", "Deflate"}, value="none") compression
 
 
-def find_edges(img):
+# per-file record of the completed stages, so a rerun skips finished files
+MANIFEST_SUFFIX = '_manifest.json'
+STAGES = ['unpacked', 'shifts', 'cropped', 'exported']
+
+
+def find_edges(shifts, width, height, slices, options):
 	'''
-	finds the top, bottom, right and left borders where all
-	black bars a cut out in all frames
+	finds the left, right, top and bottom borders of the field of view that is
+	covered by all frames of the registered image, from the correction shifts of
+	the frames of width x height x slices, without looking at any pixel: the black
+	bars are where the frames were moved in. The shifts are those applied by
+	drift_correction.correct_drift() with the options (rounded unless subpixel),
+	the registered canvas either contains all frames or is already cropped to the
+	common field of view.
 	'''
 
-	frames = img.getNFrames()
-	centerx = int(img.getHeight() /2)
-	centery = int(img.getWidth() /2)
-
-	maxleft = 0
-	maxtop = 0
-	minright = int(img.getHeight())
-	minbottom = int(img.getWidth())
-
-	for f in range(1,frames+1):
-		img.setPosition(1,1,f)
-		ip = img.getProcessor()
-
-		# find left and right limits of the black borders 
-		setleft = True
-		setright= True
-
-		ic = 0
-
-		if ip.getPixelValue(maxleft,centery)>0.0:
-			setleft= False
-		if ip.getPixelValue(minright,centery)>0.0:
-			setright= False
-			
-		for i in range(maxleft,minright):
-			if ip.getPixelValue(minright-ic,centery) > 0.0 and setright:
-				minright -= ic
-				setright= False
-			ic +=1
-		
-			if ip.getPixelValue(i,centery) > 0.0 and setleft:
-				maxleft = i
-				setleft = False
-
-			#if not setleft and not setright:
-			#	break
-
-		# find top and bottom limits of the black borders 
-		settop = True
-		setbottom = True
-
-		ic = 0
-
-		if ip.getPixelValue(centerx, maxtop)>0.0:
-			settop= False
-		if ip.getPixelValue(centerx,minbottom)>0.0:
-			setbottom= False
-			
-		for i in range(maxtop,minbottom):
-			if ip.getPixelValue(centerx,minbottom-ic) > 0.0 and setbottom:
-				minbottom -= ic
-				setbottom= False
-			ic +=1
-		
-			if ip.getPixelValue(centerx, i) > 0.0 and settop:
-				maxtop = i
-				settop = False
+	if not options.subpixel:
+		shifts = drift_correction.convert_shifts_to_integer(shifts)
+	minx, miny, minz, maxx, maxy, maxz = drift_correction.compute_min_max(shifts)
+
+	# offset of the canvas, as chosen by drift_correction.registered_canvas()
+	if options.crop and min(width - (maxx - minx), height - (maxy - miny), slices - (maxz - minz)) >= 1:
+		offx, offy = maxx, maxy
+	else:
+		offx, offy = minx, miny
+
+	maxleft = int(math.ceil(maxx - offx))
+	minright = int(math.floor(minx - offx + width - 1))
+	maxtop = int(math.ceil(maxy - offy))
+	minbottom = int(math.floor(miny - offy + height - 1))
 
-			#if not settop and not setbottom:
-			#	break
-	
 	IJ.log('MAXLEFT: %d' % maxleft)
 	IJ.log('MINRIGHT: %d' % (minright+1-maxleft))
 	IJ.log('MAXTOP: %d' % maxtop)
@@ -109,16 +82,91 @@ def find_edges(img):
 	return maxleft, minright, maxtop, minbottom
 
 
+def check_edges(img, maxleft, minright, maxtop, minbottom):
+	'''
+	checks the crop region on the minimum projection over all frames (first
+	channel and slice): a black bar makes a whole edge of the region zero,
+	while dark image content does not. Returns the edges that are black.
+	'''
+
+	frames = Duplicator().run(img, 1, 1, 1, 1, 1, img.getNFrames())
+	frames.setDimensions(1, frames.getStackSize(), 1) # project along time
+	ip = ZProjector.run(frames, 'min').getProcessor()
+	frames.close()
+
+	edges = {'left': (maxleft, maxtop, 1, minbottom+1-maxtop),
+		'right': (minright, maxtop, 1, minbottom+1-maxtop),
+		'top': (maxleft, maxtop, minright+1-maxleft, 1),
+		'bottom': (maxleft, minbottom, minright+1-maxleft, 1)}
+	black = []
+	for edge in ['left', 'right', 'top', 'bottom']:
+		ip.setRoi(*edges[edge])
+		if ip.getStatistics().max == 0:
+			black.append(edge)
+	ip.resetRoi()
+	if black:
+		IJ.log('    black border left at the {0} edge'.format(', '.join(black)))
+	return black
+
+
+def output_name(f):
+	'''
+	name of the output folder and files of an input file
+	'''
+	return f.replace('.vsi','').replace('Multichannel Time Lapse_','')
+
+
+def read_manifest(img_dir, img_name, img_file):
+	'''
+	returns the manifest of an input file, a new one if there is none
+	or the input file changed since (size or modification time)
+	'''
+	manifest = {'file': img_file, 'size': os.path.getsize(img_file), 'mtime': os.path.getmtime(img_file), 'stages': {}, 'files': []}
+	path = os.path.join(img_dir, img_name + MANIFEST_SUFFIX)
+	if not os.path.isfile(path):
+		return manifest
+	try:
+		f = open(path, 'r')
+		old = json.load(f)
+		f.close()
+	except ValueError:
+		IJ.log('    ignoring unreadable manifest ' + path)
+		return manifest
+	if old.get('size') != manifest['size'] or old.get('mtime') != manifest['mtime']:
+		return manifest
+	return old
+
+
+def write_manifest(img_dir, img_name, manifest, stage):
+	'''
+	records a completed stage
+	'''
+	manifest['stages'][stage] = time.strftime('%Y-%m-%d %H:%M:%S')
+	f = open(os.path.join(img_dir, img_name + MANIFEST_SUFFIX), 'w')
+	json.dump(manifest, f, indent=1)
+	f.close()
+
+
+def is_done(img_dir, manifest):
+	'''
+	whether the file was exported and the exported files still exist
+	'''
+	if 'exported' not in manifest['stages']:
+		return False
+	return all([os.path.isfile(os.path.join(img_dir, name)) for name in manifest['files']])
+
+
 def crop_border(img, maxleft, minright, maxtop, minbottom, adj_crop):
 	'''
-	selects region and crops it out
+	selects region and returns it (after manual adjustment),
+	the channels are exported cropped to it
 	'''
 	img.setRoi(maxleft,maxtop,minright+1-maxleft,minbottom+1-maxtop)
 	if adj_crop:
+		img.show()
 		WaitForUserDialog('Adjust crop region','Adjust the crop region if necessary').show()
 
-
-	IJ.run("Crop")
+	return img.getRoi().getBounds()
 
 
 if __name__ == '__main__':
@@ -128,10 +176,25 @@ if __name__ == '__main__':
 	img_path = str(IN_DIR)
 
 	img_files = [f for f in os.listdir(img_path) if f.endswith('vsi')]
+	if only_files:
+		selected = [name.strip() for name in only_files.split(',')]
+		img_files = [f for f in img_files if f in selected]
 
 	IJ.log('\n-- {0:-<80}'.format('SETUP'))
 	IJ.log('    Output dir:{0: >20}'.format(OUT_DIR))
 
+	# the stage drift of a multi-position acquisition is shared by all positions:
+	# it is computed on a few reference positions and only checked on the others
+	shared_drift = None
+	if n_ref > 0:
+		IJ.log('\n-- {0:-<80}'.format('SHARED STAGE DRIFT'))
+		ref_files = img_files[:n_ref]
+		ref_dirs = [os.path.join(out_path, output_name(f)) for f in ref_files]
+		for ref_dir in ref_dirs:
+			if not os.path.isdir(ref_dir):
+				os.makedirs(ref_dir)
+		shared_drift = drift_correction.shared_stage_drift([os.path.join(img_path, f) for f in ref_files], None, ref_dirs, budget_mb * 1e6 if budget_mb > 0 else None)
+
 	for f in img_files:
 		
 		IJ.log('    Input file:{0: >20}'.format(f))
@@ -139,51 +202,90 @@ if __name__ == '__main__':
 
 		# list all non-blank images
 		img_file = os.path.join(img_path, f)
-		img_name = f.replace('.vsi','').replace('Multichannel Time Lapse_','')
+		img_name = output_name(f)
 		img_dir = os.path.join(out_path, img_name)
 		if not os.path.isdir(img_dir):
 			os.makedirs(img_dir)
 		
+		manifest = read_manifest(img_dir, img_name, img_file)
+		if is_done(img_dir, manifest):
+			IJ.log('    already exported, skipping')
+			continue
 
 		IJ.log('\n-- {0:-<80}'.format(img_file))
 		
 		# import image and get some info
-		img = Opener.openUsingBioFormats(img_file)
-		img.show()
+		if budget_mb > 0:
+			img = drift_correction.open_virtual_image(img_file)
+		else:
+			img = Opener.openUsingBioFormats(img_file)
 		
 		IMG_NAME = img.getTitle()
 		NUMBER_CHANNELS = img.getNChannels()
 		NUMBER_FRAMES = img.getNFrames()
 		NUMBER_SLICES = img.getNSlices()
+		WIDTH = img.getWidth()
+		HEIGHT = img.getHeight()
 		print(NUMBER_FRAMES, NUMBER_CHANNELS, NUMBER_SLICES)
+		write_manifest(img_dir, img_name, manifest, 'unpacked')
 
 		
 				
 		IJ.log('\n-- {0:-<80}'.format('DRIFT CORRECTION'))
 		
 		# DRIFT CORRECTION
-		img_reg = drift_correction.auto_run()
-		img.close()
-
-
-		IJ.log('\n-- {0:-<80}'.format('CROP BORDERS'))
-
-		maxleft, minright, maxtop, minbottom = find_edges(img_reg)
-
-		crop_border(img_reg, maxleft, minright, maxtop, minbottom, adj_crop)
+		# drift is cached next to the exported files and reused when rerun
+		# frame pairs on all processors, only the field of view of all frames is kept, full resolution
+		options = drift_correction.DriftOptions.auto(img, fast = True, pyramid = 1)
+		if n_threads > 0:
+			options.threads = n_threads
+		if budget_mb > 0:
+			# the registered image is a view on the input file, only the frame pairs
+			# of the drift computation are in memory, as many as fit into the budget
+			options.lazy = True
+			options.threads = drift_correction.budget_threads(img, options.z_min, options.z_max or NUMBER_SLICES, options.threads, budget_mb * 1e6)
+			IJ.log('    {0} threads within {1} MB'.format(options.threads, budget_mb))
+		if shared_drift is not None and drift_correction.shared_drift_agrees(img, shared_drift, options):
+			IJ.log('    shared stage drift')
+			img_reg, shifts = drift_correction.correct_drift(img, options, None, img_file, img_dir, shared_drift)
+		elif shared_drift is not None:
+			# the drift of this position is refined from the shared drift instead of computed from scratch
+			IJ.log('    drift of this position')
+			refined = drift_correction.refine_shared_drift(img, shared_drift, options)
+			img_reg, shifts = drift_correction.correct_drift(img, options, None, img_file, img_dir, refined)
+		else:
+			img_reg, shifts = drift_correction.correct_drift(img, options, None, img_file, img_dir)
+		if budget_mb <= 0:
+			img.close()
+		write_manifest(img_dir, img_name, manifest, 'shifts')
+
+
+		# the registration output is usually already cropped to the field of view of all frames
+		maxleft, minright, maxtop, minbottom = find_edges(shifts, WIDTH, HEIGHT, NUMBER_SLICES, options)
+		if check_crop:
+			check_edges(img_reg, maxleft, minright, maxtop, minbottom)
+		crop_rect = None
+		if adj_crop or (maxleft, minright, maxtop, minbottom) != (0, img_reg.getWidth()-1, 0, img_reg.getHeight()-1):
+			IJ.log('\n-- {0:-<80}'.format('CROP BORDERS'))
+			crop_rect = crop_border(img_reg, maxleft, minright, maxtop, minbottom, adj_crop)
+		write_manifest(img_dir, img_name, manifest, 'cropped')
 		
 
 		IJ.log('\n-- {0:-<80}'.format('EXPORT'))
 
 
+		# all channels are written plane by plane in one pass over the registered stack
 		chn_names = ['_phase', '_fluor', '_fluor1', '_fluor2']
-		for i in range(NUMBER_CHANNELS):
-			cimg = Duplicator().run(img_reg, i+1,i+1,1,1,1,NUMBER_FRAMES)
-			IJ.save(cimg, os.path.join(img_dir, img_name + chn_names[i] + '.tif'))
-			cimg.close()
+		manifest['files'] = [img_name + chn_names[i] + '.tif' for i in range(NUMBER_CHANNELS)]
+		if drift_correction.save_channels(img_reg, [os.path.join(img_dir, name) for name in manifest['files']], crop_rect, compression):
+			write_manifest(img_dir, img_name, manifest, 'exported')
+		else:
+			IJ.log('    could not save all channels of ' + img_name)
 
 		img_reg.changes = False
 		img_reg.close()
+		if budget_mb > 0:
+			img.close()
 
 	print('DONE')
 	IJ.log('-----------------------------END-----------------------------')
@@ -0,0 +1,142 @@
+"""
+Batch Driver for batch_unpack_vis.py
+
+This script runs batch_unpack_vis.py on a folder of .vsi files with several
+headless FIJI processes in parallel, one file per process at a time. The FIJI
+script records the completed stages of every file (unpacked, shifts computed,
+cropped, exported) in a manifest next to the exported files:
+
+OUT_DIR
+	└── Position1
+	│		├── Position1_manifest.json
+	│		├── Position1_drift.json
+	│		├── Position1_phase.tif
+	│		└── Position1_fluor.tif
+	└── ...
+
+Files whose manifest lists them as exported (with all exported files present)
+are not started again, so a rerun after a crash only processes the remaining
+files; their drift is read from the drift cache if it was already computed.
+A log of every worker is written to OUT_DIR/logs.
+
+Usage:
+	python batch_unpack_vis_driver.py --fiji /opt/Fiji.app/ImageJ-linux64 --workers 4 IN_DIR OUT_DIR
+"""
+
+import os
+import json
+import argparse
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+FIJI_SCRIPT = os.path.join(SCRIPT_PATH, "batch_unpack_vis.py")
+MANIFEST_SUFFIX = "_manifest.json"
+
+
+def output_name(f):
+	"""
+	Name of the output folder and files of an input file (as in batch_unpack_vis.py).
+	"""
+	return f.replace(".vsi", "").replace("Multichannel Time Lapse_", "")
+
+
+def is_done(in_dir, out_dir, f):
+	"""
+	Whether the manifest of the input file lists it as exported, for the same
+	input file, and all exported files exist.
+	"""
+	name = output_name(f)
+	img_dir = os.path.join(out_dir, name)
+	path = os.path.join(img_dir, name + MANIFEST_SUFFIX)
+	if not os.path.isfile(path):
+		return False
+	try:
+		with open(path) as fh:
+			manifest = json.load(fh)
+	except ValueError:
+		return False
+	img_file = os.path.join(in_dir, f)
+	# FIJI (Jython) reports the modification time in milliseconds
+	if manifest.get("size") != os.path.getsize(img_file) or abs(manifest.get("mtime", 0) - os.path.getmtime(img_file)) > 0.001:
+		return False
+	if "exported" not in manifest.get("stages", {}):
+		return False
+	return all(os.path.isfile(os.path.join(img_dir, n)) for n in manifest.get("files", []))
+
+
+def fiji_command(fiji, in_dir, out_dir, f, threads, memory=None, budget=0, compression="none"):
+	"""
+	Command line of a headless FIJI process running batch_unpack_vis.py on one file.
+	"""
+	params = [
+		f'IN_DIR="{in_dir}"',
+		f'OUT_DIR="{out_dir}"',
+		"adj_crop=false",
+		"check_crop=false",
+		"n_ref=0",
+		f'only_files="{f}"',
+		f"n_threads={threads}",
+		f"budget_mb={budget}",
+		f'compression="{compression}"',
+	]
+	command = [fiji, "--ij2", "--headless", "--console"]
+	if memory:
+		command.append(f"--mem={memory}")
+	return command + ["--run", FIJI_SCRIPT, ",".join(params)]
+
+
+def process_file(fiji, in_dir, out_dir, f, threads, memory=None, budget=0, compression="none"):
+	"""
+	Run one FIJI process on the file and return whether it was exported.
+	"""
+	log_dir = os.path.join(out_dir, "logs")
+	os.makedirs(log_dir, exist_ok=True)
+	logging.info(f"Starting {f}")
+	with open(os.path.join(log_dir, output_name(f) + ".log"), "w") as log:
+		result = subprocess.run(fiji_command(fiji, in_dir, out_dir, f, threads, memory, budget, compression), stdout=log, stderr=subprocess.STDOUT)
+	done = is_done(in_dir, out_dir, f)
+	if done:
+		logging.info(f"Finished {f}")
+	else:
+		logging.error(f"{f} was not exported (exit code {result.returncode}), see the log in {log_dir}")
+	return done
+
+
+def run():
+	"""
+	Run the script with command line arguments.
+	"""
+	logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+	parser = argparse.ArgumentParser(description="Run batch_unpack_vis.py on a folder of .vsi files with parallel headless FIJI processes")
+	parser.add_argument("in_dir", help="Folder with the .vsi files")
+	parser.add_argument("out_dir", help="Output folder")
+	parser.add_argument("--fiji", required=True, help="Path of the FIJI executable (e.g. ImageJ-linux64)")
+	parser.add_argument("--workers", type=int, default=2, help="Number of FIJI processes running at the same time")
+	parser.add_argument("--threads", type=int, default=None, help="Threads of each process (default: processors / workers)")
+	parser.add_argument("--memory", default=None, help="Java heap of each process, e.g. 16g (default: FIJI setting)")
+	parser.add_argument("--budget", type=int, default=0, help="Memory budget (MB) of each process, planes are read when needed (default: 0, load whole files)")
+	parser.add_argument("--compression", default="none", choices=["none", "LZW", "Deflate"], help="Lossless compression of the exported stacks, encoded in parallel per channel (default: none)")
+	args = parser.parse_args()
+
+	in_dir = os.path.abspath(args.in_dir)
+	out_dir = os.path.abspath(args.out_dir)
+	threads = args.threads or max(1, os.cpu_count() // args.workers)
+
+	img_files = sorted(f for f in os.listdir(in_dir) if f.endswith("vsi"))
+	todo = [f for f in img_files if not is_done(in_dir, out_dir, f)]
+	logging.info(f"{len(img_files) - len(todo)} of {len(img_files)} files already exported")
+
+	with ThreadPoolExecutor(max_workers=args.workers) as pool:
+		results = list(pool.map(lambda f: process_file(args.fiji, in_dir, out_dir, f, threads, args.memory, args.budget, args.compression), todo))
+
+	failed = [f for f, done in zip(todo, results) if not done]
+	if failed:
+		logging.error(f"{len(failed)} files failed: {', '.join(failed)}")
+	else:
+		logging.info("All files exported")
+
+
+if __name__ == "__main__":
+	run()
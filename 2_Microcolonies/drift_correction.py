@@ -41,8 +41,8 @@
 # - fixed a bug related to hyperstack conversion
 
 from ij import VirtualStack, IJ, CompositeImage, ImageStack, ImagePlus
-from ij.process import ColorProcessor
-from ij.plugin import HyperStackConverter
+from ij.process import ColorProcessor, FloatProcessor, Blitter, ImageProcessor
+from ij.plugin import HyperStackConverter, Binner, ZProjector, Duplicator
 from ij.io import DirectoryChooser, FileSaver, SaveDialog
 from ij.gui import GenericDialog, YesNoCancelDialog, Roi
 from mpicbg.imglib.image import ImagePlusAdapter
@@ -50,8 +50,13 @@ from mpicbg.imglib.algorithm.fft import PhaseCorrelation
 from org.scijava.vecmath import Point3i  #from javax.vecmath import Point3i # java6
 from org.scijava.vecmath import Point3f  #from javax.vecmath import Point3f # java6
 from java.io import File, FilenameFilter
-from java.lang import Integer
+from java.awt import Rectangle
+from java.lang import Integer, Runtime, System
+from java.util.concurrent import Executors, Callable
 import math, os, os.path
+import glob, hashlib, json, time, threading
+from jarray import array
+from collections import OrderedDict
 
 # sub-pixel translation using imglib2
 from net.imagej.axis import Axes
@@ -63,6 +68,13 @@ from net.imglib2.converter import Converters
 from net.imglib2.converter.readwrite import RealFloatSamplerConverter
 from net.imglib2.interpolation.randomaccess import NLinearInterpolatorFactory
 
+# streaming (Big)OME-TIFF output using Bio-Formats
+from loci.common import DataTools
+from loci.formats import MetadataTools, FormatTools
+from loci.formats.out import OMETiffWriter, TiffWriter
+from loci.plugins import BF
+from loci.plugins.in import ImporterOptions
+
 def translate_single_stack_using_imglib2(imp, dx, dy, dz):
   # wrap into a float imglib2 and translate
   #   conversion into float is necessary due to "overflow of n-linear interpolation due to accuracy limits of unsigned bytes"
@@ -100,16 +112,139 @@ def translate_single_stack_using_imagescience(imp, dx, dy, dz):
   return output.imageplus()
 '''
 
-def compute_stitch(imp1, imp2):
+# maximal difference (pixels) of a shift measured on two projections to trust them
+PROJECTION_TOLERANCE = 1
+# size (in x and y) of the full resolution crop used to refine pyramid shifts
+REFINE_CROP = 256
+# smallest downsampled frame size (pixels) of the pyramid
+PYRAMID_MIN_SIZE = 64
+
+def compute_stitch(imp1, imp2, num_threads = None, pyramid = 1, projections = False):
   """ Compute a Point3i that expressed the translation of imp2 relative to imp1."""
+  return compute_stitch_scored(imp1, imp2, num_threads, pyramid, projections)[0]
+
+def clamp_pyramid(pyramid, width, height):
+  """ halves the pyramid factor until frames of width x height downsampled by it keep
+  at least PYRAMID_MIN_SIZE pixels in x and y, smaller frames give wrong coarse shifts """
+  while pyramid > 1 and min(width, height) // pyramid < PYRAMID_MIN_SIZE:
+    pyramid //= 2
+  return pyramid
+
+def compute_stitch_scored(imp1, imp2, num_threads = None, pyramid = 1, projections = False):
+  """ as compute_stitch(), but also returns the confidence of the translation (see phase_correlation()).
+  The pyramid factor is reduced for small frames (see clamp_pyramid()). """
+  pyramid = clamp_pyramid(pyramid, imp1.getWidth(), imp1.getHeight())
+  if projections and imp1.getStackSize() > 1:
+    return compute_stitch_projections(imp1, imp2, num_threads, pyramid)
+  if pyramid > 1:
+    return compute_stitch_pyramid(imp1, imp2, pyramid, num_threads)
+  return phase_correlation(imp1, imp2, num_threads)
+
+def phase_correlation(imp1, imp2, num_threads = None):
+  """ translation (Point3i) of imp2 relative to imp1 and its confidence: the normalized
+  cross correlation of the overlap at the best of the five checked peaks (at most 1) """
   phc = PhaseCorrelation(ImagePlusAdapter.wrap(imp1), ImagePlusAdapter.wrap(imp2), 5, True)
+  if num_threads:
+    phc.setNumThreads(num_threads)
   phc.process()
-  p = phc.getShift().getPosition()
+  peak = phc.getShift()
+  p = peak.getPosition()
   if len(p)==3: # 3D data
     p3 = p
   elif len(p)==2: # 2D data: add zero shift
     p3 = [p[0],p[1],0]
-  return Point3i(p3)
+  return Point3i(p3), peak.getCrossCorrelationPeak()
+
+windows = {}
+
+def apodize(imp):
+  """ fades every slice out to its mean towards the border in x and y (Hann window),
+  returns a 32-bit copy """
+  w = imp.getWidth()
+  h = imp.getHeight()
+  if (w, h) not in windows:
+    wx = [0.5 - 0.5 * math.cos(2 * math.pi * (x + 1) / (w + 1)) for x in range(w)]
+    wy = [0.5 - 0.5 * math.cos(2 * math.pi * (y + 1) / (h + 1)) for y in range(h)]
+    windows[(w, h)] = FloatProcessor(w, h, array([wx[x] * wy[y] for y in range(h) for x in range(w)], 'f'))
+  window = windows[(w, h)]
+  stack = imp.getStack()
+  stack2 = ImageStack(w, h)
+  for s in range(1, stack.getSize()+1):
+    fp = stack.getProcessor(s).convertToFloat()
+    mean = fp.getStatistics().mean
+    fp.subtract(mean)
+    fp.copyBits(window, 0, 0, Blitter.MULTIPLY)
+    fp.add(mean)
+    stack2.addSlice("", fp)
+  return ImagePlus("", stack2)
+
+def crop_overlap(imp1, imp2, shift):
+  """ returns the central part (at most REFINE_CROP in x and y) of the overlap of imp1
+  at x + shift and imp2 at x, as two images of the same size """
+  offsets1 = []
+  offsets2 = []
+  sizes = []
+  for d, n1, n2, max_size in [(shift.x, imp1.getWidth(), imp2.getWidth(), REFINE_CROP),
+                              (shift.y, imp1.getHeight(), imp2.getHeight(), REFINE_CROP),
+                              (shift.z, imp1.getStackSize(), imp2.getStackSize(), None)]:
+    lo = max(0, -d)
+    hi = min(n2, n1 - d)
+    if hi <= lo:
+      return None, None
+    size = hi - lo
+    if max_size != None and size > max_size:
+      lo += (size - max_size) / 2
+      size = max_size
+    offsets1.append(lo + d)
+    offsets2.append(lo)
+    sizes.append(size)
+  crop1 = imp1.getStack().crop(offsets1[0], offsets1[1], offsets1[2], sizes[0], sizes[1], sizes[2])
+  crop2 = imp2.getStack().crop(offsets2[0], offsets2[1], offsets2[2], sizes[0], sizes[1], sizes[2])
+  return ImagePlus("", crop1), ImagePlus("", crop2)
+
+def compute_stitch_pyramid(imp1, imp2, factor, num_threads = None):
+  """ Compute the translation of imp2 relative to imp1 on apodized images downsampled
+  by factor in x and y and refine it on a full resolution crop of their overlap.
+  This is much faster for large frames. Returns the translation and the confidence of the refinement. """
+  small1 = apodize(Binner().shrink(imp1, factor, factor, 1, Binner.AVERAGE))
+  small2 = apodize(Binner().shrink(imp2, factor, factor, 1, Binner.AVERAGE))
+  coarse, score = phase_correlation(small1, small2, num_threads)
+  shift = Point3i(coarse.x * factor, coarse.y * factor, coarse.z)
+  crop1, crop2 = crop_overlap(imp1, imp2, shift)
+  if crop1 == None:
+    return shift, score
+  residual, score = phase_correlation(crop1, crop2, num_threads)
+  return Point3i(shift.x + residual.x, shift.y + residual.y, shift.z + residual.z), score
+
+def max_projections(imp):
+  """ maximum intensity projections of a z-stack along z (xy), y (xz) and x (yz),
+  the xz and yz projections have the z axis as their y axis """
+  nz = imp.getStackSize()
+  xy = ZProjector.run(imp, "max")
+  along_y = Binner().shrink(imp, 1, imp.getHeight(), 1, Binner.MAX).getStack()
+  along_x = Binner().shrink(imp, imp.getWidth(), 1, 1, Binner.MAX).getStack()
+  xz = FloatProcessor(imp.getWidth(), nz)
+  yz = FloatProcessor(imp.getHeight(), nz)
+  for z in range(nz):
+    xz.putRow(0, z, along_y.getProcessor(z+1).toFloat(0, None).getPixels(), imp.getWidth())
+    yz.putRow(0, z, along_x.getProcessor(z+1).toFloat(0, None).getPixels(), imp.getHeight())
+  return xy, ImagePlus("xz", xz), ImagePlus("yz", yz)
+
+def compute_stitch_projections(imp1, imp2, num_threads = None, pyramid = 1):
+  """ Compute the translation of imp2 relative to imp1 from 2D phase correlations
+  of their maximum projections: x and y from the xy, z from the xz and yz projections.
+  The full 3D correlation is only computed if the projections disagree.
+  Returns the translation and its confidence (the lowest of the projections). """
+  xy1, xz1, yz1 = max_projections(imp1)
+  xy2, xz2, yz2 = max_projections(imp2)
+  s_xy, c_xy = compute_stitch_scored(xy1, xy2, num_threads, pyramid)
+  s_xz, c_xz = phase_correlation(xz1, xz2, num_threads)
+  s_yz, c_yz = phase_correlation(yz1, yz2, num_threads)
+  if abs(s_xy.x - s_xz.x) <= PROJECTION_TOLERANCE and abs(s_xy.y - s_yz.x) <= PROJECTION_TOLERANCE \
+      and abs(s_xz.y - s_yz.y) <= PROJECTION_TOLERANCE:
+    return Point3i(int(s_xy.x), int(s_xy.y), int(round((s_xz.y + s_yz.y) / 2.0))), min(c_xy, c_xz, c_yz)
+  IJ.log("    projections disagree, computing the full 3D correlation")
+  return compute_stitch_scored(imp1, imp2, num_threads, pyramid)
 
 def extract_frame(imp, frame, channel, z_min, z_max):
   """ From a VirtualStack that is a hyperstack, contained in imp,
@@ -123,25 +258,101 @@ def extract_frame(imp, frame, channel, z_min, z_max):
   return stack2
 
 
-def extract_frame_process_roi(imp, frame, channel, process, background, roi, z_min, z_max):
-  # extract frame and channel 
-  imp_frame = ImagePlus("", extract_frame(imp, frame, channel, z_min, z_max)).duplicate()
-  # check for roi and crop
+# "Mean 3D..." with x=1 y=1 z=0 is the mean of a pixel and its four direct neighbours
+MEAN_XY_KERNEL = [0, 1, 0, 1, 1, 1, 0, 1, 0]
+
+def mean_xy(ip):
+  """ "Mean 3D..." with x=1 y=1 z=0 of a plane (in place): the mean of every pixel and its direct
+  neighbours within the plane. convolve3x3 alone would count duplicated edge pixels, so the plane is
+  convolved with a zero border and the edge pixels are divided by their number of neighbours. """
+  if ip.getBitDepth() == 24:
+    ip.convolve3x3(MEAN_XY_KERNEL)
+    return ip
+  width, height = ip.getWidth(), ip.getHeight()
+  padded = FloatProcessor(width + 2, height + 2)
+  padded.insert(ip.convertToFloat(), 1, 1)
+  padded.convolve3x3(MEAN_XY_KERNEL)
+  padded.setRoi(1, 1, width, height)
+  fp = padded.crop()
+  pixels = fp.getPixels()
+  edge = set([(x, y) for x in range(width) for y in (0, height - 1)] + [(x, y) for y in range(height) for x in (0, width - 1)])
+  for x, y in edge:
+    count = 1 + (x > 0) + (x < width - 1) + (y > 0) + (y < height - 1)
+    pixels[y * width + x] *= 5.0 / count
+  # rounded and clamped to the range of ip
+  ip.setPixels(0, fp)
+  return ip
+
+def extract_frame_process_roi(imp, frame, channel, process, background, roi, z_min, z_max, buffer = None):
+  """ extracts the z-range of a frame and channel, cropped to the roi, subtracts the background
+  (clamped at 0 for integer images) and enhances edges (mean in x and y, Sobel) plane by plane
+  on the processors, instead of a duplicate and three IJ.run() calls through the macro interpreter.
+  Every plane is copied once, into the planes of buffer (a frame returned earlier) if it has the same size.
+  """
+  stack = imp.getStack()
+  # crop to the part of the roi within the image (as "Crop")
+  x, y, width, height = 0, 0, imp.getWidth(), imp.getHeight()
   if roi != None:
-    #print roi.getBounds()
-    imp_frame.setRoi(roi)
-    IJ.run(imp_frame, "Crop", "")
-  # subtract background  
-  if background > 0:
-    #IJ.log("Subtracting "+str(background));
-    IJ.run(imp_frame, "Subtract...", "value="+str(background)+" stack");
-  # enhance edges  
-  if process:
-    IJ.run(imp_frame, "Mean 3D...", "x=1 y=1 z=0");
-    IJ.run(imp_frame, "Find Edges", "stack");
-
-  # return
-  return imp_frame
+    r = roi.getBounds()
+    x, y = max(r.x, 0), max(r.y, 0)
+    width = min(r.x + r.width, imp.getWidth()) - x
+    height = min(r.y + r.height, imp.getHeight()) - y
+  nz = int(z_max) - int(z_min) + 1
+  if buffer is not None:
+    if buffer.getWidth() != width or buffer.getHeight() != height or buffer.getStackSize() != nz or buffer.getBitDepth() != imp.getBitDepth():
+      buffer = None
+  planes = ImageStack(width, height)
+  for i, s in enumerate(range(int(z_min), int(z_max)+1)):
+    src = stack.getProcessor(imp.getStackIndex(channel, s, frame))
+    if buffer is not None:
+      ip = buffer.getStack().getProcessor(i+1)
+    else:
+      ip = src.createProcessor(width, height)
+    ip.insert(src, -x, -y)
+    # subtract background
+    if background > 0:
+      ip.subtract(background)
+    # enhance edges
+    if process:
+      mean_xy(ip)
+      ip.findEdges()
+    planes.addSlice(str(s), ip)
+  return ImagePlus("", planes)
+
+FRAME_CACHE_SIZE = 8 # frames kept by default
+
+class FrameCache(object):
+  """ Bounded LRU cache of preprocessed frames.
+  Each frame is used in two pairs (t-dt, t) and (t, t+dt), with this cache
+  it is only extracted and processed once. The key contains everything the
+  preprocessing depends on, so frames with a differently shifted roi are
+  recomputed.
+  """
+  def __init__(self, max_size=FRAME_CACHE_SIZE):
+    self.max_size = max_size
+    self.frames = OrderedDict()
+    self.spare = None # planes of the last evicted frame, reused for the next one
+
+  def reserve(self, size):
+    """ keeps at least size frames, so frames in use are not evicted (and reused) """
+    self.max_size = max(self.max_size, size)
+
+  def get(self, imp, frame, channel, process, background, roi, z_min, z_max):
+    if roi != None:
+      r = roi.getBounds()
+      bounds = (r.x, r.y, r.width, r.height)
+    else:
+      bounds = None
+    key = (frame, channel, bounds, process, background, z_min, z_max)
+    if key in self.frames:
+      imp_frame = self.frames.pop(key)
+    else:
+      imp_frame = extract_frame_process_roi(imp, frame, channel, process, background, roi, z_min, z_max, self.spare)
+      self.spare = None
+      if len(self.frames) >= self.max_size:
+        self.spare = self.frames.popitem(last=False)[1]
+    self.frames[key] = imp_frame
+    return imp_frame
 
 def add_Point3f(p1, p2):
   p3 = Point3f(0,0,0)
@@ -198,12 +409,108 @@ def shift_roi(imp, roi, dr):
     shifted_roi = Roi(sx, sy, r.width, r.height)
     return shifted_roi   
   
-def compute_and_update_frame_translations_dt(imp, channel, dt, process, background, z_min, z_max, shifts = None):
+class StitchTask(Callable):
+  """ compute_stitch_scored() of one frame pair, to be run on a thread pool """
+  def __init__(self, imp1, imp2, num_threads, pyramid, projections = False):
+    self.imp1 = imp1
+    self.imp2 = imp2
+    self.num_threads = num_threads
+    self.pyramid = pyramid
+    self.projections = projections
+
+  def call(self):
+    return compute_stitch_scored(self.imp1, self.imp2, self.num_threads, self.pyramid, self.projections)
+
+def frame_pairs(nt, dt):
+  """ returns the (t-dt, t) frame pairs (0-based) compared at frame shift dt
+  """
+  pairs = []
+  for t in range(dt, nt+dt, dt):
+    if t > nt-1: # together with above range till nt+dt this ensures that the last data points are not missed out
+      t = nt-1 # nt-1 is the last shift (0-based)
+    pairs.append((t-dt, t))
+  return pairs
+
+def pair_cache_size(threads):
+  """ the number of frames compute_pair_shifts() keeps in the FrameCache: those of two blocks of
+  2*threads pairs (the block in use and the next one) """
+  return 2 * (2 * threads) + 2
+
+def compute_pair_shifts(imp, pairs, channel, process, background, z_min, z_max, cache, threads, shifts = None, pyramid = 1, projections = False, scores = None):
+  """ computes the shift of every frame pair on a pool of threads.
+  if imp has a roi, it is placed at the given (fixed) shifts of each frame.
+  frames are extracted in blocks, so only a few frames are held in memory at a time.
+  The confidence of every pair is appended to scores (if given).
+  """
+  roi = imp.getRoi()
+  pool = Executors.newFixedThreadPool(threads)
+  local_new_shifts = []
+  try:
+    block = 2 * threads
+    # the frames of a block are in use until all its futures are done
+    cache.reserve(pair_cache_size(threads))
+    for b in range(0, len(pairs), block):
+      futures = []
+      roi_shifts = []
+      for t1, t2 in pairs[b:b+block]:
+        roi1 = None
+        roi2 = None
+        if roi != None:
+          roi1 = shift_roi(imp, roi, shifts[t1])
+          roi2 = shift_roi(imp, roi, shifts[t2])
+          roi_shifts.append(shift_between_rois(roi2, roi1))
+        imp1 = cache.get(imp, t1+1, channel, process, background, roi1, z_min, z_max)
+        imp2 = cache.get(imp, t2+1, channel, process, background, roi2, z_min, z_max)
+        # if the pool already uses all cores, each correlation runs single-threaded
+        futures.append(pool.submit(StitchTask(imp2, imp1, 1 if threads > 1 else None, pyramid, projections)))
+      for i, future in enumerate(futures):
+        local_new_shift, score = future.get()
+        if scores is not None:
+          scores.append(score)
+        if roi != None: # total shift is shift of rois plus measured drift
+          local_new_shift = add_Point3f(local_new_shift, roi_shifts[i])
+        local_new_shifts.append(local_new_shift)
+      IJ.showProgress(1.0*(b+block)/(len(pairs)+1))
+  finally:
+    pool.shutdown()
+  return local_new_shifts
+
+def update_shifts_from_pairs(shifts, pairs, local_new_shifts, dt):
+  """ applies the measured shifts of all pairs at once.
+  Updating the pairs one after another (see compute_and_update_frame_translations_dt)
+  adds a linear ramp starting at t-dt for every pair, the ramps are summed up here
+  in a single pass (prefix sum of their slopes).
+  """
+  nt = len(shifts)
+  # change of the slope at the start of each pair
+  dslope = [Point3f(0,0,0) for tt in range(nt)]
+  prev_diff = Point3f(0,0,0)
+  for (t1, t2), local_new_shift in zip(pairs, local_new_shifts):
+    diff = subtract_Point3f(local_new_shift, subtract_Point3f(shifts[t2], shifts[t1]))
+    dslope[t1] = add_Point3f(dslope[t1], subtract_Point3f(diff, prev_diff))
+    prev_diff = diff
+  # sum up the ramps
+  slope = Point3f(0,0,0)
+  ramp = Point3f(0,0,0)
+  for tt in range(nt):
+    shifts[tt] = add_Point3f(shifts[tt], ramp)
+    slope = add_Point3f(slope, dslope[tt])
+    ramp.x += 1.0 * slope.x / dt
+    ramp.y += 1.0 * slope.y / dt
+    ramp.z += 1.0 * slope.z / dt
+  return shifts
+
+def compute_and_update_frame_translations_dt(imp, channel, dt, process, background, z_min, z_max, shifts = None, cache = None, threads = 1, pyramid = 1, projections = False):
   """ imp contains a hyper virtual stack, and we want to compute
   the X,Y,Z translation between every t and t+dt time points in it
   using the given preferred channel. 
   if shifts were already determined at other (lower) dt 
   they will be used and updated.
+  a FrameCache can be passed on to reuse processed frames across calls.
+  with threads > 1 and without a roi, the pairs are computed in parallel
+  and the shifts are updated afterwards.
+  with pyramid > 1 the shifts are estimated on downsampled images (see compute_stitch_pyramid),
+  with projections on maximum projections of z-stacks (see compute_stitch_projections).
   """
   nt = imp.getNFrames()
   # get roi (could be None)
@@ -215,6 +522,17 @@ def compute_and_update_frame_translations_dt(imp, channel, dt, process, backgrou
     shifts = []
     for t in range(nt):
       shifts.append(Point3f(0,0,0))
+  if cache == None:
+    cache = FrameCache()
+  # pairs are independent of the shifts if there is no roi
+  if threads > 1 and roi == None:
+    pairs = frame_pairs(nt, dt)
+    IJ.log("      between "+str(len(pairs))+" frame pairs on "+str(threads)+" threads")
+    IJ.showProgress(0)
+    local_new_shifts = compute_pair_shifts(imp, pairs, channel, process, background, z_min, z_max, cache, threads, None, pyramid, projections)
+    shifts = update_shifts_from_pairs(shifts, pairs, local_new_shifts, dt)
+    IJ.showProgress(1)
+    return shifts
   # compute shifts
   IJ.showProgress(0)
   for t in range(dt, nt+dt, dt):
@@ -223,15 +541,15 @@ def compute_and_update_frame_translations_dt(imp, channel, dt, process, backgrou
     IJ.log("      between frames "+str(t-dt+1)+" and "+str(t+1))      
     # get (cropped and processed) image at t-dt
     roi1 = shift_roi(imp, roi, shifts[t-dt])
-    imp1 = extract_frame_process_roi(imp, t+1-dt, channel, process, background, roi1, z_min, z_max)
+    imp1 = cache.get(imp, t+1-dt, channel, process, background, roi1, z_min, z_max)
     # get (cropped and processed) image at t-dt
     roi2 = shift_roi(imp, roi, shifts[t])
-    imp2 = extract_frame_process_roi(imp, t+1, channel, process, background, roi2, z_min, z_max)
+    imp2 = cache.get(imp, t+1, channel, process, background, roi2, z_min, z_max)
     #if roi:
     #  print "ROI at frame",t-dt+1,"is",roi1.getBounds()   
     #  print "ROI at frame",t+1,"is",roi2.getBounds()   
     # compute shift
-    local_new_shift = compute_stitch(imp2, imp1)
+    local_new_shift = compute_stitch(imp2, imp1, None, pyramid, projections)
     if roi: # total shift is shift of rois plus measured drift
       #print "correcting measured drift of",local_new_shift,"for roi shift:",shift_between_rois(roi2, roi1)
       local_new_shift = add_Point3f(local_new_shift, shift_between_rois(roi2, roi1))
@@ -256,6 +574,226 @@ def compute_and_update_frame_translations_dt(imp, channel, dt, process, backgrou
   return shifts
 
 
+def solve_positions(nt, pairs, local_shifts, weights, start):
+  """ weighted least-squares drift of all frames from the shifts measured between frame pairs,
+  i.e. minimizes the sum of w * (p[t2] - p[t1] - shift)^2 over all pairs with p[0] = 0.
+  The (sparse) normal equations are solved per axis with the preconditioned
+  conjugate gradient method, starting from the given shifts.
+  """
+  # normal equations as adjacency lists
+  diag = [0.0] * nt
+  neighbours = [[] for t in range(nt)]
+  for (t1, t2), w in zip(pairs, weights):
+    diag[t1] += w
+    diag[t2] += w
+    neighbours[t1].append((t2, w))
+    neighbours[t2].append((t1, w))
+
+  def apply(x):
+    y = [0.0] * nt
+    for t in range(1, nt):
+      v = diag[t] * x[t]
+      for u, w in neighbours[t]:
+        v -= w * x[u]
+      y[t] = v
+    return y
+
+  positions = [Point3f(0,0,0) for t in range(nt)]
+  for axis in ['x', 'y', 'z']:
+    b = [0.0] * nt
+    for (t1, t2), shift, w in zip(pairs, local_shifts, weights):
+      b[t2] += w * getattr(shift, axis)
+      b[t1] -= w * getattr(shift, axis)
+    b[0] = 0.0
+    x = [getattr(start[t], axis) - getattr(start[0], axis) for t in range(nt)]
+    ax = apply(x)
+    r = [b[t] - ax[t] for t in range(nt)]
+    z = [r[t] / diag[t] if t > 0 else 0.0 for t in range(nt)]
+    d = list(z)
+    rz = sum([r[t] * z[t] for t in range(nt)])
+    for i in range(2 * nt):
+      if rz < 1e-20:
+        break
+      ad = apply(d)
+      alpha = rz / sum([d[t] * ad[t] for t in range(nt)])
+      for t in range(1, nt):
+        x[t] += alpha * d[t]
+        r[t] -= alpha * ad[t]
+        z[t] = r[t] / diag[t]
+      rz_new = sum([r[t] * z[t] for t in range(nt)])
+      for t in range(1, nt):
+        d[t] = z[t] + rz_new / rz * d[t]
+      rz = rz_new
+    for t in range(nt):
+      setattr(positions[t], axis, x[t])
+  return positions
+
+def compute_frame_translations_global(imp, channel, process, background, z_min, z_max, shifts, cache = None, threads = 1, pyramid = 1, projections = False):
+  """ multi-time-scale drift with a single global solve.
+  The shifts between consecutive frames (from the dt=1 pass) and the shifts of all
+  frame pairs at the multi-time-scale frame shifts are collected once (in parallel)
+  and the drift of all frames is solved for with weighted least squares.
+  """
+  nt = imp.getNFrames()
+  if cache == None:
+    cache = FrameCache()
+  # measurements of the dt=1 pass
+  pairs = frame_pairs(nt, 1)
+  local_shifts = [subtract_Point3f(shifts[t2], shifts[t1]) for t1, t2 in pairs]
+  # sparse set of long-range pairs
+  long_pairs = []
+  for dt in multi_time_scales(nt):
+    for pair in frame_pairs(nt, dt):
+      if pair not in long_pairs and pair not in pairs:
+        long_pairs.append(pair)
+  IJ.log("    at "+str(len(long_pairs))+" long-range frame pairs")
+  local_shifts += compute_pair_shifts(imp, long_pairs, channel, process, background, z_min, z_max, cache, threads, shifts, pyramid, projections)
+  pairs += long_pairs
+  # all pairs are weighted equally
+  weights = [1.0] * len(pairs)
+  IJ.log("    solving for the drift of "+str(nt)+" frames")
+  return solve_positions(nt, pairs, local_shifts, weights, shifts)
+
+# confidence (see phase_correlation()) below which a frame pair is recomputed,
+# absolute and relative to the median confidence of all pairs
+CONFIDENCE_MIN = 0.3
+CONFIDENCE_RELATIVE = 0.5
+
+def low_confidence(scores):
+  """ indices of the scores below the confidence threshold, and the threshold """
+  median = sorted(scores)[len(scores)//2]
+  threshold = max(CONFIDENCE_MIN, CONFIDENCE_RELATIVE * median)
+  return [i for i, score in enumerate(scores) if score < threshold], threshold
+
+def overlap_correlation(imp1, imp2, shift):
+  """ normalized cross correlation of imp1 at x + shift and imp2 at x on (the central part of)
+  their overlap (see crop_overlap()), -1 if they do not overlap """
+  crop1, crop2 = crop_overlap(imp1, imp2, shift)
+  if crop1 == None:
+    return -1.0
+  def mean_product(p, q):
+    r = p.duplicate()
+    r.copyBits(q, 0, 0, Blitter.MULTIPLY)
+    return r.getStatistics().mean
+  n = crop1.getStackSize()
+  m1 = m2 = m11 = m22 = m12 = 0.0
+  for s in range(1, n+1):
+    a = crop1.getStack().getProcessor(s).convertToFloat()
+    b = crop2.getStack().getProcessor(s).convertToFloat()
+    m1 += a.getStatistics().mean / n
+    m2 += b.getStatistics().mean / n
+    m11 += mean_product(a, a) / n
+    m22 += mean_product(b, b) / n
+    m12 += mean_product(a, b) / n
+  den = math.sqrt(max(m11 - m1*m1, 0) * max(m22 - m2*m2, 0))
+  if den == 0:
+    return 0.0
+  return (m12 - m1*m2) / den
+
+def score_pair_shift(imp, pair, channel, process, background, z_min, z_max, cache, positions, shift):
+  """ confidence of the shift of a frame pair measured on the frames preprocessed as given:
+  the normalized cross correlation of their overlap at that shift (see overlap_correlation()).
+  if imp has a roi, it is placed at the positions of the frames, as in compute_pair_shifts().
+  """
+  t1, t2 = pair
+  roi = imp.getRoi()
+  roi1 = None
+  roi2 = None
+  if roi != None:
+    roi1 = shift_roi(imp, roi, positions[t1])
+    roi2 = shift_roi(imp, roi, positions[t2])
+    # the shift between the crops is the shift minus that of the rois
+    shift = subtract_Point3f(shift, shift_between_rois(roi2, roi1))
+  imp1 = cache.get(imp, t1+1, channel, process, background, roi1, z_min, z_max)
+  imp2 = cache.get(imp, t2+1, channel, process, background, roi2, z_min, z_max)
+  return overlap_correlation(imp2, imp1, Point3i(int(round(shift.x)), int(round(shift.y)), int(round(shift.z))))
+
+def compute_frame_translations_adaptive(imp, channel, process, background, z_min, z_max, cache = None, threads = 1, pyramid = 1, projections = False, confidence = None):
+  """ drift from the shifts between consecutive frames, each scored with its confidence.
+  Only the pairs of low confidence are measured again: with the other edge enhancement setting,
+  at another pyramid level and bridged over a neighbouring frame (dt=2, combined with the
+  shift of the neighbouring pair). All measurements of such a pair are scored on the frames
+  preprocessed as in the first pass (see score_pair_shift()), the one with the highest score is kept.
+  This replaces the multi-time-scale passes over all frames by a few targeted pairs.
+  The confidence of every frame (that of its pair with the previous frame, 1 for the first frame)
+  is appended to confidence (if given).
+  if imp has a roi, it follows the drift: the pairs are then measured one after another,
+  each with the roi at the shifts accumulated so far (as in compute_and_update_frame_translations_dt).
+  """
+  nt = imp.getNFrames()
+  if cache == None:
+    cache = FrameCache()
+  # pair i is between the frames i and i+1
+  pairs = [(t, t+1) for t in range(nt-1)]
+  positions = [Point3f(0,0,0) for t in range(nt)]
+  scores = []
+  if imp.getRoi() == None:
+    local_shifts = compute_pair_shifts(imp, pairs, channel, process, background, z_min, z_max, cache, threads, positions, pyramid, projections, scores)
+  else:
+    local_shifts = []
+    for t1, t2 in pairs:
+      # linear prediction of the next frame, for the position of its roi
+      positions[t2] = add_Point3f(positions[t1], local_shifts[-1] if local_shifts else Point3f(0,0,0))
+      local_shifts.extend(compute_pair_shifts(imp, [(t1, t2)], channel, process, background, z_min, z_max, cache, 1, positions, pyramid, projections, scores))
+      positions[t2] = add_Point3f(positions[t1], local_shifts[-1])
+  bad, threshold = low_confidence(scores)
+  IJ.log("    "+str(len(bad))+" of "+str(len(pairs))+" frame pairs below confidence "+str(round(threshold, 2)))
+  if bad:
+    # candidate shifts of every bad pair, including the first measurement
+    candidates = dict([(i, [local_shifts[i]]) for i in bad])
+    bad_pairs = [pairs[i] for i in bad]
+    other_shifts = compute_pair_shifts(imp, bad_pairs, channel, not process, background, z_min, z_max, cache, threads, positions, pyramid, projections)
+    for i, shift in zip(bad, other_shifts):
+      candidates[i].append(shift)
+    level = pyramid * 2
+    if min(imp.getWidth(), imp.getHeight()) / level < PYRAMID_MIN_SIZE:
+      level = pyramid // 2
+    if level >= 1:
+      other_shifts = compute_pair_shifts(imp, bad_pairs, channel, process, background, z_min, z_max, cache, threads, positions, level, projections)
+      for i, shift in zip(bad, other_shifts):
+        candidates[i].append(shift)
+    # bridges (t-1, t+1) and (t, t+2) of the pair (t, t+1) = i
+    bridges = []
+    for i in bad:
+      if i > 0:
+        bridges.append((i, i-1, (i-1, i+1)))
+      if i+2 < nt:
+        bridges.append((i, i+1, (i, i+2)))
+    bridge_shifts = compute_pair_shifts(imp, [pair for i, j, pair in bridges], channel, process, background, z_min, z_max, cache, threads, positions, pyramid, projections)
+    for (i, j, pair), shift in zip(bridges, bridge_shifts):
+      # the shift over the bridge minus that of the neighbouring pair j
+      candidates[i].append(subtract_Point3f(shift, local_shifts[j]))
+    for i in bad:
+      # scores of the first pass are not comparable to those of other preprocessing or levels
+      best = None
+      for shift in candidates[i]:
+        score = score_pair_shift(imp, pairs[i], channel, process, background, z_min, z_max, cache, positions, shift)
+        if best == None or score > best:
+          local_shifts[i] = shift
+          best = score
+      scores[i] = best
+      IJ.log("      between frames "+str(i+1)+" and "+str(i+2)+" confidence "+str(round(scores[i], 2)))
+  if confidence is not None:
+    confidence.extend([1.0] + scores)
+  shifts = [Point3f(0,0,0) for t in range(nt)]
+  return update_shifts_from_pairs(shifts, pairs, local_shifts, 1)
+
+def multi_time_scales(nt):
+  """ frame shifts of the multi-time-scale computation
+  """
+  dt_max = nt-1
+  # computing drifts on exponentially increasing time scales 3^i up to 3^6
+  # ..one could also do this with 2^i or 4^i
+  # ..maybe make this a user choice? did not do this to keep it simple.
+  dts = []
+  for dt in [3,9,27,81,243,729,dt_max]:
+    if dt < dt_max:
+      dts.append(dt)
+    else:
+      dts.append(dt_max)
+      break
+  return dts
+
 def convert_shifts_to_integer(shifts):
   int_shifts = []
   for shift in shifts: 
@@ -298,25 +836,427 @@ def invert_shifts(shifts):
   return shifts
 
 
-def register_hyperstack(imp, channel, shifts, target_folder, virtual):
-  """ Takes the imp, determines the x,y,z drift for each pair of time points, using the preferred given channel,
-  and outputs as a hyperstack."""
+def hyperstack_from(imp, stack, slices, order):
+  """ wraps the registered slices into a hyperstack with the calibration of imp """
+  registeredstack_imp = ImagePlus("registered time points", stack)
+  registeredstack_imp.setCalibration(imp.getCalibration().copy())
+  registeredstack_imp.setProperty("Info", imp.getProperty("Info"))
+  return HyperStackConverter.toHyperStack(registeredstack_imp, imp.getNChannels(), slices, imp.getNFrames(), order, "Composite")
+
+class StackOutput(object):
+  """ keeps the registered slices in RAM """
+  def __init__(self, imp, width, height):
+    self.imp = imp
+    self.stack = ImageStack(width, height, imp.getProcessor().getColorModel())
+
+  def add_slice(self, name, ip):
+    self.stack.addSlice(str(name), ip)
+
+  def add_padding(self, name, ip):
+    # all padding slices share the pixels of the same empty processor
+    self.stack.addSlice(str(name), ip)
+
+  def get_imp(self, slices, order):
+    return hyperstack_from(self.imp, self.stack, slices, order)
+
+class TiffSequenceOutput(object):
+  """ saves every registered slice as TIFF file into target_folder
+  and returns them as virtual stack """
+  def __init__(self, imp, width, height, target_folder):
+    self.imp = imp
+    self.width = width
+    self.height = height
+    self.target_folder = target_folder
+    self.names = []
+    self.padding = None
+
+  def add_slice(self, name, ip):
+    self.names.append(name)
+    currentslice = ImagePlus("", ip)
+    currentslice.setCalibration(self.imp.getCalibration().copy())
+    currentslice.setProperty("Info", self.imp.getProperty("Info"))
+    FileSaver(currentslice).saveAsTiff(self.target_folder + "/" + name)
+
+  def add_padding(self, name, ip):
+    """ the empty slice is only saved once, all padding slices of the virtual stack refer to it """
+    if self.padding is None:
+      self.padding = "empty.tif"
+      FileSaver(ImagePlus("", ip)).saveAsTiff(self.target_folder + "/" + self.padding)
+    self.names.append(self.padding)
+
+  def get_imp(self, slices, order):
+    # Create virtual hyper stack
+    registeredstack = VirtualStack(self.width, self.height, None, self.target_folder)
+    for name in self.names:
+      registeredstack.addSlice(name)
+    return hyperstack_from(self.imp, registeredstack, slices, order)
+
+class OMETiffOutput(object):
+  """ streams the registered slices into a single (Big)OME-TIFF file.
+  Only one plane is held in memory at a time and the metadata (dimensions,
+  calibration and Info) is written once. The slices have to be added in the
+  given order (e.g. "xyczt"), get_imp() opens the file as virtual stack.
+  """
+  def __init__(self, imp, width, height, slices, order, path):
+    self.imp = imp
+    self.path = path
+    self.index = 0
+    pixel_types = {8: FormatTools.UINT8, 16: FormatTools.UINT16, 32: FormatTools.FLOAT}
+    meta = MetadataTools.createOMEXMLMetadata()
+    MetadataTools.populateMetadata(meta, 0, imp.getTitle(), False, order.upper(),
+      FormatTools.getPixelTypeString(pixel_types[imp.getBitDepth()]),
+      width, height, slices, imp.getNChannels(), imp.getNFrames(), 1)
+    cal = imp.getCalibration()
+    if cal.scaled():
+      meta.setPixelsPhysicalSizeX(FormatTools.getPhysicalSizeX(cal.pixelWidth), 0)
+      meta.setPixelsPhysicalSizeY(FormatTools.getPhysicalSizeY(cal.pixelHeight), 0)
+      meta.setPixelsPhysicalSizeZ(FormatTools.getPhysicalSizeZ(cal.pixelDepth), 0)
+    if imp.getProperty("Info") != None:
+      meta.setImageDescription(imp.getProperty("Info"), 0)
+    self.writer = OMETiffWriter()
+    self.writer.setMetadataRetrieve(meta)
+    self.writer.setBigTiff(True)
+    self.writer.setWriteSequentially(True)
+    self.writer.setId(path)
+    self.padding = None
+
+  def plane_bytes(self, ip):
+    return plane_bytes(ip)
+
+  def add_slice(self, name, ip):
+    self.writer.saveBytes(self.index, self.plane_bytes(ip))
+    self.index += 1
+
+  def add_padding(self, name, ip):
+    # every plane is written, but the empty one is only converted once
+    if self.padding is None:
+      self.padding = self.plane_bytes(ip)
+    self.writer.saveBytes(self.index, self.padding)
+    self.index += 1
+
+  def get_imp(self, slices, order):
+    self.writer.close()
+    registeredstack_imp = open_ome_tiff(self.path)
+    registeredstack_imp.setTitle("registered time points")
+    registeredstack_imp.setProperty("Info", self.imp.getProperty("Info"))
+    return registeredstack_imp
+
+def plane_bytes(ip):
+  """ the pixels of ip as bytes (big-endian) for the Bio-Formats writers """
+  pixels = ip.getPixels()
+  if ip.getBitDepth() == 16:
+    pixels = DataTools.shortsToBytes(pixels, False)
+  elif ip.getBitDepth() == 32:
+    pixels = DataTools.floatsToBytes(pixels, False)
+  return pixels
+
+def open_ome_tiff(path):
+  """ opens a (Big)OME-TIFF file written by OMETiffOutput as virtual hyperstack """
+  options = ImporterOptions()
+  options.setId(path)
+  options.setVirtual(True)
+  options.setColorMode(ImporterOptions.COLOR_MODE_COMPOSITE)
+  return BF.openImagePlus(options)[0]
+
+def create_output(imp, width, height, slices, order, target_folder, virtual, single_file = False):
+  """ returns the output backend for the registered slices """
+  if virtual is not True:
+    return StackOutput(imp, width, height)
+  if single_file is True and imp.getBitDepth() != 24:
+    return OMETiffOutput(imp, width, height, slices, order, os.path.join(target_folder, "registered.ome.tif"))
+  if single_file is True:
+    IJ.log("    RGB images can not be saved as OME-TIFF, saving one file per slice")
+  return TiffSequenceOutput(imp, width, height, target_folder)
+
+def common_field(imp, shifts):
+  """ returns the width, height and number of slices of the field of view
+  that is covered by all frames. Expects absolute shifts. """
+  minx, miny, minz, maxx, maxy, maxz = compute_min_max(shifts)
+  return imp.width - (maxx - minx), imp.height - (maxy - miny), imp.getNSlices() - (maxz - minz)
+
+def registered_canvas(imp, shifts, crop):
+  """ returns whether the canvas is cropped, the offset of the canvas (subtracted from the shifts)
+  and its width, height and number of slices. With crop the canvas is the field of view
+  that is covered by all frames, otherwise it grows to contain all frames. Expects absolute shifts. """
   # Compute bounds of the new volume,
   # which accounts for all translations:
   minx, miny, minz, maxx, maxy, maxz = compute_min_max(shifts)
-  # Make shifts relative to new canvas dimensions
-  # so that the min values become 0,0,0
-  for shift in shifts:
-    shift.x -= minx
-    shift.y -= miny
-    shift.z -= minz
-  #print "shifts relative to new dimensions:"
-  #for s in shifts:
-  #  print s.x, s.y, s.z
-  # new canvas dimensions:r
+  if crop and min(common_field(imp, shifts)) < 1:
+    IJ.log("    the frames have no common field of view, the canvas is not cropped")
+    crop = False
+  if crop:
+    # the max values become 0,0,0 and the new canvas is the common field of view
+    width, height, slices = common_field(imp, shifts)
+    return crop, maxx, maxy, maxz, width, height, slices
+  # the min values become 0,0,0 and the new canvas contains all frames
   width = imp.width + maxx - minx
   height = maxy - miny + imp.height
   slices = maxz - minz + imp.getNSlices()
+  return crop, minx, miny, minz, width, height, slices
+
+class TranslatedStack(VirtualStack):
+  """ virtual stack (order xyczt) that translates the planes of imp by the shifts only
+  when a plane is requested, so the registered movie is never copied in RAM or on disk.
+  The shifts are relative to the canvas, sub-pixel shifts are interpolated linearly.
+  imp must stay open as long as the view is used. """
+  def __init__(self, imp, shifts, width, height, slices, subpixel):
+    VirtualStack.__init__(self, width, height, imp.getProcessor().getColorModel(), None)
+    self.setBitDepth(imp.getBitDepth())
+    self.imp = imp
+    self.source = imp.getStack()
+    self.shifts = shifts
+    self.slices = slices
+    self.subpixel = subpixel
+
+  def getSize(self):
+    return self.imp.getNChannels() * self.slices * self.imp.getNFrames()
+
+  def getSliceLabel(self, n):
+    return None
+
+  def plane(self, ch, s, frame):
+    """ source plane or None outside of the stack """
+    if s < 1 or s > self.imp.getNSlices():
+      return None
+    return self.source.getProcessor(self.imp.getStackIndex(ch, s, frame))
+
+  def getProcessor(self, n):
+    nc = self.imp.getNChannels()
+    ch = (n-1) % nc + 1
+    s = (n-1) // nc % self.slices + 1
+    frame = (n-1) // (nc * self.slices) + 1
+    shift = self.shifts[frame-1]
+    if not self.subpixel:
+      src = self.plane(ch, s - int(shift.z), frame)
+      if src is not None:
+        return translate_plane(src, self.getWidth(), self.getHeight(), int(shift.x), int(shift.y))
+      return self.source.getProcessor(1).createProcessor(self.getWidth(), self.getHeight())
+    ip = self.source.getProcessor(1).createProcessor(self.getWidth(), self.getHeight())
+
+    # linear interpolation between the two nearest planes in z, bilinear in x and y;
+    # the canvas has a margin of one pixel on the top left for pixels pulled in by the translation
+    sz = s - shift.z
+    z0 = int(math.floor(sz))
+    x0 = int(math.floor(shift.x))
+    y0 = int(math.floor(shift.y))
+    for c in range(ip.getNChannels()):
+      acc = FloatProcessor(self.getWidth() + 1, self.getHeight() + 1)
+      for z, weight in ((z0, 1 - (sz - z0)), (z0 + 1, sz - z0)):
+        src = self.plane(ch, z, frame)
+        if src is None or weight < 1e-6:
+          continue
+        fp = FloatProcessor(self.getWidth() + 1, self.getHeight() + 1)
+        fp.insert(src.toFloat(c, None), x0 + 1, y0 + 1)
+        fp.setInterpolationMethod(ImageProcessor.BILINEAR)
+        fp.translate(shift.x - x0, shift.y - y0)
+        fp.multiply(weight)
+        acc.copyBits(fp, 0, 0, Blitter.ADD)
+      acc.setRoi(1, 1, self.getWidth(), self.getHeight())
+      ip.setPixels(c, acc.crop())
+    return ip
+
+def translated_view(imp, shifts, subpixel = False, crop = False):
+  """ returns the registered hyperstack as a lazy view on imp (see TranslatedStack).
+  Expects absolute correction shifts (integer unless subpixel). """
+  crop, offx, offy, offz, width, height, slices = registered_canvas(imp, shifts, crop)
+  width, height, slices = int(math.floor(width)), int(math.floor(height)), int(math.floor(slices))
+  relative = [Point3f(shift.x - offx, shift.y - offy, shift.z - offz) for shift in shifts]
+  stack = TranslatedStack(imp, relative, width, height, slices, subpixel)
+  return hyperstack_from(imp, stack, slices, "xyczt")
+
+class ChannelStack(VirtualStack):
+  """ virtual stack (order xyzt) of one channel of imp, cropped to rect (a Rectangle, optional).
+  The planes are read from imp (e.g. a virtual stack or a TranslatedStack) only when requested,
+  or handed over by a ChannelPlanes, so saving it with FileSaver streams the channel plane by plane. """
+  def __init__(self, imp, channel, rect = None, planes = None):
+    if rect is None:
+      rect = Rectangle(0, 0, imp.getWidth(), imp.getHeight())
+    VirtualStack.__init__(self, rect.width, rect.height, imp.getProcessor().getColorModel(), None)
+    self.setBitDepth(imp.getBitDepth())
+    self.imp = imp
+    self.source = imp.getStack()
+    self.channel = channel
+    self.rect = rect
+    self.planes = planes
+
+  def getSize(self):
+    return self.imp.getNSlices() * self.imp.getNFrames()
+
+  def getSliceLabel(self, n):
+    return None
+
+  def getProcessor(self, n):
+    if self.planes is not None:
+      ip = self.planes.get(self.channel, n)
+    else:
+      nz = self.imp.getNSlices()
+      ip = self.source.getProcessor(self.imp.getStackIndex(self.channel, (n-1) % nz + 1, (n-1) // nz + 1))
+    if self.rect.width != ip.getWidth() or self.rect.height != ip.getHeight():
+      ip.setRoi(self.rect)
+      ip = ip.crop()
+    return ip
+
+def channel_view(imp, channel, rect = None, planes = None):
+  """ returns one channel of imp as a lazy hyperstack (see ChannelStack) """
+  view = ImagePlus(imp.getTitle(), ChannelStack(imp, channel, rect, planes))
+  view.setDimensions(1, imp.getNSlices(), imp.getNFrames())
+  view.setOpenAsHyperStack(True)
+  view.setCalibration(imp.getCalibration().copy())
+  view.setProperty("Info", imp.getProperty("Info"))
+  return view
+
+class ChannelPlanes(object):
+  """ reads the planes of the first channels of imp at one slice and frame together and hands
+  them to the ChannelStacks of these channels, which are saved at the same time (save_channels()).
+  The planes of the next slice or frame are read once every channel asked for them (or is done),
+  so every plane of imp is read once and only the planes of one slice and frame are held.
+  Planes that are asked for again later are read again. """
+  def __init__(self, imp, channels):
+    self.imp = imp
+    self.source = imp.getStack()
+    self.channels = channels
+    self.index = 0 # slice and frame (plane of a ChannelStack) of the held planes
+    self.planes = []
+    self.requested = [0] * channels # last plane asked for by every channel
+    self.finished = [False] * channels
+    self.condition = threading.Condition()
+
+  def read(self, channel, n):
+    nz = self.imp.getNSlices()
+    return self.source.getProcessor(self.imp.getStackIndex(channel, (n-1) % nz + 1, (n-1) // nz + 1))
+
+  def get(self, channel, n):
+    self.condition.acquire()
+    try:
+      self.requested[channel-1] = n
+      self.condition.notifyAll()
+      while n > self.index:
+        if self.index == 0 or all([r > self.index or f for r, f in zip(self.requested, self.finished)]):
+          self.index = n
+          self.planes = [self.read(c, n) for c in range(1, self.channels+1)]
+          self.condition.notifyAll()
+        else:
+          self.condition.wait()
+      if n == self.index:
+        return self.planes[channel-1]
+      return self.read(channel, n)
+    finally:
+      self.condition.release()
+
+  def done(self, channel):
+    self.condition.acquire()
+    try:
+      self.finished[channel-1] = True
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+
+TIFF_COMPRESSIONS = {"LZW": TiffWriter.COMPRESSION_LZW, "Deflate": TiffWriter.COMPRESSION_ZLIB}
+
+def save_compressed(imp, path, compression):
+  """ saves imp (one channel, e.g. a channel_view) plane by plane as TIFF file compressed
+  with "LZW" or "Deflate" (lossless, read by ImageJ), with the dimensions and calibration of imp.
+  Returns whether the file was saved. """
+  pixel_types = {8: FormatTools.UINT8, 16: FormatTools.UINT16, 32: FormatTools.FLOAT}
+  meta = MetadataTools.createOMEXMLMetadata()
+  MetadataTools.populateMetadata(meta, 0, imp.getTitle(), False, "XYCZT",
+    FormatTools.getPixelTypeString(pixel_types[imp.getBitDepth()]),
+    imp.getWidth(), imp.getHeight(), imp.getNSlices(), 1, imp.getNFrames(), 1)
+  cal = imp.getCalibration()
+  if cal.scaled():
+    meta.setPixelsPhysicalSizeX(FormatTools.getPhysicalSizeX(cal.pixelWidth), 0)
+    meta.setPixelsPhysicalSizeY(FormatTools.getPhysicalSizeY(cal.pixelHeight), 0)
+    meta.setPixelsPhysicalSizeZ(FormatTools.getPhysicalSizeZ(cal.pixelDepth), 0)
+  if os.path.exists(path):
+    os.remove(path) # the writer appends to existing files
+  writer = TiffWriter()
+  writer.setMetadataRetrieve(meta)
+  writer.setCompression(TIFF_COMPRESSIONS[compression])
+  writer.setWriteSequentially(True)
+  writer.setId(path)
+  try:
+    stack = imp.getStack()
+    for n in range(stack.getSize()):
+      writer.saveBytes(n, plane_bytes(stack.getProcessor(n+1)))
+  finally:
+    writer.close()
+  return True
+
+def save_channels(imp, paths, rect = None, compression = None):
+  """ saves the channels of imp (as many as paths) as TIFF files in one pass over imp,
+  cropped to rect (a Rectangle, optional). Every channel is saved by FileSaver from a
+  ChannelStack in a thread of its own, fed with the planes that are read once by a ChannelPlanes,
+  so no channel is copied. With compression ("LZW" or "Deflate", see save_compressed()) the
+  planes are compressed in the thread of their channel, so the channels are encoded concurrently.
+  Returns whether all files were saved. """
+  if compression == "none" or imp.getBitDepth() == 24:
+    compression = None
+  planes = ChannelPlanes(imp, len(paths))
+  views = [channel_view(imp, c+1, rect, planes) for c in range(len(paths))]
+  saved = [False] * len(paths)
+  def save(c):
+    try:
+      if compression is not None:
+        saved[c] = save_compressed(views[c], paths[c], compression)
+      else:
+        saved[c] = FileSaver(views[c]).saveAsTiff(paths[c])
+    finally:
+      planes.done(c+1)
+  threads = [threading.Thread(target=save, args=(c,)) for c in range(len(paths))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return all(saved)
+
+def budget_threads(imp, z_min, z_max, threads, budget):
+  """ the number of threads (at most threads) whose frames fit into budget (bytes):
+  the preprocessed frames compute_pair_shifts() reserves in the FrameCache (see pair_cache_size(),
+  the cache does not shrink) and the float and complex copies of both frames of every pair
+  being correlated (about 24 bytes per voxel). """
+  voxels = imp.getWidth() * imp.getHeight() * (int(z_max) - int(z_min) + 1)
+  frame = voxels * max(1, imp.getBitDepth() // 8)
+  for t in range(threads, 1, -1):
+    if max(FRAME_CACHE_SIZE, pair_cache_size(t)) * frame + t * 2 * voxels * 24 <= budget:
+      return t
+  return 1
+
+def translate_plane(ip, width, height, dx, dy, out = None):
+  """ copies ip at the integer offset dx, dy into a zero-filled plane of width x height
+  (clipped like insert), as slabs of whole rows (one copy for full rows) or row by row.
+  out (a processor of that size and type) is overwritten instead of allocating a new plane. """
+  if out is None:
+    out = ip.createProcessor(width, height)
+  else:
+    out.setValue(0)
+    out.fill()
+  w, h = ip.getWidth(), ip.getHeight()
+  x0, x1 = max(0, dx), min(width, w + dx)
+  y0, y1 = max(0, dy), min(height, h + dy)
+  if x1 <= x0 or y1 <= y0:
+    return out
+  src = ip.getPixels()
+  dst = out.getPixels()
+  if x0 - dx == 0 and x1 - x0 == w == width:
+    System.arraycopy(src, (y0 - dy) * w, dst, y0 * width, (y1 - y0) * w)
+  else:
+    for y in range(y0, y1):
+      System.arraycopy(src, (y - dy) * w + x0 - dx, dst, y * width + x0, x1 - x0)
+  return out
+
+def register_hyperstack(imp, channel, shifts, target_folder, virtual, single_file = False, crop = False):
+  """ Takes the imp, determines the x,y,z drift for each pair of time points, using the preferred given channel,
+  and outputs as a hyperstack.
+  With crop the output only contains the field of view that is covered by all frames,
+  otherwise the canvas grows to contain all frames.
+  Every plane is copied once, straight into its output plane (in RAM) or into a single buffer
+  that is saved right away (virtual). The empty padding slice is created once and referenced."""
+  crop, offx, offy, offz, width, height, slices = registered_canvas(imp, shifts, crop)
+  # Make shifts relative to new canvas dimensions
+  for shift in shifts:
+    shift.x -= offx
+    shift.y -= offy
+    shift.z -= offz
 
   print "New dimensions:", width, height, slices
   # Prepare empty slice to pad in Z when necessary
@@ -326,19 +1266,17 @@ def register_hyperstack(imp, channel, shifts, target_folder, virtual):
   if isinstance(empty, ColorProcessor):
     empty.setValue(0)
     empty.fill()
-  # Write all slices to files:
+  # Write all slices to the output:
   stack = imp.getStack()
+  output = create_output(imp, width, height, slices, "xyczt", target_folder, virtual, single_file)
+  # the virtual outputs save a slice before the next one is added
+  buffer = None
 
-  if virtual is False:
-  	registeredstack = ImageStack(width, height, imp.getProcessor().getColorModel())
-  names = []
-  
   for frame in range(1, imp.getNFrames()+1):
  
     shift = shifts[frame-1]
     
-    #print "frame",frame,"correcting drift",-shift.x-minx,-shift.y-miny,-shift.z-minz
-    IJ.log("    frame "+str(frame)+" correcting drift "+str(-shift.x-minx)+","+str(-shift.y-miny)+","+str(-shift.z-minz))
+    IJ.log("    frame "+str(frame)+" correcting drift "+str(-shift.x-offx)+","+str(-shift.y-offy)+","+str(-shift.z-offz))
     
     fr = "t" + zero_pad(frame, len(str(imp.getNFrames())))
     # Pad with empty slices before reaching the first slice
@@ -346,98 +1284,60 @@ def register_hyperstack(imp, channel, shifts, target_folder, virtual):
       ss = "_z" + zero_pad(s + 1, len(str(slices))) # slices start at 1
       for ch in range(1, imp.getNChannels()+1):
         name = fr + ss + "_c" + zero_pad(ch, len(str(imp.getNChannels()))) +".tif"
-        names.append(name)
-
-        if virtual is True:
-          currentslice = ImagePlus("", empty)
-          currentslice.setCalibration(imp.getCalibration().copy())
-          currentslice.setProperty("Info", imp.getProperty("Info"))
-          FileSaver(currentslice).saveAsTiff(target_folder + "/" + name)
-        else:
-          empty = imp.getProcessor().createProcessor(width, height)
-          registeredstack.addSlice(str(name), empty)
-    
+        output.add_padding(name, empty)
     
     # Add all proper slices
-    stack = imp.getStack()
     for s in range(1, imp.getNSlices()+1):
+      if s + shift.z < 1 or s + shift.z > slices: # outside of the cropped canvas
+        continue
       ss = "_z" + zero_pad(s + shift.z, len(str(slices)))
       for ch in range(1, imp.getNChannels()+1):
-         ip = stack.getProcessor(imp.getStackIndex(ch, s, frame))
-         ip2 = ip.createProcessor(width, height) # potentially larger
-         ip2.insert(ip, shift.x, shift.y)
-         name = fr + ss + "_c" + zero_pad(ch, len(str(imp.getNChannels()))) +".tif"
-         names.append(name)
-
-         if virtual is True:
-           currentslice = ImagePlus("", ip2)
-           currentslice.setCalibration(imp.getCalibration().copy())
-           currentslice.setProperty("Info", imp.getProperty("Info"));
-           FileSaver(currentslice).saveAsTiff(target_folder + "/" + name)
-         else:
-           registeredstack.addSlice(str(name), ip2)
+        ip = stack.getProcessor(imp.getStackIndex(ch, s, frame))
+        if virtual is True:
+          ip2 = buffer = translate_plane(ip, width, height, shift.x, shift.y, buffer)
+        else:
+          ip2 = translate_plane(ip, width, height, shift.x, shift.y)
+        name = fr + ss + "_c" + zero_pad(ch, len(str(imp.getNChannels()))) +".tif"
+        output.add_slice(name, ip2)
 
     # Pad the end
     for s in range(shift.z + imp.getNSlices(), slices):
       ss = "_z" + zero_pad(s + 1, len(str(slices)))
       for ch in range(1, imp.getNChannels()+1):
         name = fr + ss + "_c" + zero_pad(ch, len(str(imp.getNChannels()))) +".tif"
-        names.append(name)
-
-        if virtual is True:
-          currentslice = ImagePlus("", empty)
-          currentslice.setCalibration(imp.getCalibration().copy())
-          currentslice.setProperty("Info", imp.getProperty("Info"))
-          FileSaver(currentslice).saveAsTiff(target_folder + "/" + name)
-        else:
-          registeredstack.addSlice(str(name), empty)
+        output.add_padding(name, empty)
  
-  if virtual is True:
-    # Create virtual hyper stack
-    registeredstack = VirtualStack(width, height, None, target_folder)
-    for name in names:
-      registeredstack.addSlice(name)
-  
-  registeredstack_imp = ImagePlus("registered time points", registeredstack)
-  registeredstack_imp.setCalibration(imp.getCalibration().copy())
-  registeredstack_imp.setProperty("Info", imp.getProperty("Info"))
-  registeredstack_imp = HyperStackConverter.toHyperStack(registeredstack_imp, imp.getNChannels(), len(names) / (imp.getNChannels() * imp.getNFrames()), imp.getNFrames(), "xyczt", "Composite");    
-  
-  return registeredstack_imp
+  return output.get_imp(slices, "xyczt")
 
   
-def register_hyperstack_subpixel(imp, channel, shifts, target_folder, virtual):
+def register_hyperstack_subpixel(imp, channel, shifts, target_folder, virtual, single_file = False, crop = False):
   """ Takes the imp, determines the x,y,z drift for each pair of time points, using the preferred given channel,
   and outputs as a hyperstack.
   The shifted image is computed using TransformJ allowing for sub-pixel shifts using interpolation.
   This is quite a bit slower than just shifting the image by full pixels as done in above function register_hyperstack().
   However it significantly improves the result by removing pixel jitter.
+  With crop the output only contains the field of view that is covered by all frames.
   """
-  # Compute bounds of the new volume,
-  # which accounts for all translations:
-  minx, miny, minz, maxx, maxy, maxz = compute_min_max(shifts)
+  crop, offx, offy, offz, width, height, slices = registered_canvas(imp, shifts, crop)
+  width, height, slices = int(math.floor(width)), int(math.floor(height)), int(math.floor(slices))
+  if crop:
+    # frames are translated on a canvas of their own size and cropped afterwards
+    canvas_width, canvas_height, canvas_slices = imp.width, imp.height, imp.getNSlices()
+  else:
+    canvas_width, canvas_height, canvas_slices = width, height, slices
   # Make shifts relative to new canvas dimensions
-  # so that the min values become 0,0,0
   for shift in shifts:
-    shift.x -= minx
-    shift.y -= miny
-    shift.z -= minz
-  # new canvas dimensions:
-  width = int(imp.width + maxx - minx)
-  height = int(maxy - miny + imp.height)
-  slices = int(maxz - minz + imp.getNSlices())
+    shift.x -= offx
+    shift.y -= offy
+    shift.z -= offz
 
   #print "New dimensions:", width, height, slices
     
-  # prepare stack for final results
-  stack = imp.getStack()
-  if virtual is True: 
-    names = []
-  else:
-    registeredstack = ImageStack(width, height, imp.getProcessor().getColorModel())
+  # prepare output for final results
+  output = create_output(imp, width, height, slices, "xyzct", target_folder, virtual, single_file)
   
   # prepare empty slice for padding
-  empty = imp.getProcessor().createProcessor(width, height)
+  empty = imp.getProcessor().createProcessor(canvas_width, canvas_height)
 
   IJ.showProgress(0)
 
@@ -453,22 +1353,22 @@ def register_hyperstack_subpixel(imp, channel, shifts, target_folder, virtual):
     # get and report current shift
     shift = shifts[frame-1]
     #print "frame",frame,"correcting drift",-shift.x-minx,-shift.y-miny,-shift.z-minz
-    IJ.log("    frame "+str(frame)+" correcting drift "+str(round(-shift.x-minx,2))+","+str(round(-shift.y-miny,2))+","+str(round(-shift.z-minz,2)))
+    IJ.log("    frame "+str(frame)+" correcting drift "+str(round(-shift.x-offx,2))+","+str(round(-shift.y-offy,2))+","+str(round(-shift.z-offz,2)))
 
     # loop across channels
     for ch in range(1, imp.getNChannels()+1):      
       
-      tmpstack = ImageStack(width, height, imp.getProcessor().getColorModel())
+      tmpstack = ImageStack(canvas_width, canvas_height, imp.getProcessor().getColorModel())
 
       # get all slices of this channel and frame
       for s in range(1, imp.getNSlices()+1):
         ip = stack.getProcessor(imp.getStackIndex(ch, s, frame))
-        ip2 = ip.createProcessor(width, height) # potentially larger
+        ip2 = ip.createProcessor(canvas_width, canvas_height) # potentially larger
         ip2.insert(ip, 0, 0)
         tmpstack.addSlice("", ip2)
 
       # Pad the end (in z) of this channel and frame
-      for s in range(imp.getNSlices(), slices):
+      for s in range(imp.getNSlices(), canvas_slices):
         tmpstack.addSlice("", empty)
 
       # subpixel translation
@@ -477,33 +1377,20 @@ def register_hyperstack_subpixel(imp, channel, shifts, target_folder, virtual):
       
       # add translated stack to final time-series
       translated_stack = imp_translated.getStack()
-      for s in range(1, translated_stack.getSize()+1):
+      for s in range(1, slices+1):
         ss = "_z" + zero_pad(s, len(str(slices)))
-        ip = translated_stack.getProcessor(s).duplicate() # duplicate is important as otherwise it will only be a reference that can change its content  
-        if virtual is True:
-          name = fr + ss + "_c" + zero_pad(ch, len(str(imp.getNChannels()))) +".tif"
-          names.append(name)
-          currentslice = ImagePlus("", ip)
-          currentslice.setCalibration(imp.getCalibration().copy())
-          currentslice.setProperty("Info", imp.getProperty("Info"));
-          FileSaver(currentslice).saveAsTiff(target_folder + "/" + name)
+        ip = translated_stack.getProcessor(s)
+        if crop:
+          ip.setRoi(0, 0, width, height)
+          ip = ip.crop()
         else:
-          registeredstack.addSlice("", ip)    
+          ip = ip.duplicate() # duplicate is important as otherwise it will only be a reference that can change its content  
+        name = fr + ss + "_c" + zero_pad(ch, len(str(imp.getNChannels()))) +".tif"
+        output.add_slice(name, ip)
 
   IJ.showProgress(1)
-    
-  if virtual is True:
-    # Create virtual hyper stack
-    registeredstack = VirtualStack(width, height, None, target_folder)
-    for name in names:
-      registeredstack.addSlice(name)
   
-  registeredstack_imp = ImagePlus("registered time points", registeredstack)
-  registeredstack_imp.setCalibration(imp.getCalibration().copy())
-  registeredstack_imp.setProperty("Info", imp.getProperty("Info"))
-  registeredstack_imp = HyperStackConverter.toHyperStack(registeredstack_imp, imp.getNChannels(), slices, imp.getNFrames(), "xyzct", "Composite");    
-  
-  return registeredstack_imp
+  return output.get_imp(slices, "xyzct")
   
 
 class Filter(FilenameFilter):
@@ -520,7 +1407,10 @@ def validate(target_folder):
       return False
   return True
 
-def autoOptions(imp):
+def autoOptions(imp, fast = False):
+  """ the default options (as the defaults of getOptions()). With fast (opt-in) the frame pairs
+  are measured on all processors, large frames (from 1024 pixels) with pyramid 4, and the
+  registered image only keeps the field of view of all frames. """
 
   channel = 1
   multi_time_scale = False
@@ -531,7 +1421,20 @@ def autoOptions(imp):
   z_max = 1
   virtual = False
   only_compute = False
-  return channel, virtual, multi_time_scale, subpixel, process, background, z_min, z_max, only_compute
+  threads = 1
+  global_solve = False
+  single_file = False
+  crop = False
+  lazy = False
+  projections = False
+  adaptive = False
+  pyramid = 1
+  if fast:
+    threads = Runtime.getRuntime().availableProcessors()
+    crop = True
+    if min(imp.getWidth(), imp.getHeight()) >= 1024:
+      pyramid = 4
+  return channel, virtual, multi_time_scale, subpixel, process, background, z_min, z_max, only_compute, threads, global_solve, pyramid, single_file, crop, lazy, projections, adaptive
 
 
 def getOptions(imp):
@@ -541,69 +1444,692 @@ def getOptions(imp):
     channels.append(str(ch))
   gd.addChoice("Channel for registration:", channels, channels[0])
   gd.addCheckbox("Multi_time_scale computation for enhanced detection of slow drifts?", False)
+  gd.addCheckbox("Global_solve of the multi time scale drifts (least squares over all frame pairs)?", False)
+  gd.addCheckbox("Adaptive: only recompute frame pairs of low confidence (instead of multi time scale)?", False)
   gd.addCheckbox("Sub_pixel drift correction (possibly needed for slow drifts)?", False)
+  gd.addCheckbox("Projections: estimate 3D drifts from maximum projections (full 3D only if they disagree)?", False)
   gd.addCheckbox("Edge_enhance images for possibly improved drift detection?", False)
   gd.addNumericField("Only consider pixels with values larger than:", 0, 0)
   gd.addNumericField("Lowest z plane to take into account:", 1, 0)
   gd.addNumericField("Highest z plane to take into account:", imp.getNSlices(), 0)
   gd.addCheckbox("Use virtualstack for saving the results to disk to save RAM?", False)
+  gd.addCheckbox("Save_virtualstack as a single (Big)OME-TIFF file instead of one file per slice?", False)
+  gd.addCheckbox("Crop_to the field of view of all frames instead of growing the canvas?", False)
+  gd.addCheckbox("Lazy_view: translate the planes only when shown (no copy of the movie)?", False)
   gd.addCheckbox("Only compute drift vectors?", False)
+  gd.addNumericField("Threads for drift computation (without ROI):", 1, 0)
+  gd.addChoice("Pyramid downsampling for drift computation (faster for large images):", ["1", "2", "4", "8"], "1")
   gd.addMessage("If you put a ROI, drift will only be computed in this region;\n the ROI will be moved along with the drift to follow your structure of interest.")
   gd.showDialog()
   if gd.wasCanceled():
     return
   channel = gd.getNextChoiceIndex() + 1  # zero-based
   multi_time_scale = gd.getNextBoolean()
+  global_solve = gd.getNextBoolean()
+  adaptive = gd.getNextBoolean()
   subpixel = gd.getNextBoolean()
+  projections = gd.getNextBoolean()
   process = gd.getNextBoolean()
   background = gd.getNextNumber()
   z_min = gd.getNextNumber()
   z_max = gd.getNextNumber()
   virtual = gd.getNextBoolean()
+  single_file = gd.getNextBoolean()
+  crop = gd.getNextBoolean()
+  lazy = gd.getNextBoolean()
   only_compute = gd.getNextBoolean()
-  return channel, virtual, multi_time_scale, subpixel, process, background, z_min, z_max, only_compute
+  threads = max(1, int(gd.getNextNumber()))
+  pyramid = int(gd.getNextChoice())
+  return channel, virtual, multi_time_scale, subpixel, process, background, z_min, z_max, only_compute, threads, global_solve, pyramid, single_file, crop, lazy, projections, adaptive
 
-def save_shifts(shifts, roi):
+def save_shifts(shifts, roi, confidence = None):
   sd = SaveDialog('please select shift file for saving', 'shifts', '.txt')
   fp = os.path.join(sd.getDirectory(),sd.getFileName())
-  f = open(fp, 'w')
+  write_shifts(fp, shifts, roi, confidence)
+
+def write_shifts(file_path, shifts, roi, confidence = None):
+  """ writes the roi and the shifts as tab separated table (read by read_shifts()),
+  with the confidence of every frame as fourth column if given """
+  f = open(file_path, 'w')
   txt = []
   txt.append("ROI zero-based")
   txt.append("\nx_min\ty_min\tz_min\tx_max\ty_max\tz_max")
   txt.append("\n"+str(roi[0])+"\t"+str(roi[1])+"\t"+str(roi[2])+"\t"+str(roi[3])+"\t"+str(roi[4])+"\t"+str(roi[5]))
   txt.append("\nShifts")
-  txt.append("\ndx\tdy\tdz")  
-  for shift in shifts:
-    txt.append("\n"+str(shift.x)+"\t"+str(shift.y)+"\t"+str(shift.z))
+  if confidence is None:
+    txt.append("\ndx\tdy\tdz")  
+    for shift in shifts:
+      txt.append("\n"+str(shift.x)+"\t"+str(shift.y)+"\t"+str(shift.z))
+  else:
+    txt.append("\ndx\tdy\tdz\tconfidence")
+    for shift, score in zip(shifts, confidence):
+      txt.append("\n"+str(shift.x)+"\t"+str(shift.y)+"\t"+str(shift.z)+"\t"+str(round(score, 4)))
   f.writelines(txt)
   f.close()
 
-def auto_run():
+def append_shift(file_path, shift):
+  """ appends the shift of one more frame to a table written by write_shifts() """
+  f = open(file_path, 'a')
+  f.write("\n"+str(shift.x)+"\t"+str(shift.y)+"\t"+str(shift.z))
+  f.close()
 
-  IJ.log("Correct_3D_Drift")
+def read_shifts(file_path):
+  """ reads a shift file written by save_shifts() and returns the roi and the shifts
+  """
+  f = open(file_path, 'r')
+  lines = [line.strip() for line in f.readlines() if line.strip()]
+  f.close()
+  roi = [int(v) for v in lines[2].split("\t")]
+  shifts = []
+  for line in lines[5:]:
+    dx, dy, dz = [float(v) for v in line.split("\t")[:3]]
+    shifts.append(Point3f(dx, dy, dz))
+  return roi, shifts
 
-  imp = IJ.getImage()
-  if imp is None:
-    return
-  if 1 == imp.getNFrames():
-    IJ.showMessage("Cannot register because there is only one time frame.\nPlease check [Image > Properties...].")
-    return
 
-  options = autoOptions(imp)
+# drift cache: the correction shifts of an input file are stored in a json sidecar,
+# together with the options they were computed with and a hash of the file content.
+DRIFT_CACHE_SUFFIX = "_drift.json"
+
+def companion_files(file_path):
+  """ the files holding the pixels of an Olympus .vsi file (_<name>_/stack*/*.ets next to it),
+  none for other formats
+  """
+  name, ext = os.path.splitext(os.path.basename(file_path))
+  if ext.lower() != '.vsi':
+    return []
+  folder = os.path.join(os.path.dirname(file_path), '_' + name + '_')
+  return sorted(glob.glob(os.path.join(folder, 'stack*', '*.ets')))
+
+def file_hash(file_path):
+  """ sha1 of the file content, read in chunks of 4 MB. The pixels of a .vsi file are in its
+  companion .ets files (see companion_files()), their names, sizes and modification times are
+  hashed as well (instead of their content, which can be many GB)
+  """
+  h = hashlib.sha1()
+  f = open(file_path, 'rb')
+  while True:
+    chunk = f.read(4*1024*1024)
+    if not chunk:
+      break
+    h.update(chunk)
+  f.close()
+  for path in companion_files(file_path):
+    name = os.path.relpath(path, os.path.dirname(file_path)).replace(os.sep, '/')
+    h.update((name + ':' + str(os.path.getsize(path)) + ':' + repr(os.path.getmtime(path))).encode('utf-8'))
+  return h.hexdigest()
+
+def image_path(imp):
+  """ path of the file the image was opened from (None if unknown)
+  """
+  fi = imp.getOriginalFileInfo()
+  if fi is None or fi.fileName is None or fi.directory is None:
+    return None
+  return os.path.join(fi.directory, fi.fileName)
+
+def drift_cache_path(file_path, cache_folder = None):
+  """ sidecar of the input file, next to it or in the cache folder
+  """
+  if cache_folder is None:
+    cache_folder = os.path.dirname(file_path)
+  return os.path.join(cache_folder, os.path.basename(file_path) + DRIFT_CACHE_SUFFIX)
+
+def drift_options(imp, channel, multi_time_scale, process, background, z_min, z_max, global_solve, pyramid, projections = False, adaptive = False):
+  """ the options that determine the shifts (threads and the output options do not)
+  """
+  roi = None
+  if imp.getRoi():
+    b = imp.getRoi().getBounds()
+    roi = [b.x, b.y, b.width, b.height]
+  options = {"channel": channel, "multi_time_scale": multi_time_scale, "process": process,
+             "background": background, "z_min": z_min, "z_max": z_max, "global_solve": global_solve,
+             "pyramid": pyramid, "roi": roi}
+  # only stored if set, so the caches of earlier runs stay valid
+  if projections:
+    options["projections"] = True
+  if adaptive:
+    options["adaptive"] = True
+  return options
+
+def read_drift_cache(file_path, cache_folder = None):
+  """ returns the sidecar content of the input file if its content did not change, otherwise None.
+  The content hash is only recomputed if the size or modification time of the file changed.
+  """
+  cache_path = drift_cache_path(file_path, cache_folder)
+  if not os.path.isfile(cache_path) or not os.path.isfile(file_path):
+    return None
+  try:
+    f = open(cache_path, 'r')
+    cache = json.load(f)
+    f.close()
+  except ValueError:
+    IJ.log("    ignoring unreadable drift cache "+cache_path)
+    return None
+  if cache.get("size") != os.path.getsize(file_path):
+    return None
+  if cache.get("mtime") != os.path.getmtime(file_path):
+    if cache.get("hash") != file_hash(file_path):
+      return None
+  return cache
+
+def load_cached_shifts(file_path, options, cache_folder = None):
+  """ returns the cached correction shifts of the input file for these options, otherwise None
+  """
+  cache = read_drift_cache(file_path, cache_folder)
+  if cache is None:
+    return None
+  for entry in cache["entries"]:
+    if entry["options"] == options:
+      return [Point3f(x, y, z) for x, y, z in entry["shifts"]]
+  return None
+
+def save_cached_shifts(file_path, options, shifts, cache_folder = None, confidence = None):
+  """ adds the correction shifts computed with these options (and their confidence, if known)
+  to the sidecar of the input file
+  """
+  cache = read_drift_cache(file_path, cache_folder)
+  if cache is None:
+    cache = {"file": file_path, "hash": file_hash(file_path), "entries": []}
+  cache["size"] = os.path.getsize(file_path)
+  cache["mtime"] = os.path.getmtime(file_path)
+  entries = [entry for entry in cache["entries"] if entry["options"] != options]
+  entry = {"options": options, "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+           "shifts": [[shift.x, shift.y, shift.z] for shift in shifts]}
+  if confidence is not None:
+    entry["confidence"] = confidence
+  entries.append(entry)
+  cache["entries"] = entries
+  cache_path = drift_cache_path(file_path, cache_folder)
+  try:
+    f = open(cache_path, 'w')
+    json.dump(cache, f, indent=1)
+    f.close()
+  except IOError as e:
+    # e.g. a read-only folder, the shifts are still returned
+    IJ.log("    could not write the drift cache "+cache_path+": "+str(e))
+
+def apply_cached_shifts(imp, file_path, cache_folder = None, subpixel = False, crop = False, target_folder = None, virtual = False, single_file = False, options = None):
+  """ registers imp (e.g. other channels or a re-export of the input file) with the
+  cached shifts of the input file, without recomputing the drift. options (see drift_options())
+  selects the shifts; without options the cache must hold the shifts of only one set of options.
+  Returns None if there are no such cached shifts of the same number of frames.
+  """
+  cache = read_drift_cache(file_path, cache_folder)
+  if cache is None or not cache["entries"]:
+    IJ.log("    no cached drift for "+file_path)
+    return None
   if options is not None:
-    channel, virtual, multi_time_scale, subpixel, process, background, z_min, z_max, only_compute = options
+    entries = [entry for entry in cache["entries"] if entry["options"] == options]
+    if not entries:
+      IJ.log("    no cached drift with these options for "+file_path)
+      return None
   else:
-    return # user pressed Cancel
+    entries = cache["entries"]
+    if len(entries) > 1:
+      IJ.log("    the drift of "+file_path+" is cached with "+str(len(entries))+" sets of options, please choose one")
+      return None
+  shifts = [Point3f(x, y, z) for x, y, z in entries[0]["shifts"]]
+  if len(shifts) != imp.getNFrames():
+    IJ.log("    the cached drift has "+str(len(shifts))+" frames, the image "+str(imp.getNFrames()))
+    return None
+  if subpixel:
+    return register_hyperstack_subpixel(imp, 1, shifts, target_folder, virtual, single_file, crop)
+  return register_hyperstack(imp, 1, convert_shifts_to_integer(shifts), target_folder, virtual, single_file, crop)
+
+class DriftOptions(object):
+  """ options of correct_drift(), the values of getOptions() and autoOptions().
+  z_max None is the last z plane, threads None all processors. """
+  FIELDS = ("channel", "virtual", "multi_time_scale", "subpixel", "process", "background", "z_min", "z_max",
+            "only_compute", "threads", "global_solve", "pyramid", "single_file", "crop", "lazy", "projections", "adaptive")
+
+  def __init__(self, channel = 1, virtual = False, multi_time_scale = False, subpixel = False, process = False,
+               background = 0, z_min = 1, z_max = None, only_compute = False, threads = None, global_solve = False,
+               pyramid = 1, single_file = False, crop = False, lazy = False, projections = False, adaptive = False):
+    self.channel = channel
+    self.virtual = virtual
+    self.multi_time_scale = multi_time_scale
+    self.subpixel = subpixel
+    self.process = process
+    self.background = background
+    self.z_min = z_min
+    self.z_max = z_max
+    self.only_compute = only_compute
+    self.threads = threads
+    self.global_solve = global_solve
+    self.pyramid = pyramid
+    self.single_file = single_file
+    self.crop = crop
+    self.lazy = lazy
+    self.projections = projections
+    self.adaptive = adaptive
+
+  @classmethod
+  def auto(cls, imp, fast = False, **kwargs):
+    """ the options of autoOptions(imp, fast), changed by the keyword arguments """
+    options = cls(*autoOptions(imp, fast))
+    for key, value in kwargs.items():
+      if key not in cls.FIELDS:
+        raise ValueError("Unknown drift correction option: "+key)
+      setattr(options, key, value)
+    return options
+
+  def as_tuple(self):
+    return tuple([getattr(self, key) for key in self.FIELDS])
+
+def open_image(file_path):
+  """ opens an image file with Bio-Formats without showing it """
+  options = ImporterOptions()
+  options.setId(file_path)
+  return BF.openImagePlus(options)[0]
+
+def open_virtual_image(file_path):
+  """ opens an image file with Bio-Formats as virtual stack, planes are read when needed """
+  options = ImporterOptions()
+  options.setId(file_path)
+  options.setVirtual(True)
+  return BF.openImagePlus(options)[0]
+
+def correct_drift(image, options = None, target_folder = None, file_path = None, cache_folder = None, shifts = None, confidence = None):
+  """ drift correction without windows or dialogs, e.g. for several headless workers in parallel.
+  image is an ImagePlus or the path of an image file, options a DriftOptions (default: autoOptions()),
+  target_folder receives the registered slices of a virtual stack.
+  If the path of the input file and a cache_folder are given, the shifts are cached in cache_folder
+  and reused if the file content and the options did not change (see drift_cache_path()); nothing
+  is written next to the input file.
+  Given correction shifts (e.g. a shared stage drift) are applied without computing any.
+  confidence (a list) receives the confidence of every frame if the shifts are computed adaptively.
+  Returns the registered image (not shown, None if only computing) and the correction shifts.
+  Raises ValueError for input that can not be registered.
+  """
+  if isinstance(image, basestring):
+    file_path = image
+    imp = open_image(image)
+  else:
+    imp = image
+  if options is None:
+    options = DriftOptions.auto(imp)
+  channel, virtual, multi_time_scale, subpixel, process, background, z_min, z_max, only_compute, threads, global_solve, pyramid, single_file, crop, lazy, projections, adaptive = options.as_tuple()
+  if z_max is None:
+    z_max = imp.getNSlices()
+  if threads is None:
+    threads = Runtime.getRuntime().availableProcessors()
 
+  if 1 == imp.getNFrames():
+    raise ValueError("Cannot register because there is only one time frame.\nPlease check [Image > Properties...].")
   if z_min < 1:
-    IJ.showMessage("The minimal z plane must be >=1.")
-    return
-    
+    raise ValueError("The minimal z plane must be >=1.")
   if z_max > imp.getNSlices():
-    IJ.showMessage("Your image only has "+str(imp.getNSlices())+" z-planes, please adapt your z-range.")
-    return
+    raise ValueError("The image only has "+str(imp.getNSlices())+" z-planes, please adapt the z-range.")
+  if virtual is True and not lazy and not only_compute and target_folder is None:
+    raise ValueError("A target folder is needed to save the registered virtual stack.")
+
+  if shifts is not None:
+    if len(shifts) != imp.getNFrames():
+      raise ValueError("There are "+str(len(shifts))+" shifts for "+str(imp.getNFrames())+" frames.")
+    shifts = [Point3f(shift.x, shift.y, shift.z) for shift in shifts]
+
+  # reuse the shifts of a previous run on the same input
+  drift = drift_options(imp, channel, multi_time_scale, process, background, z_min, z_max, global_solve, pyramid, projections, adaptive)
+  use_cache = file_path is not None and cache_folder is not None
+  if shifts is None and use_cache:
+    shifts = load_cached_shifts(file_path, drift, cache_folder)
+    if shifts is not None:
+      IJ.log("  using cached drifts of "+file_path)
+
+  if shifts is None:
+    # compute shifts
+    IJ.log("  computing drifts..."); #print("\nCOMPUTING SHIFTS:")
+
+    cache = FrameCache()
+    scores = None
+    if adaptive:
+      IJ.log("    at frame shifts of 1, recomputing pairs of low confidence")
+      scores = confidence if confidence is not None else []
+      shifts = compute_frame_translations_adaptive(imp, channel, process, background, z_min, z_max, cache, threads, pyramid, projections, scores)
+    else:
+      IJ.log("    at frame shifts of 1"); 
+      dt = 1; shifts = compute_and_update_frame_translations_dt(imp, channel, dt, process, background, z_min, z_max, None, cache, threads, pyramid, projections)
+    
+    # multi-time-scale computation
+    if multi_time_scale is True and global_solve is True:
+      shifts = compute_frame_translations_global(imp, channel, process, background, z_min, z_max, shifts, cache, threads, pyramid, projections)
+    elif multi_time_scale is True:
+      for dt in multi_time_scales(imp.getNFrames()):
+        IJ.log("    at frame shifts of "+str(dt)) 
+        shifts = compute_and_update_frame_translations_dt(imp, channel, dt, process, background, z_min, z_max, shifts, cache, threads, pyramid, projections)
+
+    # invert measured shifts to make them the correction
+    shifts = invert_shifts(shifts)
+    if use_cache and os.path.isfile(file_path):
+      save_cached_shifts(file_path, drift, shifts, cache_folder, scores)
+
+  # the registration makes the shifts relative to the new canvas
+  correction = [Point3f(shift.x, shift.y, shift.z) for shift in shifts]
+  if only_compute:
+    return None, correction
+
+  # apply shifts
+  IJ.log("  applying shifts..."); #print("\nAPPLYING SHIFTS:")
   
+  if lazy:
+    if not subpixel:
+      shifts = convert_shifts_to_integer(shifts)
+    registered_imp = translated_view(imp, shifts, subpixel, crop)
+  elif subpixel:
+    registered_imp = register_hyperstack_subpixel(imp, channel, shifts, target_folder, virtual, single_file, crop)
+  else:
+    shifts = convert_shifts_to_integer(shifts)
+    registered_imp = register_hyperstack(imp, channel, shifts, target_folder, virtual, single_file, crop)
+    
   if virtual is True:
+    if 1 == imp.getNChannels():
+      ip=imp.getProcessor()
+      ip2=registered_imp.getProcessor()
+      ip2.setColorModel(ip.getCurrentColorModel())
+    else:
+      registered_imp.copyLuts(imp)
+  else:
+    if imp.getNChannels() > 1:
+      registered_imp.copyLuts(imp)
+
+  return registered_imp, correction
+
+# shared stage drift of multi-position acquisitions: the median drift of a few
+# reference positions is applied to every position whose own drift agrees with it
+SHARED_DRIFT_SAMPLES = 3
+SHARED_DRIFT_TOLERANCE = 2
+
+def median_shifts(shift_lists):
+  """ median (per frame and axis) of the correction shifts of several positions """
+  def median(values):
+    values = sorted(values)
+    n = len(values)
+    return 0.5 * (values[(n-1)//2] + values[n//2])
+  return [Point3f(median([s.x for s in frame]), median([s.y for s in frame]), median([s.z for s in frame]))
+          for frame in zip(*shift_lists)]
+
+def shared_stage_drift(file_paths, options = None, cache_folders = None, budget = None):
+  """ correction shifts shared by all positions: the median of the drift of the reference
+  positions (image files), each computed (or read from its cache) with correct_drift().
+  The files are opened as virtual stacks, only the frames of the pairs being measured are read.
+  With a memory budget (bytes) the number of threads is limited by budget_threads().
+  """
+  shift_lists = []
+  for i, file_path in enumerate(file_paths):
+    imp = open_virtual_image(file_path)
+    position_options = options
+    if position_options is None:
+      position_options = DriftOptions.auto(imp)
+    position_options = DriftOptions(*position_options.as_tuple())
+    position_options.only_compute = True
+    if budget is not None:
+      threads = position_options.threads
+      if threads is None:
+        threads = Runtime.getRuntime().availableProcessors()
+      position_options.threads = budget_threads(imp, position_options.z_min, position_options.z_max or imp.getNSlices(), threads, budget)
+    cache_folder = None
+    if cache_folders is not None:
+      cache_folder = cache_folders[i]
+    IJ.log("  drift of reference position "+os.path.basename(file_path))
+    shift_lists.append(correct_drift(imp, position_options, None, file_path, cache_folder)[1])
+    imp.close()
+  if len(set([len(shifts) for shifts in shift_lists])) > 1:
+    raise ValueError("The reference positions have different numbers of frames.")
+  return median_shifts(shift_lists)
+
+def shared_drift_agrees(imp, shared, options = None, samples = SHARED_DRIFT_SAMPLES, tolerance = SHARED_DRIFT_TOLERANCE):
+  """ checks the shared correction shifts on imp: the drift between the first frame and a few frames
+  spread over the time-lapse is measured and compared to the shared shifts (within tolerance pixels).
+  This costs samples frame pairs instead of one for every frame.
+  """
+  nt = imp.getNFrames()
+  if len(shared) != nt:
+    return False
+  if options is None:
+    options = DriftOptions.auto(imp)
+  z_max = options.z_max
+  if z_max is None:
+    z_max = imp.getNSlices()
+  threads = options.threads
+  if threads is None:
+    threads = Runtime.getRuntime().availableProcessors()
+  pairs = sorted(set([(0, int(round(1.0 * (nt-1) * (i+1) / samples))) for i in range(samples)]))
+  # measured drift of the shared shifts, places a roi at the drift of each frame
+  drift = [Point3f(-s.x, -s.y, -s.z) for s in shared]
+  measured = compute_pair_shifts(imp, pairs, options.channel, options.process, options.background, options.z_min, z_max,
+                                 FrameCache(), threads, drift, options.pyramid, options.projections)
+  for (t1, t2), shift in zip(pairs, measured):
+    expected = subtract_Point3f(drift[t2], drift[t1])
+    if max(abs(shift.x - expected.x), abs(shift.y - expected.y), abs(shift.z - expected.z)) > tolerance:
+      IJ.log("    frame "+str(t2+1)+" disagrees with the shared drift")
+      return False
+  return True
+
+def refine_shared_drift(imp, shared, options = None):
+  """ correction shifts of a position whose drift disagrees with the shared correction shifts:
+  a single pass over consecutive frames (dt = 1, see compute_and_update_frame_translations_dt())
+  seeded with the shared drift, so a roi follows it from the first frame on. The multi-time-scale,
+  global and adaptive computations of options are skipped.
+  """
+  if options is None:
+    options = DriftOptions.auto(imp)
+  z_max = options.z_max
+  if z_max is None:
+    z_max = imp.getNSlices()
+  threads = options.threads
+  if threads is None:
+    threads = Runtime.getRuntime().availableProcessors()
+  drift = [Point3f(-s.x, -s.y, -s.z) for s in shared]
+  IJ.log("  refining the shared drift at frame shifts of 1")
+  drift = compute_and_update_frame_translations_dt(imp, options.channel, 1, options.process, options.background, options.z_min, z_max,
+                                                   drift, FrameCache(), threads, options.pyramid, options.projections)
+  return invert_shifts(drift)
+
+# online drift correction of acquisitions in progress
+ONLINE_DIGITS = 5 # digits of the frame number in the names of the registered planes
+ONLINE_POLL = 2.0 # seconds between two looks at the source
+ONLINE_IDLE = 600 # seconds without a new frame until the acquisition is considered done
+
+class OnlineDrift(object):
+  """ incremental drift correction: frames are added one at a time as they are acquired
+  (each an ImagePlus with all channels and slices of one time point). The drift to the previous
+  frame is computed, the correction shift appended to the shift table and the registered planes
+  of the frame written to target_folder (named as by register_hyperstack() into a virtual stack).
+  The registered frames keep the canvas of the first frame, the common field of view
+  is not known before the acquisition ends.
+  The roi (optional) is fixed, as in the first pass of compute_and_update_frame_translations_dt().
+  Every frame is only registered against the previous one, there is no multi-time-scale pass:
+  the errors of the single steps add up over the acquisition (a random walk), so slow drifts
+  of long acquisitions are better corrected afterwards with correct_drift().
+  Frames already in an existing shift table are not corrected again, see resume().
+  """
+  def __init__(self, target_folder, options = None, table_path = None, roi = None):
+    self.target_folder = target_folder
+    self.options = options
+    self.table_path = table_path
+    if table_path is None:
+      self.table_path = os.path.join(target_folder, "shifts.txt")
+    self.roi = roi
+    self.shifts = [] # measured drift of all frames so far
+    self.reference = None # processed previous frame
+    self.output = None
+    if os.path.isfile(self.table_path):
+      for shift in read_shifts(self.table_path)[1]:
+        self.shifts.append(Point3f(-shift.x, -shift.y, -shift.z))
+
+  def setup(self, imp):
+    if self.options is None:
+      self.options = DriftOptions.auto(imp)
+    self.z_max = self.options.z_max
+    if self.z_max is None:
+      self.z_max = imp.getNSlices()
+    self.slices = imp.getNSlices()
+    if not os.path.isdir(self.target_folder):
+      os.makedirs(self.target_folder)
+    self.output = TiffSequenceOutput(imp, imp.getWidth(), imp.getHeight(), self.target_folder)
+    self.output.names = sorted([name for name in os.listdir(self.target_folder) if name.startswith("t") and name.endswith(".tif")])
+    if not os.path.isfile(self.table_path):
+      write_shifts(self.table_path, [], [0, 0, self.options.z_min-1, imp.getWidth()-1, imp.getHeight()-1, self.z_max-1])
+
+  def process(self, imp):
+    if self.output is None:
+      self.setup(imp)
+    o = self.options
+    return extract_frame_process_roi(imp, 1, o.channel, o.process, o.background, self.roi, o.z_min, self.z_max)
+
+  def resume(self, imp):
+    """ sets the last frame of the shift table (already registered) as reference of the next frame """
+    self.reference = self.process(imp)
+
+  def add_frame(self, imp):
+    """ computes the drift of the next frame and writes its shift and registered planes,
+    returns the correction shift """
+    processed = self.process(imp)
+    if self.reference is None or not self.shifts:
+      shift = Point3f(0, 0, 0)
+    else:
+      local_shift = compute_stitch(processed, self.reference, None, self.options.pyramid, self.options.projections)
+      shift = add_Point3f(self.shifts[-1], Point3f(local_shift.x, local_shift.y, local_shift.z))
+    self.reference = processed
+    self.shifts.append(shift)
+    correction = Point3f(-shift.x, -shift.y, -shift.z)
+    append_shift(self.table_path, correction)
+    self.register_frame(imp, correction)
+    IJ.log("    frame "+str(len(self.shifts))+" correcting drift "+str(round(correction.x,2))+","+str(round(correction.y,2))+","+str(round(correction.z,2)))
+    return correction
+
+  def register_frame(self, imp, correction):
+    nc, nz = imp.getNChannels(), imp.getNSlices()
+    width, height = imp.getWidth(), imp.getHeight()
+    stack = imp.getStack()
+    fr = "t" + zero_pad(len(self.shifts), ONLINE_DIGITS)
+    if self.options.subpixel:
+      translated = []
+      for ch in range(1, nc+1):
+        tmpstack = ImageStack(width, height, imp.getProcessor().getColorModel())
+        for s in range(1, nz+1):
+          tmpstack.addSlice("", stack.getProcessor(imp.getStackIndex(ch, s, 1)))
+        translated.append(translate_single_stack_using_imglib2(ImagePlus("", tmpstack), correction.x, correction.y, correction.z).getStack())
+    dx, dy, dz = int(round(correction.x)), int(round(correction.y)), int(round(correction.z))
+    for s in range(1, nz+1):
+      ss = "_z" + zero_pad(s, len(str(nz)))
+      for ch in range(1, nc+1):
+        if self.options.subpixel:
+          ip = translated[ch-1].getProcessor(s).duplicate()
+        elif 1 <= s - dz <= nz:
+          ip = translate_plane(stack.getProcessor(imp.getStackIndex(ch, s - dz, 1)), width, height, dx, dy)
+        else:
+          ip = imp.getProcessor().createProcessor(width, height)
+        self.output.add_slice(fr + ss + "_c" + zero_pad(ch, len(str(nc))) + ".tif", ip)
+
+  def get_imp(self):
+    """ the registered frames so far as virtual hyperstack """
+    imp = self.output.imp
+    registeredstack = VirtualStack(imp.getWidth(), imp.getHeight(), None, self.target_folder)
+    for name in self.output.names:
+      registeredstack.addSlice(name)
+    registeredstack_imp = ImagePlus("registered time points", registeredstack)
+    registeredstack_imp.setCalibration(imp.getCalibration().copy())
+    registeredstack_imp.setProperty("Info", imp.getProperty("Info"))
+    nc = imp.getNChannels()
+    return HyperStackConverter.toHyperStack(registeredstack_imp, nc, self.slices, len(self.output.names) // (nc * self.slices), "xyczt", "Composite")
+
+def frame_files(folder):
+  """ image files of a folder (one per time point) in acquisition (name) order """
+  return sorted([name for name in os.listdir(folder) if not name.startswith(".") and os.path.isfile(os.path.join(folder, name))])
+
+def frame_of(imp, frame):
+  """ all channels and slices of one frame of a (virtual) hyperstack """
+  return Duplicator().run(imp, 1, imp.getNChannels(), 1, imp.getNSlices(), frame, frame)
+
+def correct_drift_online(source, target_folder, options = None, table_path = None, poll = ONLINE_POLL, idle = ONLINE_IDLE):
+  """ drift correction while the acquisition is still running. source is either a folder that
+  receives one image file per time point, or a single (multi-frame) file that grows.
+  Every poll seconds new frames are corrected with OnlineDrift, files are only read once their
+  size did not change since the last look. Returns the registered image when no frame arrived
+  for idle seconds. Rerunning on the same target_folder continues after the last corrected frame.
+  """
+  online = OnlineDrift(target_folder, options, table_path)
+  sizes = {} # file sizes at the last look
+  read_size = None # size of the growing file when it was last read
+  last_frame = time.time()
+  while time.time() - last_frame < idle:
+    done = len(online.shifts)
+    if os.path.isdir(source):
+      paths = [os.path.join(source, name) for name in frame_files(source)]
+    else:
+      paths = [source]
+    # complete files: the same size as at the last look
+    complete = []
+    for path in paths:
+      size = os.path.getsize(path)
+      if sizes.get(path) != size:
+        sizes[path] = size
+        break
+      complete.append(path)
+
+    if os.path.isdir(source):
+      for i in range(done, len(complete)):
+        if i > 0 and online.reference is None:
+          imp = open_image(complete[i-1])
+          online.resume(imp)
+          imp.close()
+        imp = open_image(complete[i])
+        online.add_frame(imp)
+        imp.close()
+        last_frame = time.time()
+    elif complete and sizes[source] != read_size:
+      # the acquisition software may still be writing the file
+      try:
+        imp = open_virtual_image(source)
+      except Exception as e:
+        IJ.log("  cannot read "+source+" yet: "+str(e))
+        imp = None
+      if imp is not None:
+        read_size = sizes[source]
+        for t in range(done+1, imp.getNFrames()+1):
+          if t > 1 and online.reference is None:
+            online.resume(frame_of(imp, t-1))
+          online.add_frame(frame_of(imp, t))
+          last_frame = time.time()
+        imp.close()
+    time.sleep(poll)
+  if online.output is None:
+    return None
+  return online.get_imp()
+
+def shifts_roi(imp):
+  """ the region [xmin, ymin, zmin, xmax, ymax, zmax] saved with the shifts: the bounds of the roi or the whole image """
+  if imp.getRoi(): 
+    xmin = imp.getRoi().getBounds().x
+    ymin = imp.getRoi().getBounds().y
+    zmin = 0
+    xmax = xmin + imp.getRoi().getBounds().width - 1
+    ymax = ymin + imp.getRoi().getBounds().height - 1
+    zmax = imp.getNSlices()-1  
+  else:
+    xmin = 0
+    ymin = 0
+    zmin = 0
+    xmax = imp.getWidth() - 1
+    ymax = imp.getHeight() - 1
+    zmax = imp.getNSlices() - 1  
+  return [xmin, ymin, zmin, xmax, ymax, zmax]
+
+def auto_run(file_path = None, cache_folder = None):
+  """ runs the drift correction with the default options of autoOptions() on the current image
+  and shows the result (see correct_drift()). file_path defaults to the file the image was opened from,
+  the shifts are only cached if a cache_folder is given.
+  """
+
+  IJ.log("Correct_3D_Drift")
+
+  imp = IJ.getImage()
+  if imp is None:
+    return
+
+  options = DriftOptions.auto(imp)
+  if options.virtual is True:
     dc = DirectoryChooser("Choose target folder to save image sequence")
     target_folder = dc.getDirectory()
     if target_folder is None:
@@ -613,75 +2139,18 @@ def auto_run():
   else:
     target_folder = None 
 
-  # compute shifts
-  IJ.log("  computing drifts..."); #print("\nCOMPUTING SHIFTS:")
-
-  IJ.log("    at frame shifts of 1"); 
-  dt = 1; shifts = compute_and_update_frame_translations_dt(imp, channel, dt, process, background, z_min, z_max)
-  
-  # multi-time-scale computation
-  if multi_time_scale is True:
-    dt_max = imp.getNFrames()-1
-    # computing drifts on exponentially increasing time scales 3^i up to 3^6
-    # ..one could also do this with 2^i or 4^i
-    # ..maybe make this a user choice? did not do this to keep it simple.
-    dts = [3,9,27,81,243,729,dt_max] 
-    for dt in dts:
-      if dt < dt_max:
-        IJ.log("    at frame shifts of "+str(dt)) 
-        shifts = compute_and_update_frame_translations_dt(imp, channel, dt, process, background, z_min, z_max, shifts)
-      else: 
-        IJ.log("    at frame shifts of "+str(dt_max));
-        shifts = compute_and_update_frame_translations_dt(imp, channel, dt_max, process, background, z_min, z_max, shifts)
-        break
+  if file_path is None:
+    file_path = image_path(imp)
+  try:
+    registered_imp, shifts = correct_drift(imp, options, target_folder, file_path, cache_folder)
+  except ValueError as e:
+    IJ.showMessage(str(e))
+    return
 
-  # invert measured shifts to make them the correction
-  shifts = invert_shifts(shifts)
-  #print(shifts)
-  
-  
-  # apply shifts
-  if not only_compute:
-    
-    IJ.log("  applying shifts..."); #print("\nAPPLYING SHIFTS:")
-    
-    if subpixel:
-      registered_imp = register_hyperstack_subpixel(imp, channel, shifts, target_folder, virtual)
-    else:
-      shifts = convert_shifts_to_integer(shifts)
-      registered_imp = register_hyperstack(imp, channel, shifts, target_folder, virtual)
-      
-    if virtual is True:
-      if 1 == imp.getNChannels():
-        ip=imp.getProcessor()
-        ip2=registered_imp.getProcessor()
-        ip2.setColorModel(ip.getCurrentColorModel())
-      else:
-        registered_imp.copyLuts(imp)
-    else:
-      if imp.getNChannels() > 1:
-        registered_imp.copyLuts(imp)
-  
+  if registered_imp is not None:
     registered_imp.show()
-  
   else:
-   
-    if imp.getRoi(): 
-      xmin = imp.getRoi().getBounds().x
-      ymin = imp.getRoi().getBounds().y
-      zmin = 0
-      xmax = xmin + imp.getRoi().getBounds().width - 1
-      ymax = ymin + imp.getRoi().getBounds().height - 1
-      zmax = imp.getNSlices()-1  
-    else:
-      xmin = 0
-      ymin = 0
-      zmin = 0
-      xmax = imp.getWidth() - 1
-      ymax = imp.getHeight() - 1
-      zmax = imp.getNSlices() - 1  
-    
-    save_shifts(shifts, [xmin, ymin, zmin, xmax, ymax, zmax])
+    save_shifts(shifts, shifts_roi(imp))
     IJ.log("  saving shifts...")
 
   return registered_imp 
@@ -699,20 +2168,11 @@ def run():
     return
 
   options = getOptions(imp)
-  if options is not None:
-    channel, virtual, multi_time_scale, subpixel, process, background, z_min, z_max, only_compute = options
-  else:
+  if options is None:
     return # user pressed Cancel
+  options = DriftOptions(*options)
 
-  if z_min < 1:
-    IJ.showMessage("The minimal z plane must be >=1.")
-    return
-    
-  if z_max > imp.getNSlices():
-    IJ.showMessage("Your image only has "+str(imp.getNSlices())+" z-planes, please adapt your z-range.")
-    return
-  
-  if virtual is True:
+  if options.virtual is True:
     dc = DirectoryChooser("Choose target folder to save image sequence")
     target_folder = dc.getDirectory()
     if target_folder is None:
@@ -722,75 +2182,17 @@ def run():
   else:
     target_folder = None 
 
-  # compute shifts
-  IJ.log("  computing drifts..."); #print("\nCOMPUTING SHIFTS:")
-
-  IJ.log("    at frame shifts of 1"); 
-  dt = 1; shifts = compute_and_update_frame_translations_dt(imp, channel, dt, process, background, z_min, z_max)
-  
-  # multi-time-scale computation
-  if multi_time_scale is True:
-    dt_max = imp.getNFrames()-1
-    # computing drifts on exponentially increasing time scales 3^i up to 3^6
-    # ..one could also do this with 2^i or 4^i
-    # ..maybe make this a user choice? did not do this to keep it simple.
-    dts = [3,9,27,81,243,729,dt_max] 
-    for dt in dts:
-      if dt < dt_max:
-        IJ.log("    at frame shifts of "+str(dt)) 
-        shifts = compute_and_update_frame_translations_dt(imp, channel, dt, process, background, z_min, z_max, shifts)
-      else: 
-        IJ.log("    at frame shifts of "+str(dt_max));
-        shifts = compute_and_update_frame_translations_dt(imp, channel, dt_max, process, background, z_min, z_max, shifts)
-        break
+  confidence = []
+  try:
+    registered_imp, shifts = correct_drift(imp, options, target_folder, confidence = confidence)
+  except ValueError as e:
+    IJ.showMessage(str(e))
+    return
 
-  # invert measured shifts to make them the correction
-  shifts = invert_shifts(shifts)
-  #print(shifts)
-  
-  
-  # apply shifts
-  if not only_compute:
-    
-    IJ.log("  applying shifts..."); #print("\nAPPLYING SHIFTS:")
-    
-    if subpixel:
-      registered_imp = register_hyperstack_subpixel(imp, channel, shifts, target_folder, virtual)
-    else:
-      shifts = convert_shifts_to_integer(shifts)
-      registered_imp = register_hyperstack(imp, channel, shifts, target_folder, virtual)
-      
-    if virtual is True:
-      if 1 == imp.getNChannels():
-        ip=imp.getProcessor()
-        ip2=registered_imp.getProcessor()
-        ip2.setColorModel(ip.getCurrentColorModel())
-      else:
-    	registered_imp.copyLuts(imp)
-    else:
-      if imp.getNChannels() > 1:
-        registered_imp.copyLuts(imp)
-  
+  if registered_imp is not None:
     registered_imp.show()
-  
   else:
-   
-    if imp.getRoi(): 
-      xmin = imp.getRoi().getBounds().x
-      ymin = imp.getRoi().getBounds().y
-      zmin = 0
-      xmax = xmin + imp.getRoi().getBounds().width - 1
-      ymax = ymin + imp.getRoi().getBounds().height - 1
-      zmax = imp.getNSlices()-1  
-    else:
-      xmin = 0
-      ymin = 0
-      zmin = 0
-      xmax = imp.getWidth() - 1
-      ymax = imp.getHeight() - 1
-      zmax = imp.getNSlices() - 1  
-    
-    save_shifts(shifts, [xmin, ymin, zmin, xmax, ymax, zmax])
+    save_shifts(shifts, shifts_roi(imp), confidence or None)
     IJ.log("  saving shifts...")
     
 if __name__ == '__main__':
@@ -11,6 +11,7 @@
 
 import os
 import re
+import sys
 from math import sqrt
 from ij import IJ, ImagePlus, ImageStack
 from ij.gui import WaitForUserDialog, ShapeRoi
@@ -18,15 +19,22 @@ from ij.plugin import Duplicator, ImageCalculator, RoiEnlarger
 from ij.measure import ResultsTable
 from ij.plugin.frame import RoiManager
 
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, SCRIPT_PATH)
+
+import background_subtraction
+
 # input folder and settings
 #@ File (label="phase contrast image", style="directory") main_dir
+#@ String (label="Background subtraction (fast: approximate, on shrunken planes)", choices={"exact", "fast"}, value="exact") bg_mode
 
-def mask_phase(img):
+def mask_phase(img, mode='exact'):
 	'''
 	Segment based on phase contrast image while excluding
 	colonies that are already segmented based on fluorescence
 	'''
-	IJ.run(img, "Subtract Background...", "rolling=40 light")
+	# exact: as "Subtract Background..." with rolling=40 light
+	background_subtraction.subtract_background(img, 40, True, mode)
 	IJ.run(img, "Gaussian Blur...", "sigma=10")
 	#IJ.run(img, "Invert", "")
 	IJ.run(img, "Auto Threshold", "method=Default white")
@@ -94,7 +102,7 @@ if __name__ == '__main__':
 
             # Get phase contrast segmentation of the current frame
             phase = Duplicator().run(img_p, 1,1,1,1,t,t)
-            phase = mask_phase(phase)
+            phase = mask_phase(phase, bg_mode)
 
             IJ.run(phase, "Analyze Particles...", "size=10-Infinity add")
             
@@ -0,0 +1,258 @@
+"""
+Headless Colony Segmentation (NumPy)
+
+This script segments micro-colonies in phase contrast time-lapses without Fiji,
+a JVM or a display. It mirrors mask_phase() and "Analyze Particles" of
+segment_colonies_batch.py for every frame:
+	1. rolling ball background subtraction (radius 40, light background),
+	   exact or fast with --mode fast (background_subtraction_np.py)
+	2. Gaussian blur (sigma 10)
+	3. Default auto threshold (ImageJ's IsoData variant)
+	4. connected components (8-connected) of at least 10 (calibrated) units
+	   with their holes filled, as the outlines traced by "Analyze Particles"
+
+The filters work on (T, Y, X) stacks in batches of frames, so a batch is
+filtered by single vectorized calls instead of one macro call per frame. The
+threshold is computed per frame, as in the Fiji script.
+
+The colonies of every position are saved as label stack (T, Y, X) next to the
+phase contrast stack; the labels of every frame are numbered from 1 in the
+order of their first pixel. With --compare the masks are checked frame by frame
+against the ROIs saved by segment_colonies_batch.py (ROI/ROI_T=001.zip, ...)
+with the intersection over union (IoU); reading ROIs needs the roifile package.
+
+Tolerance:
+	The masks differ from those of the Fiji script along the outlines: ImageJ
+	interpolates the shrunken background and blurs with a downscaled Gaussian
+	kernel, which moves the threshold of a frame by a few gray values. Use
+	--compare to check the IoU on your data.
+
+Usage:
+	python segment_colonies_np.py [main_dir]
+	python segment_colonies_np.py [main_dir] --compare
+"""
+
+import os
+import argparse
+import logging
+import numpy as np
+from scipy import ndimage
+from background_subtraction_np import MODES, subtract_background
+
+# parameters of mask_phase() and "Analyze Particles" in segment_colonies_batch.py
+BALL_RADIUS = 40
+SIGMA = 10
+MIN_SIZE = 10
+# number of frames that are filtered together
+BATCH = 8
+# kernel accuracy of ImageJ's Gaussian Blur for 16-bit and float images
+GAUSS_ACCURACY = 0.0002
+
+
+def load_stack(file_path):
+	"""
+	Read the phase contrast TIFF file as (T, Y, X) array and return it with its
+	pixel size (calibrated units per pixel, 1 if the file is not calibrated).
+	"""
+	import tifffile
+
+	with tifffile.TiffFile(file_path) as tif:
+		series = tif.series[0]
+		data = series.asarray()
+		tags = tif.pages[0].tags
+		pixel_size = 1.0
+		# ImageJ stores the calibration as resolution; other files are only calibrated in cm
+		if 'XResolution' in tags and (tif.is_imagej or tags.valueof('ResolutionUnit') == 3):
+			num, den = tags['XResolution'].value
+			if num > 0:
+				pixel_size = den / num
+
+	return data.reshape((-1,) + data.shape[-2:]), pixel_size
+
+
+def gaussian_blur(stack, sigma=SIGMA):
+	"""
+	Gaussian blur of every frame (T, Y, X) like "Gaussian Blur..." (edge pixels extended), rounded to 16-bit.
+	"""
+	truncate = np.sqrt(-2 * np.log(GAUSS_ACCURACY))
+	blurred = ndimage.gaussian_filter(stack.astype(np.float32), sigma=(0, sigma, sigma), mode='nearest', truncate=truncate)
+	return np.clip(np.rint(blurred), 0, 65535).astype(np.uint16)
+
+
+def default_threshold(frame):
+	"""
+	Threshold of "Auto Threshold" with method=Default (IJ_IsoData) of a 16-bit frame.
+	The histogram covers the range of the frame; its lowest and highest bins are ignored.
+	"""
+	low = int(frame.min())
+	data = np.bincount((frame - low).ravel().astype(np.int64)).astype(np.float64)
+	data[0] = 0
+	data[-1] = 0
+	nonzero = np.flatnonzero(data)
+	if len(nonzero) == 0 or nonzero[0] >= nonzero[-1]:
+		return low + len(data) // 2
+	dmin, dmax = nonzero[0], nonzero[-1]
+	bins = np.arange(len(data))
+	sum_i = np.cumsum(bins * data)
+	sum_n = np.cumsum(data)
+	# mean of the lower and the upper part for every moving index
+	moving = np.arange(dmin, max(dmin + 1, dmax - 1))
+	lower = sum_i[moving] / sum_n[moving]
+	upper = (sum_i[dmax] - sum_i[moving]) / (sum_n[dmax] - sum_n[moving])
+	result = (lower + upper) / 2
+	# the moving index advances while it is below the result
+	stop = np.flatnonzero(~((moving + 2 <= result) & (moving + 1 < dmax - 1)))
+	result = result[stop[0]] if len(stop) else result[-1]
+	return low + int(np.floor(result + 0.5))
+
+
+def mask_phase(stack, radius=BALL_RADIUS, sigma=SIGMA, light=True, mode="exact"):
+	"""
+	Colony masks of the phase contrast frames (T, Y, X) as mask_phase() in
+	segment_colonies_batch.py: the colonies are the pixels at or below the
+	threshold of every frame (dark colonies on a light background).
+	"""
+	blurred = gaussian_blur(subtract_background(stack, radius, light, mode), sigma)
+	mask = np.empty(stack.shape, dtype=bool)
+	for t, frame in enumerate(blurred):
+		threshold = default_threshold(frame)
+		mask[t] = frame <= threshold if light else frame > threshold
+	return mask
+
+
+def label_colonies(mask, min_size=MIN_SIZE, pixel_size=1.0):
+	"""
+	Label the 8-connected components of a frame mask (Y, X) with at least
+	min_size calibrated units (size=10-Infinity of "Analyze Particles", holes not
+	counted), with their holes filled as in the traced outlines.
+	"""
+	labels, n = ndimage.label(mask, structure=np.ones((3, 3)))
+	if n == 0:
+		return labels
+	sizes = np.bincount(labels.ravel()) * pixel_size ** 2
+	keep = sizes >= min_size
+	keep[0] = False
+	filled = ndimage.binary_fill_holes(keep[labels])
+	labels, n = ndimage.label(filled, structure=np.ones((3, 3)))
+	return labels
+
+
+def segment_stack(stack, radius=BALL_RADIUS, sigma=SIGMA, min_size=MIN_SIZE, pixel_size=1.0, light=True, batch=BATCH, mode="exact"):
+	"""
+	Segment the colonies of all frames (T, Y, X) and return the labels (T, Y, X),
+	numbered from 1 in every frame. The frames are filtered in batches; mode is
+	the background subtraction ("exact" or "fast", see background_subtraction_np.py).
+	"""
+	labels = np.zeros(stack.shape, dtype=np.uint16)
+	for start in range(0, len(stack), batch):
+		mask = mask_phase(stack[start:start + batch], radius, sigma, light, mode)
+		for t, frame in enumerate(mask, start):
+			labels[t] = label_colonies(frame, min_size, pixel_size)
+	return labels
+
+
+def polygon_mask(x, y, shape):
+	"""
+	Mask (Y, X) of the pixels whose centers are inside the polygon (even-odd rule).
+	"""
+	mask = np.zeros(shape, dtype=bool)
+	x0, x1 = max(int(np.floor(x.min())), 0), min(int(np.ceil(x.max())), shape[1])
+	y0, y1 = max(int(np.floor(y.min())), 0), min(int(np.ceil(y.max())), shape[0])
+	if x1 <= x0 or y1 <= y0:
+		return mask
+	py, px = np.mgrid[y0:y1, x0:x1] + 0.5
+	inside = np.zeros(px.shape, dtype=bool)
+	for xa, ya, xb, yb in zip(x, y, np.roll(x, -1), np.roll(y, -1)):
+		if ya == yb:
+			continue
+		crosses = (ya > py) != (yb > py)
+		xc = xa + (py - ya) * (xb - xa) / (yb - ya)
+		inside ^= crosses & (px < xc)
+	mask[y0:y1, x0:x1] = inside
+	return mask
+
+
+def read_roi_mask(zip_path, shape):
+	"""
+	Mask (Y, X) of the ROIs of one frame saved by segment_colonies_batch.py.
+	"""
+	import roifile
+
+	mask = np.zeros(shape, dtype=bool)
+	for roi in roifile.roiread(zip_path):
+		coords = roi.coordinates()
+		mask |= polygon_mask(coords[:, 0], coords[:, 1], shape)
+	return mask
+
+
+def iou(mask1, mask2):
+	"""
+	Intersection over union of two masks (1 if both are empty).
+	"""
+	union = np.count_nonzero(mask1 | mask2)
+	return np.count_nonzero(mask1 & mask2) / union if union else 1.0
+
+
+def compare_rois(labels, roi_path):
+	"""
+	IoU of the labels (T, Y, X) and the ROIs of segment_colonies_batch.py for every frame with a ROI file.
+	"""
+	scores = {}
+	for t in range(1, len(labels) + 1):
+		zip_path = os.path.join(roi_path, 'ROI_T={0:03}.zip'.format(t))
+		if os.path.isfile(zip_path):
+			scores[t] = iou(labels[t - 1] > 0, read_roi_mask(zip_path, labels.shape[1:]))
+	return scores
+
+
+def process_position(pos, args):
+	"""
+	Segment the phase contrast stack of one position and save (and compare) the labels.
+	"""
+	import tifffile
+
+	basename = os.path.basename(pos)
+	phase_file = os.path.join(pos, basename + '_phase.tif')
+	if not os.path.isfile(phase_file):
+		logging.warning(f"No phase contrast stack in {pos}")
+		return
+	stack, pixel_size = load_stack(phase_file)
+	if args.pixel_size:
+		pixel_size = args.pixel_size
+	labels = segment_stack(stack, args.radius, args.sigma, args.min_size, pixel_size, batch=args.batch, mode=args.mode)
+	out_file = os.path.join(pos, basename + '_labels.tif')
+	tifffile.imwrite(out_file, labels, imagej=True, metadata={'axes': 'TYX'}, compression='zlib')
+	logging.info(f"Saved {labels.max(axis=(1, 2)).sum()} colonies in {len(labels)} frames to {out_file}")
+
+	if args.compare:
+		scores = compare_rois(labels, os.path.join(pos, 'ROI'))
+		for t, score in scores.items():
+			logging.info(f"    T={t:03} IoU {score:.3f}")
+		if scores:
+			logging.info(f"    mean IoU {np.mean(list(scores.values())):.3f}, lowest {min(scores.values()):.3f}")
+
+
+def run():
+	"""
+	Run the script with command line arguments.
+	"""
+	logging.basicConfig(level=logging.INFO)
+	parser = argparse.ArgumentParser(description="Segment micro-colonies in phase contrast stacks without Fiji")
+	parser.add_argument("main_dir", help="Folder with one subfolder per position (with <position>_phase.tif)")
+	parser.add_argument("--radius", type=float, default=BALL_RADIUS, help="Rolling ball radius (pixels)")
+	parser.add_argument("--sigma", type=float, default=SIGMA, help="Sigma of the Gaussian blur (pixels)")
+	parser.add_argument("--min_size", type=float, default=MIN_SIZE, help="Smallest colony (calibrated units, as size= of Analyze Particles)")
+	parser.add_argument("--pixel_size", type=float, default=None, help="Pixel size (default: calibration of the TIFF file)")
+	parser.add_argument("--batch", type=int, default=BATCH, help="Frames filtered together")
+	parser.add_argument("--mode", default="exact", choices=MODES, help="Exact (ImageJ) or fast approximate background subtraction")
+	parser.add_argument("--compare", action="store_true", help="Report the IoU with the ROIs of segment_colonies_batch.py")
+	args = parser.parse_args()
+
+	mdir = os.path.abspath(args.main_dir)
+	for pos in sorted(os.path.join(mdir, d) for d in os.listdir(mdir)):
+		if os.path.isdir(pos):
+			logging.info(pos)
+			process_position(pos, args)
+
+if __name__ == "__main__":
+	run()
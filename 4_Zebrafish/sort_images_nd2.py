@@ -17,16 +17,21 @@ Sample1
 			├── Sample1_T00_C02_Z00.tif
 			└── ...
 
+The planes can be saved with lossless compression (--compression, default none),
+encoded by several threads (--threads) with tiff_writer.py.
+
 Usage:
 	python sort_images_nd2.py [path_to_nd2_file]
+	python sort_images_nd2.py --compression lzw --threads 8 [path_to_nd2_file]
 """
 
 import os
 import argparse
 import logging
 from nd2reader import ND2Reader
-from skimage.io import imsave
+import numpy as np
 import itertools
+from tiff_writer import PlaneWriter, add_arguments
 
 def create_directory(path):
 	"""
@@ -47,7 +52,7 @@ def get_nd_pname(nd_file, index):
 	return(name)
 
 
-def process_images(file_path):
+def process_images(file_path, compression="none", threads=None):
 	"""
 	Process and save images from ND2 file.
 	"""
@@ -78,7 +83,15 @@ def process_images(file_path):
 	keys = list(dimensions)
 	positions = {}
 
-	
+	with PlaneWriter(compression, threads=threads) as writer:
+		save_images(nd2, keys, dimensions, positions, out_dir, writer)
+
+
+def save_images(nd2, keys, dimensions, positions, out_dir, writer):
+	"""
+	Queue every plane of the ND2 file to the writer, a plane is logged once its file is written.
+	"""
+	saved = lambda path: logging.info(f"Saved {os.path.basename(path)} to {out_dir}")
 	for values in itertools.product(*map(dimensions.get, keys)):
 		img_name = 'Series'
 
@@ -91,35 +104,36 @@ def process_images(file_path):
 
 		try:
 			frame = nd2.get_frame_2D(**dict(zip(keys,values)))
-			if 'v' in keys:
-				if not paras['v'] in positions.keys():
-					positions[paras['v']] = os.path.join(out_dir,get_nd_pname(nd2, paras['v']))
-					fluor_dir = os.path.join(positions[paras['v']], 'Fluor')
-					img_dir = os.path.join(positions[paras['v']], 'Images')
-					create_directory(fluor_dir)
-					create_directory(img_dir)
-			else:
-				positions[0] = os.path.join(out_dir,get_nd_pname(nd2, 0))
-				fluor_dir = os.path.join(positions[0], 'Fluor')
-				img_dir = os.path.join(positions[0], 'Images')
+		except:
+			logging.warn(f"index out of range {img_name}")
+			continue
+
+		if 'v' in keys:
+			if not paras['v'] in positions.keys():
+				positions[paras['v']] = os.path.join(out_dir,get_nd_pname(nd2, paras['v']))
+				fluor_dir = os.path.join(positions[paras['v']], 'Fluor')
+				img_dir = os.path.join(positions[paras['v']], 'Images')
 				create_directory(fluor_dir)
 				create_directory(img_dir)
-
-			if paras['c'] == 0:
-				if 'v' in keys:
-					imsave(os.path.join(positions[paras['v']], 'Images', img_name), frame, check_contrast=False)
-				else:
-					imsave(os.path.join(positions[0], 'Images', img_name), frame, check_contrast=False)
-
+		else:
+			positions[0] = os.path.join(out_dir,get_nd_pname(nd2, 0))
+			fluor_dir = os.path.join(positions[0], 'Fluor')
+			img_dir = os.path.join(positions[0], 'Images')
+			create_directory(fluor_dir)
+			create_directory(img_dir)
+
+		# errors of the writers are raised here or when the writer is closed
+		if paras['c'] == 0:
+			if 'v' in keys:
+				writer.write(os.path.join(positions[paras['v']], 'Images', img_name), np.asarray(frame), saved)
 			else:
-				if 'v' in keys:
-					imsave(os.path.join(positions[paras['v']], 'Fluor', img_name), frame, check_contrast=False)
-				else:
-					imsave(os.path.join(positions[0], 'Fluor', img_name), frame, check_contrast=False)
+				writer.write(os.path.join(positions[0], 'Images', img_name), np.asarray(frame), saved)
 
-			logging.info(f"Saved {img_name} to {out_dir}")
-		except:
-			logging.warn(f"index out of range {img_name}")
+		else:
+			if 'v' in keys:
+				writer.write(os.path.join(positions[paras['v']], 'Fluor', img_name), np.asarray(frame), saved)
+			else:
+				writer.write(os.path.join(positions[0], 'Fluor', img_name), np.asarray(frame), saved)
 
 
 def run():
@@ -129,8 +143,9 @@ def run():
 	logging.basicConfig(level=logging.INFO)
 	parser = argparse.ArgumentParser(description="Convert ND2 file into individual tiff files")
 	parser.add_argument("file_path", help="Path to ND2 file")
+	add_arguments(parser)
 	args = parser.parse_args()
-	process_images(args.file_path)
+	process_images(args.file_path, args.compression, args.threads)
 	
 if __name__ == "__main__":
 	run()
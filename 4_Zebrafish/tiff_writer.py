@@ -0,0 +1,251 @@
+"""
+Parallel Compressed TIFF Writer
+
+This module writes image stacks and single planes as losslessly compressed
+TIFF files. The planes (or tiles) are encoded by a pool of threads (zlib,
+LZW and Zstd release the GIL) while a single writer appends them to the file
+in their original order, so the page order does not depend on which thread
+finishes first. Only a few planes per thread are encoded ahead of the writer,
+so a stack is never held in memory as a whole.
+
+Compressions:
+	none     uncompressed
+	lzw      LZW (needs imagecodecs)
+	deflate  Deflate/zlib (ImageJ and FIJI read it natively)
+	zstd     Zstandard (needs imagecodecs, not readable by ImageJ)
+Integer images are encoded with the horizontal differencing predictor, which
+makes 16-bit microscopy images compress about 2-3 times.
+
+Stacks are written as ImageJ hyperstacks (TZCYX) unless they are tiled or
+Zstd compressed, which ImageJ can not read; these are written as plain
+multi-page TIFF files with the shape in the description.
+
+The converters (sort_images_nd2.py, sort_images_lif.py) write their single
+plane files with a PlaneWriter. Run as script, an existing TIFF file is
+rewritten with another compression.
+
+Usage:
+	python tiff_writer.py --compression deflate --threads 8 input.tif output.tif
+"""
+
+import os
+import time
+import zlib
+import argparse
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+
+# compression name: TIFF compression of tifffile
+COMPRESSIONS = {"none": None, "lzw": "lzw", "deflate": "zlib", "zstd": "zstd"}
+# zlib level of Deflate (6 is the zlib default, higher levels are much slower for little gain)
+DEFLATE_LEVEL = 6
+# planes (or tiles) encoded ahead of the writer per thread
+QUEUE_PER_THREAD = 2
+
+
+def get_encoder(compression):
+	"""
+	Function encoding bytes with the compression ("none", "lzw", "deflate" or "zstd").
+	Raises ValueError for unknown and ImportError for unavailable compressions.
+	"""
+	if compression not in COMPRESSIONS:
+		raise ValueError(f"Unknown compression {compression}, use one of {', '.join(COMPRESSIONS)}")
+	if compression == "none":
+		return bytes
+	if compression == "deflate":
+		return lambda data: zlib.compress(data, DEFLATE_LEVEL)
+	try:
+		import imagecodecs
+	except ImportError:
+		raise ImportError(f"{compression} compression needs the imagecodecs package (pip install imagecodecs)")
+	if compression == "lzw":
+		return imagecodecs.lzw_encode
+	return imagecodecs.zstd_encode
+
+
+def use_predictor(compression, dtype):
+	"""
+	Whether segments are encoded with the horizontal differencing predictor.
+	"""
+	return compression != "none" and np.dtype(dtype).kind in "iu"
+
+
+def encode_segment(segment, encoder, predictor):
+	"""
+	Encode one strip or tile (Y, X) as bytes of the TIFF file.
+	"""
+	segment = np.ascontiguousarray(segment)
+	if predictor:
+		# difference of every pixel to its left neighbour (wraps around like the TIFF predictor)
+		diff = np.empty_like(segment)
+		diff[:, 0] = segment[:, 0]
+		np.subtract(segment[:, 1:], segment[:, :-1], out=diff[:, 1:])
+		segment = diff
+	return encoder(segment.tobytes())
+
+
+def split_tiles(plane, tile):
+	"""
+	Tiles (tile_y, tile_x) of the plane in row-major order, zero-padded at the borders.
+	"""
+	ty, tx = tile
+	for y in range(0, plane.shape[0], ty):
+		for x in range(0, plane.shape[1], tx):
+			block = plane[y:y + ty, x:x + tx]
+			if block.shape != (ty, tx):
+				padded = np.zeros((ty, tx), dtype=plane.dtype)
+				padded[:block.shape[0], :block.shape[1]] = block
+				block = padded
+			yield block
+
+
+def encode_ordered(segments, encoder, predictor, threads):
+	"""
+	Encode the segments on a pool of threads and yield the bytes in the order of the segments.
+	At most QUEUE_PER_THREAD segments per thread are encoded ahead.
+	"""
+	threads = max(1, threads or os.cpu_count() or 1)
+	if threads == 1:
+		for segment in segments:
+			yield encode_segment(segment, encoder, predictor)
+		return
+	with ThreadPoolExecutor(max_workers=threads) as pool:
+		pending = deque()
+		for segment in segments:
+			pending.append(pool.submit(encode_segment, segment, encoder, predictor))
+			if len(pending) >= threads * QUEUE_PER_THREAD:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+
+def write_stack(path, planes, shape, dtype, compression="none", tile=None, threads=None, metadata=None):
+	"""
+	Write the planes (iterable of (Y, X) arrays) as one TIFF file.
+
+	shape is the shape of the whole stack, e.g. (T, Z, C, Y, X) for an ImageJ
+	hyperstack (axes in metadata, default TZCYX) or (N, Y, X).
+	tile (tile_y, tile_x), multiples of 16, writes tiles instead of one strip per plane.
+	threads is the number of encoding threads (default: all processors).
+	"""
+	encoder = get_encoder(compression)
+	predictor = use_predictor(compression, dtype)
+	height, width = shape[-2:]
+	if tile:
+		segments = (block for plane in planes for block in split_tiles(plane, tile))
+	else:
+		segments = iter(planes)
+
+	imagej = tile is None and compression != "zstd"
+	if imagej:
+		metadata = metadata or {"axes": "TZCYX"[-len(shape):]}
+	elif metadata is None:
+		metadata = {}
+	kwargs = {"tile": tuple(tile)} if tile else {"rowsperstrip": height}
+	with tifffile.TiffWriter(path, bigtiff=not imagej, imagej=imagej) as tif:
+		tif.write(
+			encode_ordered(segments, encoder, predictor, threads),
+			shape=tuple(shape),
+			dtype=dtype,
+			compression=COMPRESSIONS[compression],
+			predictor=predictor,
+			metadata=metadata,
+			**kwargs,
+		)
+
+
+class PlaneWriter:
+	"""
+	Writes many single-plane TIFF files on a pool of threads; every file is
+	encoded and written by one thread. At most QUEUE_PER_THREAD planes per
+	thread are waiting, so a reader that is faster than the writers is held
+	back instead of filling the memory. Use as context manager to wait for all
+	files (errors of the writers are raised there).
+	"""
+
+	def __init__(self, compression="none", tile=None, threads=None):
+		self.encoder = get_encoder(compression)
+		self.compression = compression
+		self.tile = tile
+		self.threads = max(1, threads or os.cpu_count() or 1)
+		self.pool = ThreadPoolExecutor(max_workers=self.threads)
+		self.pending = deque()
+
+	def write(self, path, plane, done=None):
+		"""
+		Queue the plane (Y, X) to be written to path. done(path) is called by the
+		writing thread once the file is written (not if writing fails).
+		"""
+		while len(self.pending) >= self.threads * QUEUE_PER_THREAD:
+			self.pending.popleft().result()
+		self.pending.append(self.pool.submit(self._write, path, plane, done))
+
+	def _write(self, path, plane, done):
+		write_stack(path, (plane,), plane.shape, plane.dtype, self.compression, self.tile, 1)
+		if done is not None:
+			done(path)
+
+	def flush(self):
+		"""
+		Wait for all queued files, errors of the writers are raised here.
+		"""
+		while self.pending:
+			self.pending.popleft().result()
+
+	def close(self):
+		"""
+		Wait for all queued files.
+		"""
+		try:
+			self.flush()
+		finally:
+			self.pool.shutdown()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def add_arguments(parser):
+	"""
+	Add the --compression and --threads options of the writer to an argument parser.
+	"""
+	parser.add_argument("--compression", default="none", choices=sorted(COMPRESSIONS), help="Lossless compression of the TIFF files (default: none)")
+	parser.add_argument("--threads", type=int, default=None, help="Encoding threads (default: all processors)")
+
+
+def run():
+	"""
+	Run the script with command line arguments.
+	"""
+	logging.basicConfig(level=logging.INFO, format="%(message)s")
+	parser = argparse.ArgumentParser(description="Rewrite a TIFF file with lossless compression, encoded by parallel threads")
+	parser.add_argument("input", help="TIFF file to read")
+	parser.add_argument("output", help="TIFF file to write")
+	add_arguments(parser)
+	parser.add_argument("--tile", type=int, nargs=2, default=None, metavar=("Y", "X"), help="Tile size (multiples of 16, not readable by ImageJ)")
+	args = parser.parse_args()
+
+	with tifffile.TiffFile(args.input) as tif:
+		series = tif.series[0]
+		shape, dtype = series.shape, series.dtype
+		metadata = {"axes": series.axes} if tif.is_imagej else None
+		if metadata is None:
+			shape = (len(series.pages),) + shape[-2:]
+		planes = (page.asarray() for page in series.pages)
+		start = time.perf_counter()
+		write_stack(args.output, planes, shape, dtype, args.compression, args.tile, args.threads, metadata)
+		duration = time.perf_counter() - start
+
+	ratio = os.path.getsize(args.input) / os.path.getsize(args.output)
+	logging.info(f"Wrote {args.output} in {duration:.1f} s, {ratio:.2f}x smaller than {args.input}")
+
+
+if __name__ == "__main__":
+	run()
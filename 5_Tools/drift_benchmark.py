@@ -0,0 +1,289 @@
+"""
+Drift Correction Benchmark
+
+This script generates synthetic 2D and 3D time-lapses with known drift and
+measures how fast and how accurately drift_correction_np.py recovers it.
+
+The frames are crops of a larger textured volume (blurred noise with bright
+blobs as cells), translated by the ground truth drift with a Fourier shift, so
+integer and sub-pixel drifts are both exact. Drift models:
+	integer   random walk of full pixels
+	subpixel  random walk with fractional steps
+	slow      constant slow drift (fraction of a pixel per frame)
+	fast      random walk with large steps
+Gaussian noise is added relative to the standard deviation of the texture.
+
+For every mode (integer, subpixel, multi-time-scale, global solve, pyramid,
+ROI, edge-enhanced, and registration in RAM versus into a memory-mapped
+file) the harness reports frames per second, the peak memory allocated
+during the run (tracemalloc) and the RMS error of the shifts in pixels.
+For the registration modes it is the residual misalignment of the registered
+frames: the shift of every registered frame relative to the first one,
+measured to 1/100 pixel on the field of view of all frames.
+
+With --save the synthetic time-lapse is written as ImageJ TIFF together with
+the ground truth shifts (in the format of drift_correction.save_shifts()),
+to benchmark drift_correction.py in FIJI on the same data. drift_benchmark_fiji.py
+writes the integer shifts of drift_correction.py next to it (<time-lapse>_fiji.txt);
+--compare checks them against drift_correction_np.py (see FIJI_TOLERANCE there).
+
+Usage:
+	python drift_benchmark.py --size 256 --frames 40 --drift subpixel --noise 0.2
+	python drift_benchmark.py --suite
+	python drift_benchmark.py --compare FOLDER/synthetic_integer_256x256x1_t40.tif
+"""
+
+import os
+import time
+import argparse
+import logging
+import tempfile
+import tracemalloc
+import numpy as np
+
+import drift_correction_np as dc
+
+# margin (pixels) of the textured volume around the field of view
+MARGIN = 32
+# steps (pixels per frame) of the drift models
+DRIFT_STEPS = {"integer": 2.0, "subpixel": 1.0, "slow": 0.3, "fast": 8.0}
+# all benchmark modes
+MODES = ["integer", "subpixel", "multi_time_scale", "global_solve", "pyramid", "roi", "edge", "register_ram", "register_file"]
+# precision (1/pixels) of the residual shifts of registered frames
+RESIDUAL_UPSAMPLE = 100
+
+
+def make_drift(nt, kind, ndim=2, rng=None):
+	"""
+	Ground truth drift (T, 3) with columns dx, dy, dz; the first frame is at 0.
+	3D drifts move in z at a sixth of the lateral step.
+	"""
+	rng = rng or np.random.default_rng()
+	step = DRIFT_STEPS[kind]
+	if kind == "slow":
+		direction = rng.normal(size=3)
+		steps = np.tile(step * direction / np.linalg.norm(direction[:2]), (nt, 1))
+	else:
+		steps = rng.normal(0, step, (nt, 3))
+	if kind == "integer":
+		steps = np.round(steps)
+	steps[0] = 0
+	steps[:, 2] = steps[:, 2] / 6 if ndim == 3 else 0
+	drift = np.cumsum(steps, axis=0)
+	if kind == "integer":
+		drift[:, 2] = np.round(drift[:, 2])
+	return drift
+
+
+def make_texture(shape, rng=None, cells=200):
+	"""
+	Textured volume (Z, Y, X): blurred noise with bright blobs, values in [0, 1].
+	"""
+	from scipy import ndimage
+
+	rng = rng or np.random.default_rng()
+	sigma = [1 if n > 1 else 0 for n in shape]
+	texture = ndimage.gaussian_filter(rng.random(shape), [2 * s for s in sigma])
+	blobs = np.zeros(shape)
+	idx = tuple(rng.integers(0, n, cells) for n in shape)
+	blobs[idx] = 1
+	blobs = ndimage.gaussian_filter(blobs, [3 * s for s in sigma])
+	texture = (texture - texture.min()) / np.ptp(texture) + 4 * blobs / blobs.max()
+	return texture / texture.max()
+
+
+def fourier_shift(img, shift):
+	"""
+	Translate img (Z, Y, X) by the (x, y, z) shift (periodic).
+	"""
+	f = np.fft.fftn(img)
+	for axis, s in zip((2, 1, 0), shift):
+		k = np.fft.fftfreq(img.shape[axis])
+		shape = [1, 1, 1]
+		shape[axis] = -1
+		f *= np.exp(-2j * np.pi * s * k).reshape(shape)
+	return np.fft.ifftn(f).real
+
+
+def make_time_lapse(nt=40, size=256, nz=1, kind="subpixel", noise=0.05, channels=1, seed=0):
+	"""
+	Synthetic time-lapse (T, C, Z, Y, X) uint16 and its ground truth drift (T, 3).
+	"""
+	rng = np.random.default_rng(seed)
+	ndim = 3 if nz > 1 else 2
+	drift = make_drift(nt, kind, ndim, rng)
+	drift -= drift.mean(axis=0).round()
+	margin = int(np.abs(drift).max()) + MARGIN
+	zmargin = margin if ndim == 3 else 0
+	texture = make_texture((nz + 2 * zmargin, size + 2 * margin, size + 2 * margin), rng)
+
+	data = np.empty((nt, channels, nz, size, size), dtype=np.uint16)
+	sigma = noise * texture.std()
+	for t in range(nt):
+		frame = fourier_shift(texture, drift[t])
+		frame = frame[zmargin:zmargin + nz, margin:margin + size, margin:margin + size]
+		for c in range(channels):
+			noisy = frame + rng.normal(0, sigma, frame.shape)
+			data[t, c] = np.clip(noisy * 3000 + 500, 0, 65535).astype(np.uint16)
+	return data, drift
+
+
+def rms_error(shifts, drift, ndim):
+	"""
+	RMS error (pixels) of the shifts of all frames relative to the first frame.
+	"""
+	err = (shifts - shifts[0]) - (drift - drift[0])
+	return float(np.sqrt(np.mean(np.sum(err[:, :ndim] ** 2, axis=1))))
+
+
+def residual_error(registered, correction, shape, ndim):
+	"""
+	RMS residual misalignment (pixels) of the registered frames (T, C, Z, Y, X) of
+	register_stack() without crop, for the original frame shape (..., Z, Y, X):
+	the shifts between the registered frames and the first one, measured on the
+	field of view of all frames (without the interpolated border pixels).
+	"""
+	correction = np.asarray(correction, dtype=np.float64)
+	lo, hi = correction.min(axis=0), correction.max(axis=0)
+	size = np.array(shape[-1:-4:-1], dtype=np.float64)
+	margin = np.array([1, 1, 1 if ndim == 3 else 0])
+	# every frame covers [correction - lo, correction - lo + size) of the canvas
+	start = (np.ceil(hi - lo - 1e-6) + margin).astype(int)
+	stop = (size - margin).astype(int)
+	field = registered[:, 0, start[2]:stop[2], start[1]:stop[1], start[0]:stop[0]].astype(np.float64)
+	residual = np.array([dc.compute_stitch(frame, field[0], upsample=RESIDUAL_UPSAMPLE) for frame in field])
+	return rms_error(residual, np.zeros_like(residual), ndim)
+
+
+def measure(func):
+	"""
+	Run func() and return its result, the run time (s) and the peak memory (MB).
+	"""
+	tracemalloc.start()
+	start = time.perf_counter()
+	result = func()
+	duration = time.perf_counter() - start
+	peak = tracemalloc.get_traced_memory()[1] / 1e6
+	tracemalloc.stop()
+	return result, duration, peak
+
+
+def run_mode(mode, data, drift, threads=1):
+	"""
+	Benchmark one mode on the time-lapse and return fps, peak memory and RMS error.
+	"""
+	nt, _, nz, ny, nx = data.shape
+	ndim = 3 if nz > 1 else 2
+	stack = data[:, 0]
+	options = {
+		"integer": {},
+		"subpixel": {"upsample": 10},
+		"multi_time_scale": {"multi_time_scale": True},
+		"global_solve": {"multi_time_scale": True, "global_solve": True},
+		"pyramid": {"pyramid": 2, "upsample": 10},
+		"roi": {"roi": (nx // 4, ny // 4, nx // 2, ny // 2)},
+		"edge": {"process": True},
+	}
+	if mode in options:
+		shifts, duration, peak = measure(lambda: dc.compute_shifts(stack, threads=threads, **options[mode]))
+		if mode == "integer":
+			shifts = dc.convert_shifts_to_integer(shifts)
+		return nt / duration, peak, rms_error(shifts, drift, ndim)
+
+	# registration with sub-pixel shifts, only the registration is measured
+	shifts = dc.compute_shifts(stack, threads=threads, upsample=10)
+	correction = dc.invert_shifts(shifts)
+	if mode == "register_ram":
+		registered, duration, peak = measure(lambda: dc.register_stack(data, correction, threads=threads))
+	else:
+		import tifffile
+
+		path = os.path.join(tempfile.mkdtemp(), "registered.tif")
+		_, duration, peak = measure(lambda: dc.save_registered(path, data, correction, threads=threads))
+		canvas = dc.registered_shape(data.shape, correction)[0]
+		# the file is an ImageJ hyperstack (T, Z, C, Y, X)
+		registered = np.array(tifffile.memmap(path)).reshape((nt, canvas[0], data.shape[1]) + canvas[1:]).transpose(0, 2, 1, 3, 4)
+		os.remove(path)
+	return nt / duration, peak, residual_error(registered, correction, data.shape, ndim)
+
+
+def run_benchmark(data, drift, modes, threads=1, label=""):
+	"""
+	Benchmark the modes and print one line per mode.
+	"""
+	for mode in modes:
+		fps, peak, rms = run_mode(mode, data, drift, threads)
+		print(f"{label:<24}{mode:<18}{fps:>10.1f}{peak:>12.1f}{rms:>10.3f}")
+
+
+def compare_fiji(file_path, threads=1):
+	"""
+	Compare the integer shifts of drift_correction_np.py (channel 1) with those of
+	drift_correction.py written by drift_benchmark_fiji.py and with the ground truth.
+	Returns True if they agree within dc.FIJI_TOLERANCE.
+	"""
+	base = os.path.splitext(file_path)[0]
+	_, fiji = dc.read_shifts(base + "_fiji.txt")
+	_, truth = dc.read_shifts(base + "_truth.txt")
+	data = dc.load_hyperstack(file_path)
+	ndim = 3 if data.shape[2] > 1 else 2
+	shifts = dc.convert_shifts_to_integer(dc.invert_shifts(dc.compute_shifts(data[:, 0], threads=threads)))
+	difference = dc.step_difference(shifts, fiji)
+	print(f"{os.path.basename(file_path)}: {len(shifts)} frames")
+	print(f"RMS error NumPy {rms_error(shifts, truth, ndim):.3f} px, FIJI {rms_error(fiji, truth, ndim):.3f} px")
+	print(f"largest difference of the shift between consecutive frames: {difference:.0f} px (tolerance {dc.FIJI_TOLERANCE} px)")
+	return difference <= dc.FIJI_TOLERANCE
+
+
+def header():
+	print(f"{'data':<24}{'mode':<18}{'frames/s':>10}{'peak MB':>12}{'RMS px':>10}")
+
+
+def run():
+	"""
+	Run the script with command line arguments.
+	"""
+	logging.basicConfig(level=logging.WARNING)
+	parser = argparse.ArgumentParser(description="Benchmark drift_correction_np on synthetic time-lapses with known drift")
+	parser.add_argument("--frames", type=int, default=40, help="Number of frames")
+	parser.add_argument("--size", type=int, default=256, help="Width and height of the frames")
+	parser.add_argument("--z", type=int, default=1, help="Number of z-planes (>1 for 3D)")
+	parser.add_argument("--drift", default="subpixel", choices=sorted(DRIFT_STEPS), help="Drift model")
+	parser.add_argument("--noise", type=float, default=0.1, help="Standard deviation of the noise relative to that of the texture")
+	parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES, help="Modes to benchmark")
+	parser.add_argument("--threads", type=int, default=os.cpu_count(), help="Threads for drift computation and registration")
+	parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator")
+	parser.add_argument("--suite", action="store_true", help="Benchmark all drift models on small 2D and 3D time-lapses")
+	parser.add_argument("--save", default=None, metavar="FOLDER", help="Only save the time-lapse and its ground truth shifts for FIJI")
+	parser.add_argument("--compare", default=None, metavar="TIFF", help="Only compare the shifts of drift_benchmark_fiji.py for this saved time-lapse")
+	args = parser.parse_args()
+
+	if args.compare:
+		if not compare_fiji(args.compare, args.threads):
+			raise SystemExit(1)
+		return
+
+	if args.save:
+		import tifffile
+
+		data, drift = make_time_lapse(args.frames, args.size, args.z, args.drift, args.noise, seed=args.seed)
+		name = f"synthetic_{args.drift}_{args.size}x{args.size}x{args.z}_t{args.frames}"
+		os.makedirs(args.save, exist_ok=True)
+		tifffile.imwrite(os.path.join(args.save, name + ".tif"), np.transpose(data, (0, 2, 1, 3, 4)), imagej=True, metadata={'axes': 'TZCYX'})
+		nt, _, nz, ny, nx = data.shape
+		dc.save_shifts(os.path.join(args.save, name + "_truth.txt"), dc.invert_shifts(drift), [0, 0, 0, nx - 1, ny - 1, nz - 1])
+		print(f"Saved {name} to {args.save}")
+		return
+
+	header()
+	if args.suite:
+		for nz in (1, 16):
+			for kind in sorted(DRIFT_STEPS):
+				data, drift = make_time_lapse(20, 128, nz, kind, args.noise, seed=args.seed)
+				run_benchmark(data, drift, args.modes, args.threads, f"{kind} {'3D' if nz > 1 else '2D'}")
+	else:
+		data, drift = make_time_lapse(args.frames, args.size, args.z, args.drift, args.noise, seed=args.seed)
+		run_benchmark(data, drift, args.modes, args.threads, f"{args.drift} {args.size}x{args.size}x{args.z}")
+
+if __name__ == "__main__":
+	run()
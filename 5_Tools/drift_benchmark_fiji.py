@@ -0,0 +1,235 @@
+#title           : drift_benchmark_fiji.py
+#description     : Benchmarks drift_correction.py on a synthetic time-lapse written by
+#					drift_benchmark.py --save (the image and its _truth.txt shifts).
+#					Reports frames per second, peak heap memory and RMS shift error
+#					for every mode; for the registration modes the RMS residual
+#					misalignment of the registered frames relative to frame 1 (in x
+#					and y on the middle z plane, to about 0.1 pixel). The drift
+#					computation of drift_correction.py is integer only, sub-pixel
+#					shifts are only applied by the registration.
+#					The shifts of the integer mode are saved as <image>_fiji.txt, to
+#					compare them with drift_correction_np.py (drift_benchmark.py --compare).
+#					Must be run with the drift_correction.py script in the same folder
+#date            : 2026/10/18
+#version         :
+#usage           :
+#notes           :
+#python_version  : ImageJ
+
+#=======================================================================
+
+import os
+import sys
+import time
+import math
+import tempfile
+from ij import IJ
+from ij.gui import Roi
+from ij.process import Blitter
+from java.lang import Runtime
+from java.lang.management import ManagementFactory, MemoryType
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, SCRIPT_PATH)
+
+import drift_correction
+
+#@ File (label="Synthetic time-lapse (drift_benchmark.py --save):", style="file") IMG_FILE
+
+
+MODES = ['integer', 'multi_time_scale', 'global_solve', 'adaptive', 'pyramid', 'projections', 'roi', 'edge', 'register_ram', 'register_virtual', 'register_subpixel']
+
+
+def reset_peak_memory():
+	for pool in ManagementFactory.getMemoryPoolMXBeans():
+		pool.resetPeakUsage()
+
+
+def peak_memory():
+	'''
+	peak heap usage (MB) since reset_peak_memory()
+	'''
+	used = 0
+	for pool in ManagementFactory.getMemoryPoolMXBeans():
+		if pool.getType() == MemoryType.HEAP:
+			used += pool.getPeakUsage().getUsed()
+	return used / 1e6
+
+
+def compute_shifts(imp, multi_time_scale=False, global_solve=False, process=False, pyramid=1, projections=False, adaptive=False):
+	'''
+	correction shifts of channel 1 as computed by auto_run()
+	'''
+	threads = Runtime.getRuntime().availableProcessors()
+	z_max = imp.getNSlices()
+	cache = drift_correction.FrameCache()
+	if adaptive:
+		shifts = drift_correction.compute_frame_translations_adaptive(imp, 1, process, 0, 1, z_max, cache, threads, pyramid, projections)
+	else:
+		shifts = drift_correction.compute_and_update_frame_translations_dt(imp, 1, 1, process, 0, 1, z_max, None, cache, threads, pyramid, projections)
+	if multi_time_scale and global_solve:
+		shifts = drift_correction.compute_frame_translations_global(imp, 1, process, 0, 1, z_max, shifts, cache, threads, pyramid, projections)
+	elif multi_time_scale:
+		for dt in drift_correction.multi_time_scales(imp.getNFrames()):
+			shifts = drift_correction.compute_and_update_frame_translations_dt(imp, 1, dt, process, 0, 1, z_max, shifts, cache, threads, pyramid, projections)
+	return drift_correction.invert_shifts(shifts)
+
+
+def rms_error(shifts, truth):
+	'''
+	RMS error (pixels) of the shifts of all frames relative to the first frame
+	'''
+	total = 0.0
+	for s, t in zip(shifts, truth):
+		dx = (s.x - shifts[0].x) - (t.x - truth[0].x)
+		dy = (s.y - shifts[0].y) - (t.y - truth[0].y)
+		dz = (s.z - shifts[0].z) - (t.z - truth[0].z)
+		total += dx*dx + dy*dy + dz*dz
+	return math.sqrt(total / len(shifts))
+
+
+# steps (pixels) of the search for the residual shift of a registered frame
+RESIDUAL_STEPS = 10
+
+
+def correlation(ip1, ip2, dx, dy, margin=1):
+	'''
+	normalized cross correlation of ip1 and ip2 translated by (dx, dy) on their overlap,
+	without margin pixels at the borders (interpolated by the sub-pixel registration)
+	'''
+	width, height = ip1.getWidth(), ip1.getHeight()
+	x0, y0 = max(0, dx) + margin, max(0, dy) + margin
+	x1, y1 = min(width, width + dx) - margin, min(height, height + dy) - margin
+	if x1 - x0 < 2 or y1 - y0 < 2:
+		return -1.0
+	ip1.setRoi(x0, y0, x1 - x0, y1 - y0)
+	a = ip1.crop().convertToFloat()
+	ip1.resetRoi()
+	ip2.setRoi(x0 - dx, y0 - dy, x1 - x0, y1 - y0)
+	b = ip2.crop().convertToFloat()
+	ip2.resetRoi()
+
+	def mean_product(p, q):
+		r = p.duplicate()
+		r.copyBits(q, 0, 0, Blitter.MULTIPLY)
+		return r.getStatistics().mean
+
+	ma, mb = a.getStatistics().mean, b.getStatistics().mean
+	den = math.sqrt(max(mean_product(a, a) - ma*ma, 0) * max(mean_product(b, b) - mb*mb, 0))
+	if den == 0:
+		return 0.0
+	return (mean_product(a, b) - ma*mb) / den
+
+
+def residual_shift(ip1, ip2):
+	'''
+	sub-pixel shift (dx, dy) of ip2 relative to ip1: the integer shift of the highest
+	cross correlation (searched from no shift), refined by a parabola in x and y
+	'''
+	best = (0, 0)
+	r = correlation(ip1, ip2, 0, 0)
+	for step in range(RESIDUAL_STEPS):
+		moved = False
+		for sx, sy in [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]:
+			c = correlation(ip1, ip2, best[0] + sx, best[1] + sy)
+			if c > r:
+				candidate, r, moved = (best[0] + sx, best[1] + sy), c, True
+		if not moved:
+			break
+		best = candidate
+	shift = []
+	for axis in range(2):
+		lower = list(best)
+		upper = list(best)
+		lower[axis] -= 1
+		upper[axis] += 1
+		rl = correlation(ip1, ip2, lower[0], lower[1])
+		ru = correlation(ip1, ip2, upper[0], upper[1])
+		curvature = rl - 2*r + ru
+		shift.append(best[axis] + (0.5 * (rl - ru) / curvature if curvature < 0 else 0.0))
+	return shift
+
+
+def residual_error(registered):
+	'''
+	RMS residual misalignment (pixels) of the registered frames relative to frame 1,
+	measured on channel 1 and the middle z plane
+	'''
+	stack = registered.getStack()
+	z = (registered.getNSlices() + 1) // 2
+	reference = stack.getProcessor(registered.getStackIndex(1, z, 1))
+	total = 0.0
+	for t in range(1, registered.getNFrames() + 1):
+		dx, dy = residual_shift(reference, stack.getProcessor(registered.getStackIndex(1, z, t)))
+		total += dx*dx + dy*dy
+	return math.sqrt(total / registered.getNFrames())
+
+
+def copy_shifts(shifts):
+	# registration makes the shifts relative to the canvas
+	return [type(s)(s.x, s.y, s.z) for s in shifts]
+
+
+def run_mode(mode, imp, truth):
+	'''
+	returns the computed shifts and the registered image (None if only computed),
+	the shifts of the registration modes are those applied
+	'''
+	if mode == 'integer':
+		return drift_correction.convert_shifts_to_integer(compute_shifts(imp)), None
+	if mode == 'multi_time_scale':
+		return compute_shifts(imp, multi_time_scale=True), None
+	if mode == 'global_solve':
+		return compute_shifts(imp, multi_time_scale=True, global_solve=True), None
+	if mode == 'adaptive':
+		return compute_shifts(imp, adaptive=True), None
+	if mode == 'pyramid':
+		return compute_shifts(imp, pyramid=2), None
+	if mode == 'projections':
+		return compute_shifts(imp, projections=True), None
+	if mode == 'edge':
+		return compute_shifts(imp, process=True), None
+	if mode == 'roi':
+		imp.setRoi(Roi(imp.getWidth()/4, imp.getHeight()/4, imp.getWidth()/2, imp.getHeight()/2))
+		shifts = compute_shifts(imp)
+		imp.deleteRoi()
+		return shifts, None
+
+	# registration with the ground truth, cropped to the field of view of all frames,
+	# only the registration is measured
+	if mode == 'register_subpixel':
+		return truth, drift_correction.register_hyperstack_subpixel(imp, 1, copy_shifts(truth), None, False, False, True)
+	shifts = drift_correction.convert_shifts_to_integer(truth)
+	if mode == 'register_virtual':
+		return shifts, drift_correction.register_hyperstack(imp, 1, copy_shifts(shifts), tempfile.mkdtemp(), True, False, True)
+	return shifts, drift_correction.register_hyperstack(imp, 1, copy_shifts(shifts), None, False, False, True)
+
+
+if __name__ == '__main__':
+
+	img_file = str(IMG_FILE)
+	roi, truth = drift_correction.read_shifts(os.path.splitext(img_file)[0] + '_truth.txt')
+	imp = IJ.openImage(img_file)
+
+	IJ.log('\n-- {0:-<80}'.format('DRIFT BENCHMARK'))
+	IJ.log('    {0}: {1} frames of {2}x{3}x{4}'.format(os.path.basename(img_file), imp.getNFrames(), imp.getWidth(), imp.getHeight(), imp.getNSlices()))
+	IJ.log('    {0:<20}{1:>10}{2:>12}{3:>10}'.format('mode', 'frames/s', 'peak MB', 'RMS px'))
+
+	for mode in MODES:
+		reset_peak_memory()
+		start = time.time()
+		shifts, registered = run_mode(mode, imp, truth)
+		duration = time.time() - start
+		peak = peak_memory()
+		if mode == 'integer':
+			drift_correction.write_shifts(os.path.splitext(img_file)[0] + '_fiji.txt', shifts, roi)
+		if registered is not None:
+			error = residual_error(registered)
+		else:
+			error = rms_error(shifts, truth)
+		IJ.log('    {0:<20}{1:>10.1f}{2:>12.1f}{3:>10.3f}'.format(mode, imp.getNFrames() / duration, peak, error))
+		if registered is not None:
+			registered.close()
+
+	imp.close()
+	IJ.log('-----------------------------END-----------------------------')
@@ -0,0 +1,1068 @@
+"""
+Headless Drift Correction (NumPy)
+
+This script computes the drift of a time-lapse without Fiji, a JVM or a display.
+It mirrors the drift computation of drift_correction.py: the same preprocessing
+(z-range, ROI crop, background subtraction, edge enhancement), the same phase
+correlation with verification of the best peaks by cross correlation and the
+same update of the shift table for every frame shift dt (including the
+multi-time-scale passes and the ROI that follows the drift).
+
+Input stacks are NumPy arrays of shape (T, Z, Y, X) for the channel used for
+registration. Shift tables are (T, 3) float arrays with the columns dx, dy, dz,
+i.e. the same values compute_and_update_frame_translations_dt() stores in its
+list of Point3f. As in drift_correction.py the shifts are the measured drift;
+use invert_shifts() to turn them into a correction.
+
+The Fourier transforms of all frames are computed as batched real FFTs whenever
+the frames do not depend on the shifts (no ROI). Preprocessed frames and their
+spectra are kept in a bounded FrameCache, so every frame is processed and
+transformed only once per dt pass.
+
+register_stack() applies a (subpixel) correction to a whole (T, C, Z, Y, X)
+array. Frames are translated in batches, either by n-linear interpolation (as
+register_hyperstack_subpixel() in drift_correction.py) or by a Fourier shift,
+and written straight into a preallocated output, e.g. a memory-mapped TIFF.
+
+Tolerance:
+	On the integer path (no upsample, pyramid 1) the shift between two
+	consecutive frames differs by at most FIJI_TOLERANCE = 1 pixel in x, y
+	and z from that of drift_correction.py. The shifts are not guaranteed to
+	be identical: the verified peak is moved to the neighbouring shift with
+	the highest cross correlation, which the Fiji script does not do, and the
+	border extension used before the FFT and the rounding of 8/16-bit images
+	in the Fiji edge filters differ. On synthetic time-lapses with known
+	integer drift the shifts are exact. To compare with the Fiji script:
+		python drift_benchmark.py --save FOLDER
+		(run drift_benchmark_fiji.py in Fiji on the saved time-lapse)
+		python drift_benchmark.py --compare FOLDER/<time-lapse>.tif
+
+Usage:
+	python drift_correction_np.py [path_to_tif] --channel 1 --multi_time_scale
+"""
+
+import os
+import argparse
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# number of frames that are Fourier transformed together
+FFT_BATCH = 8
+# number of preprocessed frames (and their spectra) kept in a FrameCache
+CACHE_SIZE = 32
+# number of phase correlation peaks verified with cross correlation (as in PhaseCorrelation(..., 5, True))
+NUM_PEAKS = 5
+# relative extension of the images before the FFT
+RELATIVE_EXTENSION = 0.1
+# minimal overlap (fraction of pixels) for a peak to be verified
+MIN_OVERLAP = 0.1
+# steps of the hill climb of the verified peak on the cross correlation
+PEAK_CLIMB_STEPS = 4
+# size (in x and y) of the full resolution crop used to refine pyramid shifts
+REFINE_CROP = 256
+# smallest downsampled frame size (pixels in x and y) of the pyramid, as in drift_correction.py
+PYRAMID_MIN_SIZE = 64
+# number of frames that are translated together by register_stack()
+TRANSLATE_BATCH = 8
+# border (pixels) added around the frames for Fourier shifts to avoid wrap around
+FOURIER_PAD = 8
+# maximal difference (pixels) of the shift between consecutive frames to drift_correction.py (integer path)
+FIJI_TOLERANCE = 1
+
+
+def load_hyperstack(file_path):
+	"""
+	Read a TIFF file as (T, C, Z, Y, X) array.
+	"""
+	import tifffile
+
+	with tifffile.TiffFile(file_path) as tif:
+		series = tif.series[0]
+		data = series.asarray()
+		axes = series.axes
+
+	return to_tczyx(data, axes)
+
+
+def to_tczyx(data, axes):
+	"""
+	Reorder an array with the given axes string (e.g. 'TZCYX') to (T, C, Z, Y, X).
+	Missing axes are added with length 1.
+	"""
+	axes = axes.upper().replace('Q', 'T').replace('I', 'Z')
+	for ax in 'TCZYX':
+		if ax not in axes:
+			data = data[np.newaxis]
+			axes = ax + axes
+
+	return np.transpose(data, [axes.index(ax) for ax in 'TCZYX'])
+
+
+def fast_length(n):
+	"""
+	Smallest integer >= n without prime factors larger than 5.
+	"""
+	m = max(int(n), 1)
+	while True:
+		r = m
+		for p in (2, 3, 5):
+			while r % p == 0:
+				r //= p
+		if r == 1:
+			return m
+		m += 1
+
+
+# scratch buffers of every thread, reused across frames of the same size
+_buffers = threading.local()
+
+
+def work_buffer(name, shape):
+	"""
+	float32 scratch buffer of the calling thread, reused while the shape does not change.
+	"""
+	buf = getattr(_buffers, name, None)
+	if buf is None or buf.shape != shape:
+		buf = np.empty(shape, dtype=np.float32)
+		setattr(_buffers, name, buf)
+	return buf
+
+
+def neighbour_count(shape):
+	"""
+	Number of pixels averaged by the mean filter in x and y (the pixel and its four direct
+	neighbours within the image) at every position of a (Y, X) plane.
+	"""
+	count = getattr(_buffers, 'count', None)
+	if count is None or count.shape != shape:
+		count = np.full(shape, 5, dtype=np.float32)
+		count[0, :] -= 1
+		count[-1, :] -= 1
+		count[:, 0] -= 1
+		count[:, -1] -= 1
+		_buffers.count = count
+	return count
+
+
+def extract_frame_process_roi(stack, frame, process, background, roi, z_min, z_max):
+	"""
+	Extract the z-planes z_min..z_max (1-based, inclusive) of a frame (0-based) as float32,
+	crop them to the roi (x, y, width, height), subtract the background and enhance edges.
+	With edge enhancement the planes are copied once into a padded scratch buffer, where
+	background subtraction, the mean filter in x and y ("Mean 3D..." with x=1 y=1 z=0) and
+	a separable Sobel filter ("Find Edges") run in place.
+	"""
+	src = stack[frame, int(z_min) - 1:int(z_max)]
+	# check for roi and crop
+	if roi is not None:
+		x, y, w, h = [int(v) for v in roi]
+		src = src[:, y:y + h, x:x + w]
+	clip = background > 0 and stack.dtype.kind in 'ui'
+	if not process:
+		img = np.array(src, dtype=np.float32)
+		# subtract background (integer images are clipped at 0 as in ImageJ)
+		if background > 0:
+			img -= background
+			if clip:
+				np.maximum(img, 0, out=img)
+		return img
+
+	nz, ny, nx = src.shape
+	pad = work_buffer('pad', (nz, ny + 2, nx + 2))
+	inner = pad[:, 1:-1, 1:-1]
+	inner[...] = src
+	if background > 0:
+		inner -= background
+		if clip:
+			np.maximum(inner, 0, out=inner)
+
+	# mean of the pixel and its neighbours within the image (zero border)
+	pad[:, 0, :] = 0
+	pad[:, -1, :] = 0
+	pad[:, :, 0] = 0
+	pad[:, :, -1] = 0
+	mean = work_buffer('mean', (nz, ny, nx))
+	np.add(inner, pad[:, :-2, 1:-1], out=mean)
+	mean += pad[:, 2:, 1:-1]
+	mean += pad[:, 1:-1, :-2]
+	mean += pad[:, 1:-1, 2:]
+	mean /= neighbour_count((ny, nx))
+
+	# Sobel with the edge pixels repeated at the border, as [1, 2, 1] smoothing and [1, 0, -1] difference
+	inner[...] = mean
+	pad[:, 0, :] = pad[:, 1, :]
+	pad[:, -1, :] = pad[:, -2, :]
+	pad[:, :, 0] = pad[:, :, 1]
+	pad[:, :, -1] = pad[:, :, -2]
+	smooth = work_buffer('smooth_y', (nz, ny, nx + 2))
+	np.add(pad[:, :-2], pad[:, 2:], out=smooth)
+	smooth += 2 * pad[:, 1:-1]
+	gx = smooth[..., :-2] - smooth[..., 2:]
+	smooth = work_buffer('smooth_x', (nz, ny + 2, nx))
+	np.add(pad[..., :-2], pad[..., 2:], out=smooth)
+	smooth += 2 * pad[..., 1:-1]
+	gy = smooth[:, :-2] - smooth[:, 2:]
+
+	gx *= gx
+	gy *= gy
+	gx += gy
+	return np.sqrt(gx, out=gx)
+
+
+def spatial_axes(img):
+	"""
+	Frames with a single z-plane are treated as 2D images (dz = 0).
+	"""
+	return img[0] if img.shape[0] == 1 else img
+
+
+def extended_shape(shape1, shape2):
+	"""
+	Common FFT size of two images extended by RELATIVE_EXTENSION on every side.
+	"""
+	return tuple(fast_length(max(a, b) * (1 + 2 * RELATIVE_EXTENSION)) for a, b in zip(shape1, shape2))
+
+
+def extend(img, shape):
+	"""
+	Extend an image (or a batch of images in the leading axis) to shape by mirroring
+	and fading the mirrored pixels out to the image mean, which avoids the
+	discontinuities at the border of the periodic FFT.
+	"""
+	nd = len(shape)
+	lead = img.ndim - nd
+	pads = []
+	for n, m in zip(img.shape[lead:], shape):
+		before = (m - n) // 2
+		pads.append((before, m - n - before))
+	mean = img.mean(axis=tuple(range(lead, img.ndim)), keepdims=True)
+	out = np.pad(img - mean, [(0, 0)] * lead + pads, mode='symmetric' if max(img.shape[lead:]) > 1 else 'edge')
+	for i, ((before, after), n) in enumerate(zip(pads, img.shape[lead:])):
+		if before + after == 0:
+			continue
+		w = np.ones(n + before + after, dtype=np.float32)
+		if before:
+			w[:before] = 0.5 - 0.5 * np.cos(np.pi * np.arange(before) / before)
+		if after:
+			w[n + before:] = 0.5 + 0.5 * np.cos(np.pi * np.arange(1, after + 1) / after)
+		out *= w.reshape([-1 if j == lead + i else 1 for j in range(out.ndim)])
+
+	return out, [p[0] for p in pads]
+
+
+def spectra(imgs, shape):
+	"""
+	Normalized real Fourier transforms of a batch of images (N, ...) extended to shape.
+	"""
+	axes = tuple(range(1, len(shape) + 1))
+	out = []
+	for i in range(0, len(imgs), FFT_BATCH):
+		ext, _ = extend(np.asarray(imgs[i:i + FFT_BATCH], dtype=np.float32), shape)
+		f = np.fft.rfftn(ext, axes=axes)
+		f /= np.maximum(np.abs(f), 1e-12)
+		out.append(f.astype(np.complex64))
+
+	return np.concatenate(out)
+
+
+def overlap(img1, img2, shift):
+	"""
+	Overlapping parts of img1 at x+shift and img2 at x.
+	"""
+	s1 = []
+	s2 = []
+	for d, n1, n2 in zip(shift, img1.shape, img2.shape):
+		lo = max(0, -d)
+		hi = min(n2, n1 - d)
+		if hi <= lo:
+			return None, None
+		s1.append(slice(lo + d, hi + d))
+		s2.append(slice(lo, hi))
+
+	return img1[tuple(s1)], img2[tuple(s2)]
+
+
+def cross_correlation(img1, img2, shift):
+	"""
+	Pearson correlation of the overlapping pixels of both images for the given shift.
+	"""
+	a, b = overlap(img1, img2, shift)
+	if a is None or a.size < MIN_OVERLAP * min(img1.size, img2.size) or a.size < 2:
+		return -1.0
+	a = a - a.mean()
+	b = b - b.mean()
+	den = np.sqrt((a * a).sum() * (b * b).sum())
+	if den == 0:
+		return 0.0
+
+	return float((a * b).sum() / den)
+
+
+def pcm_peaks(pcm, num_peaks=NUM_PEAKS):
+	"""
+	Positions of the num_peaks highest local maxima of the (periodic) phase correlation matrix.
+	"""
+	is_max = np.ones(pcm.shape, dtype=bool)
+	for ax in range(pcm.ndim):
+		if pcm.shape[ax] > 1:
+			is_max &= pcm >= np.roll(pcm, 1, axis=ax)
+			is_max &= pcm >= np.roll(pcm, -1, axis=ax)
+	idx = np.flatnonzero(is_max)
+	idx = idx[np.argsort(pcm.flat[idx])[::-1][:num_peaks]]
+
+	return [np.unravel_index(i, pcm.shape) for i in idx]
+
+
+def verify_peaks(peaks, pcm_shape, img1, img2):
+	"""
+	Test all periodic interpretations of each peak with cross correlation and
+	return the shift (in image axis order) with the highest correlation and its R.
+	"""
+	best = (tuple([0] * img1.ndim), -np.inf)
+	for peak in peaks:
+		candidates = [[]]
+		for p, m in zip(peak, pcm_shape):
+			candidates = [c + [v] for c in candidates for v in set((int(p), int(p) - m))]
+		for c in candidates:
+			shift = tuple(c)
+			r = cross_correlation(img1, img2, shift)
+			if r > best[1]:
+				best = (shift, r)
+
+	return climb_correlation(img1, img2, best)
+
+
+def climb_correlation(img1, img2, best, max_steps=PEAK_CLIMB_STEPS):
+	"""
+	Move the shift to the neighbour (+-1 pixel per axis) with the highest cross
+	correlation until no neighbour is better. With noise the whitened phase
+	correlation can put the peak next to the true shift, which is then not a
+	local maximum of the phase correlation matrix itself.
+	"""
+	steps = [s for s in np.ndindex(*([3] * img1.ndim)) if any(v != 1 for v in s)]
+	for _ in range(max_steps):
+		shift, r = best
+		for step in steps:
+			c = tuple(v + d - 1 for v, d in zip(shift, step))
+			rc = cross_correlation(img1, img2, c)
+			if rc > best[1]:
+				best = (c, rc)
+		if best[0] == shift:
+			break
+
+	return best
+
+
+def stitch_from_spectra(f1, f2, shape, img1, img2):
+	"""
+	Shift (in image axis order) of img1 relative to img2 from their normalized spectra.
+	"""
+	pcm = np.fft.irfftn(f1 * np.conj(f2), s=shape, axes=tuple(range(len(shape))))
+	return verify_peaks(pcm_peaks(pcm), shape, img1, img2)
+
+
+def downsample(img, factor):
+	"""
+	Mean of blocks of factor x factor pixels in x and y (z is kept).
+	"""
+	h = img.shape[-2] // factor * factor
+	w = img.shape[-1] // factor * factor
+	blocks = img[..., :h, :w].reshape(img.shape[:-2] + (h // factor, factor, w // factor, factor))
+	return blocks.mean(axis=(-3, -1))
+
+
+def apodize(img):
+	"""
+	Fade the image out to its mean towards the border in x and y (Hann window).
+	"""
+	wy = np.hanning(img.shape[-2] + 2)[1:-1].astype(np.float32)
+	wx = np.hanning(img.shape[-1] + 2)[1:-1].astype(np.float32)
+	mean = img.mean()
+	return (img - mean) * wy[:, np.newaxis] * wx[np.newaxis, :] + mean
+
+
+def upsampled_dft(data, region, upsample, offsets):
+	"""
+	Inverse DFT of data evaluated on a region upsampled by upsample around offsets
+	(matrix multiply DFT, Guizar-Sicairos et al. 2008).
+	"""
+	for n, offset in list(zip(data.shape, offsets))[::-1]:
+		kernel = np.exp(-2j * np.pi * (np.arange(region) - offset)[:, np.newaxis] * np.fft.fftfreq(n, upsample))
+		data = np.tensordot(kernel, data, axes=(1, -1))
+	return data
+
+
+def refine_shift(img1, img2, shift, upsample=1):
+	"""
+	Refine the shift of img1 relative to img2 on a central crop of their overlap
+	at full resolution; with upsample > 1 the result is refined to 1/upsample pixel.
+	"""
+	shift = np.array(shift, dtype=int)
+	a, b = overlap(img1, img2, shift)
+	if a is None:
+		return shift.astype(np.float64)
+	crop = []
+	for ax, n in enumerate(a.shape):
+		c = min(n, REFINE_CROP) if ax >= a.ndim - 2 else n
+		crop.append(slice((n - c) // 2, (n - c) // 2 + c))
+	a = apodize(a[tuple(crop)])
+	b = apodize(b[tuple(crop)])
+	# plain cross correlation: whitening the spectrum (as for the phase correlation)
+	# lets the noise dominate the peak position at sub-pixel precision
+	f = np.fft.fftn(a) * np.conj(np.fft.fftn(b))
+	pcm = np.fft.ifftn(f).real
+	peak = np.array(np.unravel_index(np.argmax(pcm), pcm.shape))
+	residual = np.where(peak > np.array(pcm.shape) // 2, peak - np.array(pcm.shape), peak).astype(np.float64)
+	if upsample > 1:
+		region = int(np.ceil(upsample * 1.5))
+		center = np.fix(region / 2.0)
+		cc = upsampled_dft(f.conj(), region, upsample, center - residual * upsample).conj()
+		maxima = np.array(np.unravel_index(np.argmax(np.abs(cc)), cc.shape), dtype=np.float64)
+		residual += (maxima - center) / upsample
+	return shift + residual
+
+
+def shift_to_xyz(shift):
+	"""
+	Convert a shift in array order ((z,) y, x) to (dx, dy, dz).
+	"""
+	if len(shift) == 3:
+		return np.array([shift[2], shift[1], shift[0]], dtype=np.float64)
+	return np.array([shift[1], shift[0], 0], dtype=np.float64)
+
+
+def clamp_pyramid(pyramid, shape):
+	"""
+	Halve the pyramid factor until frames of shape (.., Y, X) downsampled by it keep at
+	least PYRAMID_MIN_SIZE pixels in x and y, smaller frames give wrong coarse shifts.
+	"""
+	while pyramid > 1 and min(shape[-2:]) // pyramid < PYRAMID_MIN_SIZE:
+		pyramid //= 2
+	return pyramid
+
+
+def compute_stitch(img1, img2, pyramid=1, upsample=1):
+	"""
+	Compute the (dx, dy, dz) translation of img1 relative to img2, i.e. the content of img2
+	at x is found in img1 at x + shift. Both are (Z, Y, X) frames.
+	With pyramid > 1 the shift is estimated on apodized frames downsampled by this
+	factor in x and y (see clamp_pyramid) and refined at full resolution (see refine_shift).
+	"""
+	img1 = spatial_axes(img1)
+	img2 = spatial_axes(img2)
+	pyramid = clamp_pyramid(pyramid, img1.shape)
+	small1 = apodize(downsample(img1, pyramid)) if pyramid > 1 else img1
+	small2 = apodize(downsample(img2, pyramid)) if pyramid > 1 else img2
+	shape = extended_shape(small1.shape, small2.shape)
+	shift, _ = stitch_from_spectra(spectra([small1], shape)[0], spectra([small2], shape)[0], shape, small1, small2)
+	return shift_to_xyz(scale_and_refine(img1, img2, shift, pyramid, upsample))
+
+
+def scale_and_refine(img1, img2, shift, pyramid, upsample):
+	"""
+	Scale a shift measured on downsampled frames to full resolution and refine it.
+	"""
+	if pyramid == 1 and upsample == 1:
+		return shift
+	shift = np.array(shift)
+	shift[-2:] *= pyramid
+	return refine_shift(img1, img2, shift, upsample)
+
+
+def frame_pairs(nt, dt):
+	"""
+	Frame pairs (t-dt, t) visited by compute_and_update_frame_translations_dt (0-based).
+	"""
+	pairs = []
+	for t in range(dt, nt + dt, dt):
+		if t > nt - 1: # this ensures that the last data points are not missed out
+			t = nt - 1
+		pairs.append((t - dt, t))
+
+	return pairs
+
+
+def shift_roi(shape, roi, dr):
+	"""
+	Shift a roi (x, y, width, height) by dr, keeping it within an image of shape (.., Y, X).
+	"""
+	if roi is None:
+		return roi
+	x, y, w, h = roi
+	height, width = shape[-2:]
+	# x shift
+	if (x + dr[0]) < 0:
+		sx = 0
+	elif (x + dr[0] + w) > width:
+		sx = int(width - w)
+	else:
+		sx = x + int(dr[0])
+	# y shift
+	if (y + dr[1]) < 0:
+		sy = 0
+	elif (y + dr[1] + h) > height:
+		sy = int(height - h)
+	else:
+		sy = y + int(dr[1])
+
+	return (sx, sy, w, h)
+
+
+class FrameCache(object):
+	"""
+	Bounded LRU cache of preprocessed frames and their spectra.
+
+	Every frame is part of the pairs (t-dt, t) and (t, t+dt) and the multi-time-scale
+	passes visit the same frames again, with the cache each frame is only extracted,
+	processed and Fourier transformed once while it is in the cache. Frames are keyed
+	by (frame, roi, process, background, z_min, z_max, pyramid) and spectra are stored
+	in their entry by FFT size, use one cache per stack (channel).
+
+	frame() returns the entry itself, callers keep it (and its spectra) for as long as
+	they need it, so an entry that is evicted meanwhile is still valid. The cache can
+	be shared by threads: lookups, inserts and evictions hold a lock.
+	"""
+
+	def __init__(self, max_size=CACHE_SIZE):
+		self.max_size = max_size
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+	def _lookup(self, key):
+		with self.lock:
+			value = self.entries.pop(key, None)
+			if value is not None:
+				self.entries[key] = value
+			return value
+
+	def _store(self, key, value):
+		with self.lock:
+			# a frame that another thread stored meanwhile is kept
+			if key in self.entries:
+				return self.entries[key]
+			while len(self.entries) >= self.max_size:
+				self.entries.popitem(last=False)
+			self.entries[key] = value
+			return value
+
+	def entries_per_frame(self, pyramid=1):
+		"""
+		Number of cache entries of one frame: a downsampled frame is made from the full resolution one.
+		"""
+		return 2 if pyramid > 1 else 1
+
+	def frame(self, stack, frame, process, background, roi, z_min, z_max, pyramid=1):
+		"""
+		Entry and preprocessed frame (see extract_frame_process_roi) without singleton
+		z axis, downsampled and apodized for pyramid > 1.
+		"""
+		key = (frame, None if roi is None else tuple(int(v) for v in roi), process, background, z_min, z_max, pyramid)
+		entry = self._lookup(key)
+		if entry is None:
+			if pyramid > 1:
+				img = apodize(downsample(self.frame(stack, frame, process, background, roi, z_min, z_max)[1], pyramid))
+			else:
+				img = spatial_axes(extract_frame_process_roi(stack, frame, process, background, roi, z_min, z_max))
+			entry = self._store(key, {'img': img})
+		return entry, entry['img']
+
+	def spectra(self, entries, shape):
+		"""
+		Spectra of the entries returned by frame(), missing ones are computed together as batched FFT.
+		"""
+		missing = [e for e in entries if shape not in e]
+		for i in range(0, len(missing), FFT_BATCH):
+			batch = missing[i:i + FFT_BATCH]
+			for e, f in zip(batch, spectra([e['img'] for e in batch], shape)):
+				e[shape] = f
+		return [e[shape] for e in entries]
+
+
+def measure_pairs(stack, pairs, process, background, z_min, z_max, cache, threads=1, pyramid=1, upsample=1):
+	"""
+	Measure the shift of every (t1, t2) pair on whole frames.
+	Pairs are processed in blocks whose frames are Fourier transformed together,
+	the pairs of a block are correlated on a pool of threads. The frames and spectra
+	of a block are held by the block, a block fits into the cache.
+	"""
+	measured = {}
+	block = max(1, cache.max_size // (2 * cache.entries_per_frame(pyramid)) - 1)
+	refine = pyramid > 1 or upsample > 1
+	pool = ThreadPoolExecutor(threads) if threads > 1 else None
+	for i in range(0, len(pairs), block):
+		todo = [pair for pair in pairs[i:i + block] if pair not in measured]
+		frames = sorted(set([t for pair in todo for t in pair]))
+		if not frames:
+			continue
+		entries = {}
+		imgs = {}
+		fulls = {}
+		for t in frames:
+			entries[t], imgs[t] = cache.frame(stack, t, process, background, None, z_min, z_max, pyramid)
+			fulls[t] = cache.frame(stack, t, process, background, None, z_min, z_max)[1] if refine else None
+		shape = extended_shape(imgs[frames[0]].shape, imgs[frames[0]].shape)
+		specs = dict(zip(frames, cache.spectra([entries[t] for t in frames], shape)))
+		def stitch(pair):
+			shift, _ = stitch_from_spectra(specs[pair[1]], specs[pair[0]], shape, imgs[pair[1]], imgs[pair[0]])
+			return shift_to_xyz(scale_and_refine(fulls[pair[1]], fulls[pair[0]], shift, pyramid, upsample))
+		for pair, shift in zip(todo, pool.map(stitch, todo) if pool else map(stitch, todo)):
+			measured[pair] = shift
+	if pool:
+		pool.shutdown()
+
+	return measured
+
+
+def update_shifts_from_pairs(shifts, pairs, local_new_shifts, dt):
+	"""
+	Apply the measured shifts of all pairs at once. Updating the pairs one after another
+	adds a linear ramp starting at t-dt for every pair, the ramps are the prefix sum of
+	their slopes.
+	"""
+	t1 = np.array([pair[0] for pair in pairs])
+	t2 = np.array([pair[1] for pair in pairs])
+	diff = np.asarray(local_new_shifts, dtype=np.float64) - (shifts[t2] - shifts[t1])
+	dslope = np.zeros_like(shifts)
+	np.add.at(dslope, t1, np.diff(diff, axis=0, prepend=0))
+	slope = np.cumsum(dslope, axis=0)
+	ramp = np.concatenate([np.zeros((1, 3)), np.cumsum(slope[:-1], axis=0)]) / dt
+
+	return shifts + ramp
+
+
+def measure_pair_roi(stack, t1, t2, roi1, roi2, process, background, z_min, z_max, cache, pyramid=1, upsample=1):
+	"""
+	Measure the shift between the roi1 of frame t1 and the roi2 of frame t2.
+	"""
+	entry1, img1 = cache.frame(stack, t1, process, background, roi1, z_min, z_max, pyramid)
+	entry2, img2 = cache.frame(stack, t2, process, background, roi2, z_min, z_max, pyramid)
+	shape = extended_shape(img1.shape, img2.shape)
+	f1, f2 = cache.spectra([entry1, entry2], shape)
+	shift, _ = stitch_from_spectra(f2, f1, shape, img2, img1)
+	if pyramid > 1 or upsample > 1:
+		img1 = cache.frame(stack, t1, process, background, roi1, z_min, z_max)[1]
+		img2 = cache.frame(stack, t2, process, background, roi2, z_min, z_max)[1]
+
+	return shift_to_xyz(scale_and_refine(img2, img1, shift, pyramid, upsample))
+
+
+def compute_and_update_frame_translations_dt(stack, dt, process, background, z_min, z_max, roi=None, shifts=None, cache=None, threads=1, pyramid=1, upsample=1):
+	"""
+	Compute the x,y,z translation between every t and t+dt frames of stack (T, Z, Y, X).
+	If shifts were already determined at other (lower) dt they will be used and updated.
+	The roi (x, y, width, height) is moved along with the drift.
+	A FrameCache can be passed on to reuse processed frames and spectra across calls.
+	Without roi the pairs are independent of the shifts, they are measured on
+	threads and applied at once.
+	"""
+	nt = stack.shape[0]
+	if shifts is None:
+		shifts = np.zeros((nt, 3))
+	if cache is None:
+		cache = FrameCache()
+	pairs = frame_pairs(nt, dt)
+	if roi is None:
+		logging.info(f"between {len(pairs)} frame pairs")
+		measured = measure_pairs(stack, pairs, process, background, z_min, z_max, cache, threads, pyramid, upsample)
+		return update_shifts_from_pairs(shifts, pairs, [measured[pair] for pair in pairs], dt)
+
+	for t1, t2 in pairs:
+		logging.info(f"between frames {t1+1} and {t2+1}")
+		# get (cropped and processed) images at t1 and t2
+		roi1 = shift_roi(stack.shape, roi, shifts[t1])
+		roi2 = shift_roi(stack.shape, roi, shifts[t2])
+		# total shift is shift of rois plus measured drift
+		local_new_shift = measure_pair_roi(stack, t1, t2, roi1, roi2, process, background, z_min, z_max, cache, pyramid, upsample)
+		local_new_shift += [roi2[0] - roi1[0], roi2[1] - roi1[1], 0]
+		# difference between new and old measurement (which come from different dt)
+		add_shift = local_new_shift - (shifts[t2] - shifts[t1])
+		# update shifts from t1 to the end (linear drift prediction for the frames after t2)
+		i = np.arange(nt - t1, dtype=np.float64)
+		shifts[t1:] += (i / dt)[:, np.newaxis] * add_shift
+
+	return shifts
+
+
+def solve_positions(nt, pairs, local_shifts, weights):
+	"""
+	Weighted least-squares drift of all frames from the shifts measured between frame pairs,
+	i.e. minimizes the sum of w * (p[t2] - p[t1] - shift)^2 over all pairs with p[0] = 0.
+	The normal equations are a single sparse linear system.
+	"""
+	from scipy.sparse import coo_matrix
+	from scipy.sparse.linalg import spsolve
+
+	t1 = np.array([pair[0] for pair in pairs])
+	t2 = np.array([pair[1] for pair in pairs])
+	w = np.asarray(weights, dtype=np.float64)
+	m = np.asarray(local_shifts, dtype=np.float64)
+	rows = np.concatenate([t1, t2, t1, t2])
+	cols = np.concatenate([t1, t2, t2, t1])
+	vals = np.concatenate([w, w, -w, -w])
+	normal = coo_matrix((vals, (rows, cols)), shape=(nt, nt)).tocsr()[1:, 1:]
+	rhs = np.zeros((nt, 3))
+	np.add.at(rhs, t2, w[:, np.newaxis] * m)
+	np.add.at(rhs, t1, -w[:, np.newaxis] * m)
+	positions = np.zeros((nt, 3))
+	positions[1:] = spsolve(normal.tocsc(), rhs[1:]).reshape(nt - 1, 3)
+
+	return positions
+
+
+def compute_frame_translations_global(stack, process, background, z_min, z_max, shifts, roi=None, cache=None, threads=1, pyramid=1, upsample=1):
+	"""
+	Multi-time-scale drift with a single global solve. The shifts between consecutive frames
+	(from the dt=1 pass) and the shifts of all frame pairs at the multi-time-scale frame shifts
+	are collected once and the drift of all frames is solved for with weighted least squares.
+	"""
+	nt = stack.shape[0]
+	if cache is None:
+		cache = FrameCache()
+	# measurements of the dt=1 pass
+	pairs = frame_pairs(nt, 1)
+	local_shifts = [shifts[t2] - shifts[t1] for t1, t2 in pairs]
+	# sparse set of long-range pairs
+	long_pairs = []
+	for dt in multi_time_scales(nt):
+		for pair in frame_pairs(nt, dt):
+			if pair not in long_pairs and pair not in pairs:
+				long_pairs.append(pair)
+	logging.info(f"at {len(long_pairs)} long-range frame pairs")
+	if roi is None:
+		measured = measure_pairs(stack, long_pairs, process, background, z_min, z_max, cache, threads, pyramid, upsample)
+		local_shifts += [measured[pair] for pair in long_pairs]
+	else:
+		# the rois are placed at the shifts of the dt=1 pass
+		def measure(pair):
+			roi1 = shift_roi(stack.shape, roi, shifts[pair[0]])
+			roi2 = shift_roi(stack.shape, roi, shifts[pair[1]])
+			shift = measure_pair_roi(stack, pair[0], pair[1], roi1, roi2, process, background, z_min, z_max, cache, pyramid, upsample)
+			return shift + [roi2[0] - roi1[0], roi2[1] - roi1[1], 0]
+		with ThreadPoolExecutor(threads) as pool:
+			local_shifts += list(pool.map(measure, long_pairs))
+	# all pairs are weighted equally
+	weights = np.ones(len(pairs) + len(long_pairs))
+	logging.info(f"solving for the drift of {nt} frames")
+
+	return solve_positions(nt, pairs + long_pairs, local_shifts, weights)
+
+
+def multi_time_scales(nt):
+	"""
+	Frame shifts of the multi-time-scale computation.
+	"""
+	dt_max = nt - 1
+	dts = []
+	for dt in [3, 9, 27, 81, 243, 729, dt_max]:
+		if dt < dt_max:
+			dts.append(dt)
+		else:
+			dts.append(dt_max)
+			break
+
+	return dts
+
+
+def compute_shifts(stack, process=False, background=0, z_min=1, z_max=None, roi=None, multi_time_scale=False, threads=1, global_solve=False, pyramid=1, upsample=1):
+	"""
+	Compute the drift of every frame of stack (T, Z, Y, X) like run()/auto_run().
+	pyramid > 1 estimates the shifts on downsampled frames (at most down to
+	PYRAMID_MIN_SIZE pixels, see clamp_pyramid) and refines them at full resolution,
+	upsample > 1 refines them to 1/upsample pixel.
+	Returns the measured shifts; use invert_shifts() to get the correction.
+	"""
+	if z_max is None:
+		z_max = stack.shape[1]
+	if z_min < 1 or z_max > stack.shape[1]:
+		raise ValueError(f"z-range {z_min}-{z_max} is outside of the {stack.shape[1]} z-planes")
+	if stack.shape[0] < 2:
+		raise ValueError("Cannot register because there is only one time frame.")
+	level = clamp_pyramid(pyramid, stack.shape if roi is None else (roi[3], roi[2]))
+	if level != pyramid:
+		logging.info(f"pyramid reduced from {pyramid} to {level}, downsampled frames keep at least {PYRAMID_MIN_SIZE} pixels")
+		pyramid = level
+
+	cache = FrameCache()
+	logging.info("at frame shifts of 1")
+	shifts = compute_and_update_frame_translations_dt(stack, 1, process, background, z_min, z_max, roi, None, cache, threads, pyramid, upsample)
+	if multi_time_scale and global_solve:
+		shifts = compute_frame_translations_global(stack, process, background, z_min, z_max, shifts, roi, cache, threads, pyramid, upsample)
+	elif multi_time_scale:
+		for dt in multi_time_scales(stack.shape[0]):
+			logging.info(f"at frame shifts of {dt}")
+			shifts = compute_and_update_frame_translations_dt(stack, dt, process, background, z_min, z_max, roi, shifts, cache, threads, pyramid, upsample)
+
+	return shifts
+
+
+def invert_shifts(shifts):
+	"""
+	Invert shifts such that they can be used for correction.
+	"""
+	return -np.asarray(shifts, dtype=np.float64)
+
+
+def convert_shifts_to_integer(shifts):
+	return np.round(shifts).astype(int)
+
+
+def compute_min_max(shifts):
+	"""
+	Bounds (minx, miny, minz, maxx, maxy, maxz) of the absolute shifts.
+	"""
+	return tuple(np.min(shifts, axis=0)) + tuple(np.max(shifts, axis=0))
+
+
+def registered_shape(shape, shifts, crop=False):
+	"""
+	Canvas (Z, Y, X) of the registered frames of the given (..., Z, Y, X) shape
+	and the correction shifts relative to it, as in register_hyperstack_subpixel().
+	The canvas contains all frames or, with crop, only the field of view of all
+	frames.
+	"""
+	shifts = np.asarray(shifts, dtype=np.float64)
+	size = np.array(shape[-1:-4:-1], dtype=np.float64)
+	lo, hi = shifts.min(axis=0), shifts.max(axis=0)
+	if crop and np.all(size - (hi - lo) >= 1):
+		offset, canvas = hi, size - (hi - lo)
+	else:
+		if crop:
+			logging.warning("The frames have no common field of view, the canvas is not cropped")
+		offset, canvas = lo, size + hi - lo
+	canvas = tuple(int(n) for n in np.floor(canvas + 1e-6)[::-1])
+	return canvas, shifts - offset
+
+
+def slab(n, size, offset):
+	"""
+	Slices of the target (length size) and the source (length n) when the
+	source is inserted at the integer offset, clipped to the target.
+	"""
+	start, stop = max(0, offset), min(size, n + offset)
+	if stop <= start:
+		return None, None
+	return slice(start, stop), slice(start - offset, stop - offset)
+
+
+def insert(target, source, offset, weight=None):
+	"""
+	Add (or copy without weight) the source at the integer (x, y, z) offset
+	into the target, both (..., Z, Y, X).
+	"""
+	dst, src = [Ellipsis], [Ellipsis]
+	for axis, o in zip((-3, -2, -1), offset[::-1]):
+		d, r = slab(source.shape[axis], target.shape[axis], int(o))
+		if d is None:
+			return
+		dst.append(d)
+		src.append(r)
+	dst, src = tuple(dst), tuple(src)
+	if weight is None:
+		target[dst] = source[src]
+	else:
+		target[dst] += weight * source[src]
+
+
+def translate_linear(frame, shift, acc):
+	"""
+	Translate the frame (C, Z, Y, X) by the (x, y, z) shift with n-linear
+	interpolation into acc, a float32 array of the canvas shape. Outside of the
+	frame is zero. Only the corners with a non-zero weight are added, so
+	integer shifts are plain slab copies.
+	"""
+	acc[...] = 0
+	base = np.floor(shift).astype(int)
+	frac = shift - base
+	corners = [[(0, 1.0)] if f < 1e-6 else [(0, 1 - f), (1, f)] for f in frac]
+	for cx, wx in corners[0]:
+		for cy, wy in corners[1]:
+			for cz, wz in corners[2]:
+				w = wx * wy * wz
+				if w < 1e-6:
+					continue
+				insert(acc, frame, base + (cx, cy, cz), None if w == 1 else np.float32(w))
+	return acc
+
+
+def translate_fourier(frames, shifts, acc, pad=FOURIER_PAD):
+	"""
+	Translate a batch of frames (B, C, Z, Y, X) by their (B, 3) shifts into acc,
+	a float32 array (B, C) + canvas. The fractional part is a phase ramp applied
+	to the whole batch in one FFT of the edge-padded frames (to avoid ringing
+	and wrap around), the integer part a slab copy into the canvas.
+	"""
+	acc[...] = 0
+	shape = frames.shape[-3:]
+	pads = [pad if n > 1 else 0 for n in shape]
+	box = [fast_length(n + 2 * p) if p else n for n, p in zip(shape, pads)]
+	buf = np.pad(frames.astype(np.float32), [(0, 0), (0, 0)] + [(p, b - n - p) for n, p, b in zip(shape, pads, box)], mode='edge')
+	base = np.floor(shifts).astype(int)
+	frac = shifts - base
+
+	f = np.fft.rfftn(buf, axes=(-3, -2, -1))
+	kz = np.fft.fftfreq(box[0])
+	ky = np.fft.fftfreq(box[1])
+	kx = np.fft.rfftfreq(box[2])
+	ramp = np.exp(-2j * np.pi * (
+		frac[:, 2, None, None, None] * kz[None, :, None, None]
+		+ frac[:, 1, None, None, None] * ky[None, None, :, None]
+		+ frac[:, 0, None, None, None] * kx[None, None, None, :])).astype(np.complex64)
+	f *= ramp[:, None]
+	buf = np.fft.irfftn(f, s=box, axes=(-3, -2, -1))
+
+	for b in range(len(frames)):
+		# the shifted frame covers one more pixel along the axes with a fractional shift
+		region = tuple(slice(p, p + n + (fr > 1e-6)) for n, p, fr in zip(shape, pads, frac[b][::-1]))
+		insert(acc[b], buf[b][(Ellipsis,) + region], base[b])
+	return acc
+
+
+def to_dtype(data, dtype):
+	"""
+	Round and clip float data to the range of an integer dtype.
+	"""
+	if np.issubdtype(dtype, np.integer):
+		info = np.iinfo(dtype)
+		data = np.clip(np.rint(data), info.min, info.max)
+	return data.astype(dtype, copy=False)
+
+
+def register_stack(data, shifts, crop=False, method="linear", out=None, batch=TRANSLATE_BATCH, threads=1):
+	"""
+	Apply the correction shifts (see invert_shifts()) to all frames of the
+	(T, C, Z, Y, X) data and write them into out, a (T, C) + canvas array of the
+	data dtype (see registered_shape()) that is allocated if not given, e.g.
+	a view of a memory-mapped file. method is "linear" (n-linear interpolation)
+	or "fourier". Batches of frames are translated in parallel threads.
+	"""
+	if method not in ("linear", "fourier"):
+		raise ValueError("Unknown interpolation method: " + str(method))
+	canvas, shifts = registered_shape(data.shape, shifts, crop)
+	if out is None:
+		out = np.empty(data.shape[:2] + canvas, dtype=data.dtype)
+	elif out.shape != data.shape[:2] + canvas:
+		raise ValueError("Output shape " + str(out.shape) + " does not match " + str(data.shape[:2] + canvas))
+
+	def translate_batch(start):
+		stop = min(start + batch, len(data))
+		if method == "fourier":
+			acc = np.empty((stop - start,) + data.shape[1:2] + canvas, dtype=np.float32)
+			out[start:stop] = to_dtype(translate_fourier(np.asarray(data[start:stop]), shifts[start:stop], acc), out.dtype)
+		else:
+			acc = np.empty(data.shape[1:2] + canvas, dtype=np.float32)
+			for t in range(start, stop):
+				out[t] = to_dtype(translate_linear(np.asarray(data[t]), shifts[t], acc), out.dtype)
+		logging.info(f"Registered frames {start + 1} to {stop}")
+
+	starts = range(0, len(data), batch)
+	if threads > 1:
+		with ThreadPoolExecutor(threads) as executor:
+			list(executor.map(translate_batch, starts))
+	else:
+		for start in starts:
+			translate_batch(start)
+	return out
+
+
+def save_registered(file_path, data, shifts, crop=False, method="linear", threads=1):
+	"""
+	Register the (T, C, Z, Y, X) data into an ImageJ hyperstack TIFF that is
+	memory-mapped, so the registered frames are never held in memory at once.
+	"""
+	import tifffile
+
+	canvas, _ = registered_shape(data.shape, shifts, crop)
+	shape = (data.shape[0], canvas[0], data.shape[1]) + canvas[1:]
+	mm = tifffile.memmap(file_path, shape=shape, dtype=data.dtype, imagej=True, metadata={'axes': 'TZCYX'})
+	register_stack(data, shifts, crop, method, mm.transpose(0, 2, 1, 3, 4), threads=threads)
+	mm.flush()
+	del mm
+
+
+def save_shifts(file_path, shifts, roi):
+	"""
+	Write the shifts in the format of drift_correction.save_shifts().
+	"""
+	txt = []
+	txt.append("ROI zero-based")
+	txt.append("\nx_min\ty_min\tz_min\tx_max\ty_max\tz_max")
+	txt.append("\n" + "\t".join(str(v) for v in roi))
+	txt.append("\nShifts")
+	txt.append("\ndx\tdy\tdz")
+	for shift in shifts:
+		txt.append("\n" + "\t".join(str(float(v)) for v in shift))
+	with open(file_path, 'w') as f:
+		f.writelines(txt)
+
+
+def read_shifts(file_path):
+	"""
+	Read a shift file of save_shifts() or drift_correction.write_shifts() and return
+	the roi and the shifts (T, 3), without the confidence column.
+	"""
+	with open(file_path) as f:
+		lines = [line.strip() for line in f if line.strip()]
+	roi = [int(v) for v in lines[2].split("\t")]
+	shifts = np.array([[float(v) for v in line.split("\t")[:3]] for line in lines[5:]], dtype=np.float64)
+	return roi, shifts
+
+
+def step_difference(shifts, reference):
+	"""
+	Largest difference (pixels, in x, y or z) between the shifts of consecutive frames
+	of two shift tables (T, 3), e.g. to compare with drift_correction.py (see FIJI_TOLERANCE).
+	"""
+	return float(np.max(np.abs(np.diff(shifts, axis=0) - np.diff(reference, axis=0)), initial=0))
+
+
+def run():
+	"""
+	Run the script with command line arguments.
+	"""
+	logging.basicConfig(level=logging.INFO)
+	parser = argparse.ArgumentParser(description="Compute the drift of a time-lapse TIFF without Fiji")
+	parser.add_argument("file_path", help="Path to TIFF file")
+	parser.add_argument("--channel", type=int, default=1, help="Channel for registration (1-based)")
+	parser.add_argument("--multi_time_scale", action="store_true", help="Multi time scale computation for slow drifts")
+	parser.add_argument("--global_solve", action="store_true", help="Solve the multi time scale drifts with least squares over all frame pairs")
+	parser.add_argument("--pyramid", type=int, default=1, choices=[1, 2, 4, 8], help="Estimate the drift on frames downsampled by this factor and refine it")
+	parser.add_argument("--upsample", type=int, default=1, help="Refine the drift to 1/upsample pixel")
+	parser.add_argument("--process", action="store_true", help="Edge enhance images")
+	parser.add_argument("--background", type=float, default=0, help="Only consider pixels with values larger than")
+	parser.add_argument("--z_min", type=int, default=1, help="Lowest z plane to take into account")
+	parser.add_argument("--z_max", type=int, default=None, help="Highest z plane to take into account")
+	parser.add_argument("--roi", type=int, nargs=4, default=None, metavar=("X", "Y", "W", "H"), help="Only compute drift in this region")
+	parser.add_argument("--threads", type=int, default=os.cpu_count(), help="Threads for drift computation (without ROI)")
+	parser.add_argument("--output", default=None, help="Shift file (default: <file>_shifts.txt)")
+	parser.add_argument("--register", default=None, metavar="TIFF", help="Also save the registered hyperstack to this file")
+	parser.add_argument("--subpixel", action="store_true", help="Register with sub-pixel shifts (otherwise rounded to full pixels)")
+	parser.add_argument("--interpolation", default="linear", choices=["linear", "fourier"], help="Interpolation of sub-pixel shifts")
+	parser.add_argument("--crop", action="store_true", help="Only keep the field of view of all frames in the registered hyperstack")
+	args = parser.parse_args()
+
+	data = load_hyperstack(args.file_path)
+	stack = data[:, args.channel - 1]
+	shifts = compute_shifts(stack, args.process, args.background, args.z_min, args.z_max, args.roi, args.multi_time_scale, args.threads, args.global_solve, args.pyramid, args.upsample)
+	shifts = invert_shifts(shifts)
+
+	nt, nz, ny, nx = stack.shape
+	if args.roi:
+		x, y, w, h = args.roi
+		roi = [x, y, 0, x + w - 1, y + h - 1, nz - 1]
+	else:
+		roi = [0, 0, 0, nx - 1, ny - 1, nz - 1]
+	output = args.output or os.path.splitext(args.file_path)[0] + '_shifts.txt'
+	save_shifts(output, shifts, roi)
+	logging.info(f"Saved shifts to {output}")
+
+	if args.register:
+		if not args.subpixel:
+			shifts = convert_shifts_to_integer(shifts)
+		save_registered(args.register, data, shifts, args.crop, args.interpolation, args.threads)
+		logging.info(f"Saved registered hyperstack to {args.register}")
+
+if __name__ == "__main__":
+	run()
@@ -0,0 +1,50 @@
+#title           : online_drift_correction.py
+#description     : Corrects the drift of a time-lapse while it is still being acquired.
+#					Watches a folder that receives one image file per time point, or a single
+#					image file that grows, registers every new frame against the previous one
+#					and appends its shift to shifts.txt and its planes to the output directory.
+#					Limitation: every frame is only registered against the previous frame,
+#					the errors of the single steps add up over the acquisition. For slow
+#					drifts of long acquisitions, correct the drift again afterwards with
+#					the multi time scale option of drift_correction.py.
+#					Must be run with the drift_correction.py script in the same folder
+#date            : 2026/10/18
+#version         :
+#usage           :
+#notes           : Rerunning on the same output directory continues after the last corrected frame.
+#python_version  : ImageJ
+
+#=======================================================================
+
+import os
+import sys
+from ij import IJ
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(1, SCRIPT_PATH)
+
+import drift_correction
+
+#@ File (label="Acquisition folder (one file per time point) or growing image file:", style="both") SOURCE
+#@ File (label="Ouput directory:", style="directory") OUT_DIR
+#@ Integer (label="Channel for registration", value=1) channel
+#@ Boolean (label="Sub-pixel drift correction", value=false) subpixel
+#@ Boolean (label="Edge enhance images for possibly improved drift correction?", value=false) process
+#@ Integer (label="Minutes without a new frame until the acquisition is done", value=10) idle
+
+
+if __name__ == '__main__':
+
+	source = str(SOURCE)
+	out_path = str(OUT_DIR)
+
+	IJ.log('\n-- {0:-<80}'.format('ONLINE DRIFT CORRECTION'))
+	IJ.log('    Source:{0: >20}'.format(source))
+	IJ.log('    Output dir:{0: >20}'.format(out_path))
+
+	options = drift_correction.DriftOptions(channel=channel, subpixel=subpixel, process=process)
+	img_reg = drift_correction.correct_drift_online(source, out_path, options, None, drift_correction.ONLINE_POLL, idle * 60)
+	if img_reg is not None:
+		img_reg.show()
+
+	IJ.log('-----------------------------END-----------------------------')
@@ -17,15 +17,21 @@ Sample1
 			├── Sample001_T00_C02_Z00.tif
 			└── ...
 
+The planes can be saved with lossless compression (--compression, default none),
+encoded by several threads (--threads) with tiff_writer.py.
+
 Usage:
 	python sort_images_lif.py [path_to_lif_file]
+	python sort_images_lif.py --compression lzw --threads 8 [path_to_lif_file]
 """
 
 
 import os
 import argparse
 import logging
+import numpy as np
 from readlif.reader import LifFile
+from tiff_writer import PlaneWriter, add_arguments
 
 def create_directory(path):
 	"""
@@ -34,7 +40,7 @@ def create_directory(path):
 	if not os.path.isdir(path):
 		os.makedirs(path)
 
-def process_images(file_path):
+def process_images(file_path, compression="none", threads=None):
 	"""
 	Process and save images from ND2 file.
 	"""
@@ -55,26 +61,29 @@ def process_images(file_path):
 		return
 
 
-	for img in lif.get_iter_image():
+	with PlaneWriter(compression, threads=threads) as writer:
+		for img in lif.get_iter_image():
 
-		sample_name = img.name.split('/')[-1]
-		
-		fluor_dir = os.path.join(out_dir, sample_name, 'Fluor')
-		img_dir = os.path.join(out_dir, sample_name, 'Images')
+			sample_name = img.name.split('/')[-1]
+			
+			fluor_dir = os.path.join(out_dir, sample_name, 'Fluor')
+			img_dir = os.path.join(out_dir, sample_name, 'Images')
 
-		create_directory(fluor_dir)
-		create_directory(img_dir)
+			create_directory(fluor_dir)
+			create_directory(img_dir)
 
-		for t in range(img.dims.t):
-			for c in range(img.channels):
-				for z in range(img.dims.z):
-					img_name = f"{sample_name}_T{t:02}_C{c:02}_Z{z:02}.tif"
-					frame = img.get_frame(z=z, t=t, c=c)
-					if c == 0:
-						frame.save(os.path.join(img_dir, img_name))
-					else:
-						frame.save(os.path.join(fluor_dir, img_name))
-		logging.info(f"Saved {sample_name} to {os.path.join(out_dir, sample_name)}")
+			for t in range(img.dims.t):
+				for c in range(img.channels):
+					for z in range(img.dims.z):
+						img_name = f"{sample_name}_T{t:02}_C{c:02}_Z{z:02}.tif"
+						frame = np.asarray(img.get_frame(z=z, t=t, c=c))
+						if c == 0:
+							writer.write(os.path.join(img_dir, img_name), frame)
+						else:
+							writer.write(os.path.join(fluor_dir, img_name), frame)
+			# wait until all planes of the sample are on disk
+			writer.flush()
+			logging.info(f"Saved {sample_name} to {os.path.join(out_dir, sample_name)}")
 
 
 
@@ -85,8 +94,9 @@ def main():
 	logging.basicConfig(level=logging.INFO)
 	parser = argparse.ArgumentParser(description="Convert LIF file into individual tiff files")
 	parser.add_argument("file_path", help="Path to LIF file")
+	add_arguments(parser)
 	args = parser.parse_args()
-	process_images(args.file_path)
+	process_images(args.file_path, args.compression, args.threads)
 	
 if __name__ == "__main__":
 	main()
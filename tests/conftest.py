@@ -0,0 +1,7 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the CPython helpers are scripts in their workflow folders, not an installed package
+for folder in ("5_Tools", "2_Microcolonies"):
+	sys.path.insert(0, os.path.join(ROOT, folder))
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+import background_subtraction_np as bs
+
+
+def spots_on_ramp(nt=3, size=96, light=False):
+	"""
+	Frames (T, Y, X) uint16 with small spots on a linear ramp, and the mask of the spots.
+	"""
+	y, x = np.mgrid[:size, :size]
+	ramp = 1000 + 5.0 * x + 3.0 * y
+	mask = np.zeros((size, size), dtype=bool)
+	for cy, cx in [(20, 20), (50, 70), (75, 30)]:
+		mask |= (y - cy) ** 2 + (x - cx) ** 2 <= 9
+	frames = np.empty((nt, size, size), dtype=np.uint16)
+	for t in range(nt):
+		frames[t] = ramp + (-1 if light else 1) * 500 * mask + 10 * t
+	return frames, mask
+
+
+@pytest.mark.parametrize("mode", bs.MODES)
+def test_dark_background_removed(mode):
+	frames, mask = spots_on_ramp()
+	result = bs.subtract_background(frames, 20, mode=mode)
+	assert result.dtype == frames.dtype
+	# the ramp is removed, the spots remain
+	assert np.median(result[:, ~mask]) < 20
+	assert np.median(result[:, mask]) > 300
+
+
+@pytest.mark.parametrize("mode", bs.MODES)
+def test_light_background_becomes_white(mode):
+	frames, mask = spots_on_ramp(light=True)
+	result = bs.subtract_background(frames, 20, light=True, mode=mode)
+	assert np.median(result[:, ~mask]) > 65535 - 20
+	assert np.median(result[:, mask]) < 65535 - 300
+
+
+def test_float_frames_not_offset():
+	frames, mask = spots_on_ramp(light=True)
+	result = bs.subtract_background(frames.astype(np.float32), 20, light=True)
+	assert result.dtype == np.float32
+	assert abs(np.median(result[:, ~mask])) < 20
+
+
+@pytest.mark.parametrize("dtype", [np.int8, np.int16, np.int32])
+def test_signed_frames_rounded_and_clamped(dtype):
+	frames, mask = spots_on_ramp()
+	info = np.iinfo(dtype)
+	# values over the whole range of the type
+	frames = (frames.astype(np.float64) / frames.max() * (float(info.max) - info.min) + info.min).astype(dtype)
+	result = bs.subtract_background(frames, 20, light=True)
+	expected = frames - bs.rolling_ball_background(frames, 20, True) + info.max
+	assert result.dtype == dtype
+	np.testing.assert_array_equal(result, np.clip(np.floor(expected + 0.5), info.min, info.max))
+
+
+def test_batches_match_whole_stack():
+	frames, _ = spots_on_ramp(nt=5)
+	np.testing.assert_array_equal(bs.subtract_background_batches(frames, 20, batch=2), bs.subtract_background(frames, 20))
+
+
+def test_fast_close_to_exact():
+	frames, mask = spots_on_ramp()
+	exact = bs.subtract_background(frames, 40).astype(np.float64)
+	fast = bs.subtract_background(frames, 40, mode="fast").astype(np.float64)
+	# the fast background is a little smoother, the spots keep most of their height
+	assert np.abs(fast - exact)[:, mask].mean() < 0.15 * exact[:, mask].mean()
+
+
+def test_ball_parameters():
+	assert bs.ball_parameters(5)[0] == 1
+	assert bs.ball_parameters(40)[0] == 4
+	assert bs.ball_parameters(200)[0] == 8
+	assert bs.fast_shrink(40) == 8
+
+
+def test_unknown_mode():
+	with pytest.raises(ValueError):
+		bs.subtract_background(np.zeros((1, 8, 8), dtype=np.uint16), 5, mode="slow")
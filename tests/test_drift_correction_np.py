@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+import drift_correction_np as dc
+from drift_benchmark import make_time_lapse, rms_error
+
+
+@pytest.fixture(scope="module")
+def long_lapse():
+	# frames of 128 pixels keep pyramid 2 (see clamp_pyramid)
+	data, drift = make_time_lapse(nt=120, size=128, kind="integer", noise=0.05, seed=1)
+	return data[:, 0], drift
+
+
+def test_pyramid_global_solve_long_stack(long_lapse):
+	# each pyramid frame takes two cache entries, blocks must not evict their own frames
+	stack, _ = long_lapse
+	shifts = dc.compute_shifts(stack, multi_time_scale=True, global_solve=True, pyramid=2)
+	assert shifts.shape == (len(stack), 3)
+	assert np.all(np.isfinite(shifts))
+
+
+def test_small_cache_keeps_block_frames(long_lapse):
+	stack, _ = long_lapse
+	cache = dc.FrameCache(max_size=8)
+	pairs = dc.frame_pairs(len(stack), 9)
+	measured = dc.measure_pairs(stack, pairs, False, 0, 1, 1, cache, pyramid=2, upsample=2)
+	assert sorted(measured) == sorted(pairs)
+
+
+def test_shared_cache_roi_threads(long_lapse):
+	# the roi pairs of the global solve are measured by threads sharing one small cache
+	stack, _ = long_lapse
+	roi = [8, 8, 112, 112]
+	one = dc.compute_shifts(stack[:40], roi=roi, multi_time_scale=True, global_solve=True)
+	many = dc.compute_shifts(stack[:40], roi=roi, multi_time_scale=True, global_solve=True, threads=4)
+	np.testing.assert_allclose(many, one)
+
+
+@pytest.mark.parametrize("size, noise", [(64, 0.05), (256, 0.1)])
+def test_integer_shifts_exact(size, noise):
+	data, drift = make_time_lapse(nt=40, size=size, kind="integer", noise=noise)
+	shifts = dc.compute_shifts(data[:, 0])
+	np.testing.assert_array_equal(shifts[:, :2] - shifts[0, :2], drift[:, :2] - drift[0, :2])
+
+
+@pytest.fixture(scope="module")
+def subpixel_lapse():
+	data, drift = make_time_lapse(nt=30, size=128, kind="subpixel", noise=0.1, seed=2)
+	return data[:, 0], drift
+
+
+@pytest.mark.parametrize("options, tolerance", [
+	({"upsample": 10}, 0.3),
+	({"pyramid": 2, "upsample": 10}, 0.3),
+	({"multi_time_scale": True, "upsample": 10}, 0.3),
+	({"multi_time_scale": True, "global_solve": True, "upsample": 10}, 0.3),
+	({}, 1.5),
+])
+def test_subpixel_shifts(subpixel_lapse, options, tolerance):
+	stack, drift = subpixel_lapse
+	shifts = dc.compute_shifts(stack, **options)
+	assert rms_error(shifts, drift, 2) < tolerance
+
+
+@pytest.mark.parametrize("options", [{}, {"upsample": 10}, {"multi_time_scale": True, "global_solve": True}])
+def test_threads_match_single_thread(subpixel_lapse, options):
+	stack, _ = subpixel_lapse
+	np.testing.assert_allclose(dc.compute_shifts(stack, threads=3, **options), dc.compute_shifts(stack, **options))
+
+
+def test_shifts_3d():
+	data, drift = make_time_lapse(nt=8, size=48, nz=8, kind="integer", noise=0.05, seed=3)
+	shifts = dc.compute_shifts(data[:, 0])
+	assert rms_error(shifts, drift, 3) == 0
+
+
+@pytest.mark.parametrize("pyramid", [4, 8])
+def test_pyramid_small_frames(pyramid):
+	data, drift = make_time_lapse(nt=10, size=20, kind="integer", noise=0.05, seed=5)
+	shifts = dc.compute_shifts(data[:, 0], pyramid=pyramid)
+	np.testing.assert_array_equal(shifts[:, :2] - shifts[0, :2], drift[:, :2] - drift[0, :2])
+
+
+def test_pyramid_small_frames_3d():
+	data, drift = make_time_lapse(nt=8, size=48, nz=8, kind="integer", noise=0.05, seed=3)
+	shifts = dc.compute_shifts(data[:, 0], pyramid=2)
+	assert rms_error(shifts, drift, 3) == 0
+
+
+def test_clamp_pyramid():
+	assert dc.clamp_pyramid(8, (3, 512, 1024)) == 8
+	assert dc.clamp_pyramid(8, (256, 300)) == 4
+	assert dc.clamp_pyramid(4, (20, 20)) == 1
+
+
+def test_single_frame_rejected():
+	with pytest.raises(ValueError):
+		dc.compute_shifts(np.zeros((1, 1, 16, 16), dtype=np.uint16))
+
+
+def test_read_shifts_of_fiji_table(tmp_path):
+	# drift_correction.write_shifts() with confidence column
+	path = tmp_path / "shifts.txt"
+	path.write_text("ROI zero-based\nx_min\ty_min\tz_min\tx_max\ty_max\tz_max\n0\t0\t0\t63\t63\t0\nShifts\ndx\tdy\tdz\tconfidence\n0.0\t0.0\t0.0\t1.0\n2.0\t-1.0\t0.0\t0.83")
+	roi, shifts = dc.read_shifts(path)
+	assert roi == [0, 0, 0, 63, 63, 0]
+	np.testing.assert_array_equal(shifts, [[0, 0, 0], [2, -1, 0]])
+
+
+def test_compare_fiji_within_tolerance(tmp_path):
+	import tifffile
+	from drift_benchmark import compare_fiji
+
+	data, drift = make_time_lapse(nt=12, size=96, kind="integer", noise=0.05, seed=6)
+	base = str(tmp_path / "lapse")
+	tifffile.imwrite(base + ".tif", np.transpose(data, (0, 2, 1, 3, 4)), imagej=True, metadata={'axes': 'TZCYX'})
+	roi = [0, 0, 0, 95, 95, 0]
+	truth = dc.invert_shifts(drift)
+	dc.save_shifts(base + "_truth.txt", truth, roi)
+	# a FIJI table one pixel off from frame 5 on is within the tolerance, two pixels are not
+	fiji = truth.copy()
+	fiji[5:, 0] += 1
+	dc.save_shifts(base + "_fiji.txt", fiji, roi)
+	assert compare_fiji(base + ".tif")
+	fiji[5:, 0] += 1
+	dc.save_shifts(base + "_fiji.txt", fiji, roi)
+	assert not compare_fiji(base + ".tif")
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import tifffile
+
+import drift_correction_np as dc
+from drift_benchmark import make_time_lapse, residual_error
+
+
+@pytest.fixture(scope="module")
+def integer_lapse():
+	return make_time_lapse(nt=10, size=64, kind="integer", noise=0, channels=2, seed=4)
+
+
+@pytest.mark.parametrize("method", ["linear", "fourier"])
+def test_integer_correction_aligns_frames(integer_lapse, method):
+	data, drift = integer_lapse
+	registered = dc.register_stack(data, dc.invert_shifts(drift), crop=True, method=method)
+	assert registered.dtype == data.dtype
+	for c in range(data.shape[1]):
+		diff = np.abs(registered[:, c].astype(np.int64) - registered[0, c])
+		assert diff.max() <= 1
+
+
+def test_canvas_holds_all_frames(integer_lapse):
+	data, drift = integer_lapse
+	correction = dc.invert_shifts(drift)
+	registered = dc.register_stack(data, correction)
+	span = np.ptp(correction, axis=0)
+	assert registered.shape[-2:] == (64 + span[1], 64 + span[0])
+	# every frame keeps all its pixels
+	assert np.all(registered.reshape(len(data), -1).sum(axis=1) == data.reshape(len(data), -1).sum(axis=1))
+
+
+def test_subpixel_correction_residual():
+	data, drift = make_time_lapse(nt=12, size=96, kind="subpixel", noise=0.05, seed=5)
+	correction = dc.invert_shifts(drift)
+	assert residual_error(dc.register_stack(data, correction), correction, data.shape, 2) < 0.05
+	# the measured drift as correction, not the drift itself
+	assert residual_error(dc.register_stack(data, drift), drift, data.shape, 2) > 1
+
+
+def test_threads_and_batches(integer_lapse):
+	data, drift = integer_lapse
+	correction = dc.invert_shifts(drift) + 0.3
+	one = dc.register_stack(data, correction)
+	np.testing.assert_array_equal(dc.register_stack(data, correction, batch=3, threads=3), one)
+
+
+def test_save_registered(tmp_path, integer_lapse):
+	data, drift = integer_lapse
+	correction = dc.invert_shifts(drift)
+	path = str(tmp_path / "registered.tif")
+	dc.save_registered(path, data, correction, crop=True)
+	with tifffile.TiffFile(path) as tif:
+		assert tif.is_imagej
+		saved = tif.asarray()
+	np.testing.assert_array_equal(saved, dc.register_stack(data, correction, crop=True).squeeze())
+
+
+def test_invalid_arguments(integer_lapse):
+	data, drift = integer_lapse
+	with pytest.raises(ValueError):
+		dc.register_stack(data, drift, method="cubic")
+	with pytest.raises(ValueError):
+		dc.register_stack(data, drift, out=np.empty(data.shape, dtype=data.dtype))
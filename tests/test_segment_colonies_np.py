@@ -0,0 +1,71 @@
+import numpy as np
+
+import segment_colonies_np as sc
+
+CENTERS = [(30, 30), (40, 95), (95, 60)]
+
+
+def colony_mask(size=128, radius=12):
+	y, x = np.mgrid[:size, :size]
+	mask = np.zeros((size, size), dtype=bool)
+	for cy, cx in CENTERS:
+		mask |= (y - cy) ** 2 + (x - cx) ** 2 <= radius ** 2
+	return mask
+
+
+def phase_stack(nt=3, size=128):
+	"""
+	Phase contrast frames (T, Y, X): dark colonies on a light, uneven background.
+	"""
+	rng = np.random.default_rng(0)
+	mask = colony_mask(size)
+	y, x = np.mgrid[:size, :size]
+	frames = 3000 + 2.0 * x - 1200 * mask + rng.normal(0, 30, (nt, size, size))
+	return np.clip(frames, 0, 65535).astype(np.uint16), mask
+
+
+def test_segment_stack_finds_colonies():
+	stack, mask = phase_stack()
+	labels = sc.segment_stack(stack, sigma=2, batch=2)
+	assert labels.shape == stack.shape
+	for frame in labels:
+		assert frame.max() == len(CENTERS)
+		assert sc.iou(frame > 0, mask) > 0.8
+
+
+def test_fast_mode_finds_colonies():
+	stack, mask = phase_stack(nt=1)
+	labels = sc.segment_stack(stack, sigma=2, mode="fast")
+	assert labels[0].max() == len(CENTERS)
+	assert sc.iou(labels[0] > 0, mask) > 0.8
+
+
+def test_default_threshold_between_modes():
+	frame = np.full((32, 32), 1000, dtype=np.uint16)
+	frame[:, 16:] = 3000
+	frame[0, 0] = 900
+	frame[-1, -1] = 3100
+	threshold = sc.default_threshold(frame)
+	assert 1000 <= threshold < 3000
+
+
+def test_label_colonies_size_and_holes():
+	mask = np.zeros((40, 40), dtype=bool)
+	mask[5:20, 5:20] = True
+	mask[10:13, 10:13] = False
+	mask[30:32, 30:32] = True
+	labels = sc.label_colonies(mask, min_size=10)
+	assert labels.max() == 1
+	# the hole is filled, the small particle removed
+	assert np.count_nonzero(labels) == 15 * 15
+	assert sc.label_colonies(mask, min_size=10, pixel_size=0.1).max() == 0
+
+
+def test_polygon_mask_and_iou():
+	mask = sc.polygon_mask(np.array([2.0, 10.0, 10.0, 2.0]), np.array([3.0, 3.0, 8.0, 8.0]), (12, 12))
+	expected = np.zeros((12, 12), dtype=bool)
+	expected[3:8, 2:10] = True
+	np.testing.assert_array_equal(mask, expected)
+	assert sc.iou(mask, expected) == 1.0
+	assert sc.iou(mask, ~expected) == 0.0
+	assert sc.iou(np.zeros((2, 2), bool), np.zeros((2, 2), bool)) == 1.0
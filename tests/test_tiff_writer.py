@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import tifffile
+
+import tiff_writer
+
+
+@pytest.fixture
+def stack():
+	rng = np.random.default_rng(0)
+	return rng.integers(0, 4096, size=(3, 2, 40, 70), dtype=np.uint16)
+
+
+@pytest.mark.parametrize("compression", ["none", "deflate"])
+@pytest.mark.parametrize("threads", [1, 3])
+def test_write_stack_round_trip(tmp_path, stack, compression, threads):
+	path = str(tmp_path / "stack.tif")
+	tiff_writer.write_stack(path, iter(stack.reshape(-1, 40, 70)), stack.shape, stack.dtype, compression, threads=threads, metadata={"axes": "TCYX"})
+	with tifffile.TiffFile(path) as tif:
+		assert tif.is_imagej
+		assert tif.pages[0].compression == (1 if compression == "none" else 8)
+		np.testing.assert_array_equal(tif.asarray(), stack)
+
+
+def test_write_stack_default_uncompressed(tmp_path, stack):
+	path = str(tmp_path / "stack.tif")
+	tiff_writer.write_stack(path, iter(stack[0]), stack.shape[1:], stack.dtype)
+	with tifffile.TiffFile(path) as tif:
+		assert tif.pages[0].compression == 1
+
+
+def test_write_stack_tiles(tmp_path, stack):
+	path = str(tmp_path / "tiled.tif")
+	planes = stack.reshape(-1, 40, 70)
+	tiff_writer.write_stack(path, iter(planes), planes.shape, planes.dtype, "deflate", tile=(16, 32), threads=2)
+	with tifffile.TiffFile(path) as tif:
+		assert tif.pages[0].is_tiled
+		np.testing.assert_array_equal(tif.asarray(), planes)
+
+
+def test_write_stack_float(tmp_path):
+	planes = np.random.default_rng(1).random((2, 20, 30)).astype(np.float32)
+	path = str(tmp_path / "float.tif")
+	tiff_writer.write_stack(path, iter(planes), planes.shape, planes.dtype, "deflate")
+	np.testing.assert_array_equal(tifffile.imread(path), planes)
+
+
+def test_plane_writer_done_after_write(tmp_path, stack):
+	planes = stack.reshape(-1, 40, 70)
+	saved = []
+
+	def done(path):
+		# the file is complete when done is called
+		saved.append((path, tifffile.imread(path)))
+
+	with tiff_writer.PlaneWriter("deflate", threads=2) as writer:
+		for i, plane in enumerate(planes):
+			writer.write(str(tmp_path / f"plane_{i}.tif"), plane, done)
+	assert sorted(path for path, _ in saved) == sorted(str(tmp_path / f"plane_{i}.tif") for i in range(len(planes)))
+	for path, data in saved:
+		np.testing.assert_array_equal(data, planes[int(path[-5])])
+
+
+def test_unknown_compression():
+	with pytest.raises(ValueError):
+		tiff_writer.get_encoder("jpeg")
+
+
+def test_plane_writer_raises_write_errors(tmp_path, stack):
+	saved = []
+	with pytest.raises(OSError):
+		with tiff_writer.PlaneWriter(threads=2) as writer:
+			writer.write(str(tmp_path / "missing" / "plane.tif"), stack[0, 0], saved.append)
+			writer.flush()
+	assert saved == []